@@ -0,0 +1,60 @@
+"""Index every hot query in db.py
+
+Revision ID: 35472a93959b
+Revises: e88ee3ea0666
+Create Date: 2026-10-17 10:41:07.118523
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '35472a93959b'
+down_revision: Union[str, None] = 'e88ee3ea0666'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction; autocommit_block()
+    # lets the bots keep writing while the indexes build.
+    with op.get_context().autocommit_block():
+        # get_subscription / get_user and the ON CONFLICT (user_id, bot) upsert
+        op.create_index('uq_subscriptions_user_id_bot', 'subscriptions', ['user_id', 'bot'],
+                        unique=True, postgresql_concurrently=True, if_not_exists=True)
+        # get_supervisors, get_users_by_role
+        op.create_index('ix_subscriptions_role_bot', 'subscriptions', ['role', 'bot'],
+                        postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_subscriptions_role_lower_client', 'subscriptions',
+                        ['role', sa.text('lower(client)')],
+                        postgresql_concurrently=True, if_not_exists=True)
+        # get_clients_by_name
+        op.create_index('ix_subscriptions_client', 'subscriptions', ['client'],
+                        postgresql_concurrently=True, if_not_exists=True)
+        # get_all_open_tickets: most tickets are closed, so index only the open ones
+        op.create_index('ix_tickets_open_created_at', 'tickets', ['created_at', 'ticket_id'],
+                        postgresql_where=sa.text("status <> 'Closed'"),
+                        postgresql_concurrently=True, if_not_exists=True)
+        # get_tickets_by_user, get_tickets_by_client
+        op.create_index('ix_tickets_da_id_created_at', 'tickets', ['da_id', 'created_at', 'ticket_id'],
+                        postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_tickets_client_created_at', 'tickets', ['client', 'created_at', 'ticket_id'],
+                        postgresql_concurrently=True, if_not_exists=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for table_name, index_name in (
+            ('tickets', 'ix_tickets_client_created_at'),
+            ('tickets', 'ix_tickets_da_id_created_at'),
+            ('tickets', 'ix_tickets_open_created_at'),
+            ('subscriptions', 'ix_subscriptions_client'),
+            ('subscriptions', 'ix_subscriptions_role_lower_client'),
+            ('subscriptions', 'ix_subscriptions_role_bot'),
+            ('subscriptions', 'uq_subscriptions_user_id_bot'),
+        ):
+            op.drop_index(index_name, table_name=table_name,
+                          postgresql_concurrently=True, if_exists=True)
@@ -0,0 +1,40 @@
+"""Order id search indexes (text_pattern_ops and pg_trgm)
+
+Revision ID: 431f2f156534
+Revises: 35472a93959b
+Create Date: 2026-10-17 11:26:54.730461
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '431f2f156534'
+down_revision: Union[str, None] = '35472a93959b'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    with op.get_context().autocommit_block():
+        # Exact and prefix (LIKE 'x%') matches, independent of the database collation
+        op.create_index('ix_tickets_order_id_pattern', 'tickets', ['order_id'],
+                        postgresql_ops={'order_id': 'text_pattern_ops'},
+                        postgresql_concurrently=True, if_not_exists=True)
+        # Substring (ILIKE '%x%') matches
+        op.create_index('ix_tickets_order_id_trgm', 'tickets', ['order_id'],
+                        postgresql_using='gin', postgresql_ops={'order_id': 'gin_trgm_ops'},
+                        postgresql_concurrently=True, if_not_exists=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_tickets_order_id_trgm', table_name='tickets',
+                      postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_tickets_order_id_pattern', table_name='tickets',
+                      postgresql_concurrently=True, if_exists=True)
+    # pg_trgm is left installed; other objects may depend on it
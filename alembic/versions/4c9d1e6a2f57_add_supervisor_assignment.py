@@ -0,0 +1,41 @@
+"""Assign each ticket to one supervisor
+
+Revision ID: 4c9d1e6a2f57
+Revises: b7f2c9a4e013
+Create Date: 2026-10-17 18:12:44.902631
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '4c9d1e6a2f57'
+down_revision: Union[str, None] = 'b7f2c9a4e013'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('tickets', sa.Column('assigned_supervisor_id', sa.BigInteger(), nullable=True))
+    op.add_column('tickets', sa.Column('assigned_at', sa.DateTime(), nullable=True))
+    op.add_column('subscriptions',
+                  sa.Column('available', sa.Boolean(), server_default=sa.text('true'), nullable=False))
+
+    # Existing tickets stay unassigned: their supervisor notifications keep going to everyone
+    with op.get_context().autocommit_block():
+        # db.assign_supervisor() open-ticket counts, db.claim_overdue_assignment()
+        op.create_index('ix_tickets_assigned_open', 'tickets', ['assigned_supervisor_id', 'assigned_at'],
+                        postgresql_where=sa.text("status <> 'Closed'"),
+                        postgresql_concurrently=True, if_not_exists=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_tickets_assigned_open', table_name='tickets',
+                      postgresql_concurrently=True, if_exists=True)
+    op.drop_column('subscriptions', 'available')
+    op.drop_column('tickets', 'assigned_at')
+    op.drop_column('tickets', 'assigned_supervisor_id')
@@ -0,0 +1,32 @@
+"""Add photo_file_ids for reusing Telegram file_ids of ticket photos
+
+Revision ID: 5d0e7c3f91a4
+Revises: 3ab822a2569f
+Create Date: 2026-10-17 15:22:09.634120
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5d0e7c3f91a4'
+down_revision: Union[str, None] = '3ab822a2569f'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('photo_file_ids',
+    sa.Column('image_url', sa.String(), nullable=False),
+    sa.Column('bot', sa.String(), nullable=False),
+    sa.Column('file_id', sa.String(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), server_default=sa.text('now()'), nullable=True),
+    sa.PrimaryKeyConstraint('image_url', 'bot')
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('photo_file_ids')
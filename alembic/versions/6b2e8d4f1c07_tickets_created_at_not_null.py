@@ -0,0 +1,33 @@
+"""Make tickets.created_at NOT NULL
+
+Revision ID: 6b2e8d4f1c07
+Revises: a4e7d2c9b351
+Create Date: 2026-10-17 09:12:27.540219
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '6b2e8d4f1c07'
+down_revision: Union[str, None] = 'a4e7d2c9b351'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Keyset pagination orders by created_at; legacy tickets without one get their first event's time
+    op.execute("""
+        UPDATE tickets t SET created_at = COALESCE(
+            (SELECT min(e.timestamp) FROM ticket_events e WHERE e.ticket_id = t.ticket_id), 'epoch')
+        WHERE created_at IS NULL
+    """)
+    op.alter_column('tickets', 'created_at', existing_type=sa.DateTime(), nullable=False,
+                    server_default=sa.text('now()'))
+
+
+def downgrade() -> None:
+    op.alter_column('tickets', 'created_at', existing_type=sa.DateTime(), nullable=True, server_default=None)
@@ -0,0 +1,38 @@
+"""Track sent notification messages so status changes edit them in place
+
+Revision ID: 8e41b2d07c6a
+Revises: 5d0e7c3f91a4
+Create Date: 2026-10-17 16:48:12.503917
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8e41b2d07c6a'
+down_revision: Union[str, None] = '5d0e7c3f91a4'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('notification_messages',
+    sa.Column('ticket_id', sa.Integer(), nullable=False),
+    sa.Column('bot', sa.String(), nullable=False),
+    sa.Column('chat_id', sa.BigInteger(), nullable=False),
+    sa.Column('message_id', sa.BigInteger(), nullable=False),
+    sa.Column('has_photo', sa.Boolean(), server_default='false', nullable=False),
+    sa.Column('text', sa.Text(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), server_default=sa.text('now()'), nullable=True),
+    sa.ForeignKeyConstraint(['ticket_id'], ['tickets.ticket_id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('ticket_id', 'bot', 'chat_id')
+    )
+    op.add_column('outbox', sa.Column('delivered_as', sa.String(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('outbox', 'delivered_as')
+    op.drop_table('notification_messages')
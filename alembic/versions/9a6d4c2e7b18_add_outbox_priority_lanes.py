@@ -0,0 +1,43 @@
+"""Add outbox priority lanes
+
+Revision ID: 9a6d4c2e7b18
+Revises: e5a8f3b1c942
+Create Date: 2026-10-17 20:12:47.530916
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9a6d4c2e7b18'
+down_revision: Union[str, None] = 'e5a8f3b1c942'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+PENDING = "status = 'pending'"
+
+
+def upgrade() -> None:
+    op.add_column('outbox', sa.Column('lane', sa.String(), server_default='normal', nullable=False))
+    # Rows still waiting go in the lane notifier.KIND_LANES gives their kind now
+    op.execute("""
+        UPDATE outbox SET lane = CASE
+            WHEN payload->>'mode' = 'digest' THEN 'normal'
+            WHEN kind IN ('notify_supervisors', 'notify_da_moreinfo') THEN 'urgent'
+            WHEN kind IN ('send_to_client', 'notify_client', 'refresh') THEN 'bulk'
+            ELSE 'normal' END
+        WHERE status = 'pending'
+    """)
+    # db.claim_outbox() claims one lane at a time
+    op.create_index('ix_outbox_lane_due', 'outbox', ['lane', 'next_attempt_at', 'id'],
+                    postgresql_where=sa.text(PENDING))
+    op.drop_index('ix_outbox_due', table_name='outbox', postgresql_where=sa.text(PENDING))
+
+
+def downgrade() -> None:
+    op.create_index('ix_outbox_due', 'outbox', ['next_attempt_at', 'id'], postgresql_where=sa.text(PENDING))
+    op.drop_index('ix_outbox_lane_due', table_name='outbox', postgresql_where=sa.text(PENDING))
+    op.drop_column('outbox', 'lane')
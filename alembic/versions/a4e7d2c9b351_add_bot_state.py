@@ -0,0 +1,34 @@
+"""Add bot_state
+
+Revision ID: a4e7d2c9b351
+Revises: f3c81a5d9e26
+Create Date: 2026-10-17 23:05:41.218736
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a4e7d2c9b351'
+down_revision: Union[str, None] = 'f3c81a5d9e26'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('bot_state',
+    sa.Column('bot', sa.String(), nullable=False),
+    sa.Column('kind', sa.String(), nullable=False),
+    sa.Column('key', sa.String(), nullable=False),
+    sa.Column('data', postgresql.JSONB(astext_type=sa.Text()), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+    sa.PrimaryKeyConstraint('bot', 'kind', 'key')
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('bot_state')
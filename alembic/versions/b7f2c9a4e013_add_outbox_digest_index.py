@@ -0,0 +1,30 @@
+"""Index a chat's pending digest entries in the outbox
+
+Revision ID: b7f2c9a4e013
+Revises: 8e41b2d07c6a
+Create Date: 2026-10-17 17:31:26.118402
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b7f2c9a4e013'
+down_revision: Union[str, None] = '8e41b2d07c6a'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+DIGEST_WHERE = "status = 'pending' AND payload->>'mode' = 'digest'"
+
+
+def upgrade() -> None:
+    # db.enqueue_notifications(digest_window=...) and db.claim_outbox(); only pending
+    # digest entries are indexed, so this stays small
+    op.create_index('ix_outbox_digest', 'outbox', ['bot', 'chat_id'], postgresql_where=sa.text(DIGEST_WHERE))
+
+
+def downgrade() -> None:
+    op.drop_index('ix_outbox_digest', table_name='outbox', postgresql_where=sa.text(DIGEST_WHERE))
@@ -0,0 +1,90 @@
+"""Add clients and reference them from tickets and subscriptions by id
+
+Revision ID: c7b648e633ef
+Revises: 431f2f156534
+Create Date: 2026-10-17 12:48:20.516392
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c7b648e633ef'
+down_revision: Union[str, None] = '431f2f156534'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('clients',
+    sa.Column('client_id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('name_key', sa.String(), sa.Computed('lower(btrim(name))', persisted=True), nullable=False),
+    sa.PrimaryKeyConstraint('client_id'),
+    sa.UniqueConstraint('name_key')
+    )
+    op.add_column('tickets', sa.Column('client_id', sa.Integer(), nullable=True))
+    op.create_foreign_key('tickets_client_id_fkey', 'tickets', 'clients', ['client_id'], ['client_id'])
+    op.add_column('subscriptions', sa.Column('client_id', sa.Integer(), nullable=True))
+    op.create_foreign_key('subscriptions_client_id_fkey', 'subscriptions', 'clients', ['client_id'], ['client_id'])
+
+    # Backfill: one client per distinct normalized name, keeping the most used spelling.
+    # The free-text client columns stay as display names.
+    op.execute("""
+        INSERT INTO clients (name)
+        SELECT DISTINCT ON (lower(name)) name
+        FROM (
+            SELECT btrim(client) AS name, count(*) AS uses
+            FROM (SELECT client FROM tickets UNION ALL SELECT client FROM subscriptions) c
+            WHERE btrim(client) <> ''
+            GROUP BY btrim(client)
+        ) n
+        ORDER BY lower(name), uses DESC, name
+    """)
+    op.execute("""
+        UPDATE tickets t SET client_id = c.client_id
+        FROM clients c WHERE c.name_key = lower(btrim(t.client))
+    """)
+    op.execute("""
+        UPDATE subscriptions s SET client_id = c.client_id
+        FROM clients c WHERE c.name_key = lower(btrim(s.client))
+    """)
+
+    # autocommit_block() commits the backfill before the concurrent index builds
+    with op.get_context().autocommit_block():
+        # get_tickets_by_client, get_tickets_page(client=..., client_user_id=...)
+        op.create_index('ix_tickets_client_id_created_at', 'tickets', ['client_id', 'created_at', 'ticket_id'],
+                        postgresql_concurrently=True, if_not_exists=True)
+        # get_users_by_role(client=...), get_clients_by_name
+        op.create_index('ix_subscriptions_client_id_role', 'subscriptions', ['client_id', 'role'],
+                        postgresql_concurrently=True, if_not_exists=True)
+        # The string comparisons these served are gone
+        op.drop_index('ix_tickets_client_created_at', table_name='tickets',
+                      postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_subscriptions_role_lower_client', table_name='subscriptions',
+                      postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_subscriptions_client', table_name='subscriptions',
+                      postgresql_concurrently=True, if_exists=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.create_index('ix_subscriptions_client', 'subscriptions', ['client'],
+                        postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_subscriptions_role_lower_client', 'subscriptions',
+                        ['role', sa.text('lower(client)')],
+                        postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_tickets_client_created_at', 'tickets', ['client', 'created_at', 'ticket_id'],
+                        postgresql_concurrently=True, if_not_exists=True)
+        op.drop_index('ix_subscriptions_client_id_role', table_name='subscriptions',
+                      postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_tickets_client_id_created_at', table_name='tickets',
+                      postgresql_concurrently=True, if_exists=True)
+    op.drop_constraint('subscriptions_client_id_fkey', 'subscriptions', type_='foreignkey')
+    op.drop_column('subscriptions', 'client_id')
+    op.drop_constraint('tickets_client_id_fkey', 'tickets', type_='foreignkey')
+    op.drop_column('tickets', 'client_id')
+    op.drop_table('clients')
@@ -0,0 +1,31 @@
+"""Add outbox dedup keys
+
+Revision ID: e5a8f3b1c942
+Revises: 4c9d1e6a2f57
+Create Date: 2026-10-17 18:58:03.271845
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e5a8f3b1c942'
+down_revision: Union[str, None] = '4c9d1e6a2f57'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('outbox', sa.Column('dedup_key', sa.String(), nullable=True))
+    # The ON CONFLICT arbiter of db.enqueue_notifications(); existing rows have no key.
+    # Not built concurrently: the outbox is small, and purged of delivered rows.
+    op.create_index('uq_outbox_dedup', 'outbox', ['dedup_key', 'bot', 'chat_id'], unique=True,
+                    postgresql_where=sa.text('dedup_key IS NOT NULL'))
+
+
+def downgrade() -> None:
+    op.drop_index('uq_outbox_dedup', table_name='outbox', postgresql_where=sa.text('dedup_key IS NOT NULL'))
+    op.drop_column('outbox', 'dedup_key')
@@ -0,0 +1,81 @@
+"""Add ticket_events and backfill from tickets.logs
+
+Revision ID: e88ee3ea0666
+Revises: 7dd84ef15977
+Create Date: 2026-10-17 09:12:31.402118
+
+"""
+from typing import Sequence, Union
+import datetime
+import json
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e88ee3ea0666'
+down_revision: Union[str, None] = '7dd84ef15977'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def _parse_timestamp(value):
+    try:
+        return datetime.datetime.fromisoformat(value) if value else None
+    except (TypeError, ValueError):
+        return None
+
+
+def upgrade() -> None:
+    op.add_column('tickets', sa.Column('event_seq', sa.Integer(), server_default='0', nullable=False))
+    op.create_table('ticket_events',
+    sa.Column('ticket_id', sa.Integer(), nullable=False),
+    sa.Column('seq', sa.Integer(), nullable=False),
+    sa.Column('action', sa.String(), nullable=False),
+    sa.Column('message', sa.Text(), nullable=True),
+    sa.Column('actor', sa.BigInteger(), nullable=True),
+    sa.Column('timestamp', sa.DateTime(), server_default=sa.text('now()'), nullable=True),
+    sa.ForeignKeyConstraint(['ticket_id'], ['tickets.ticket_id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('ticket_id', 'seq')
+    )
+
+    # Backfill: one ticket_events row per entry of the legacy JSON logs column.
+    # Unparseable histories are skipped, matching how the bots used to read them.
+    bind = op.get_bind()
+    rows = bind.execute(sa.text(
+        "SELECT ticket_id, logs FROM tickets WHERE logs IS NOT NULL AND logs <> '' ORDER BY ticket_id"
+    )).fetchall()
+    insert_event = sa.text("""
+        INSERT INTO ticket_events (ticket_id, seq, action, message, actor, timestamp)
+        VALUES (:ticket_id, :seq, :action, :message, NULL, COALESCE(:timestamp, now()))
+    """)
+    update_seq = sa.text("UPDATE tickets SET event_seq = :seq WHERE ticket_id = :ticket_id")
+    for ticket_id, logs in rows:
+        try:
+            entries = json.loads(logs)
+        except ValueError:
+            continue
+        if not isinstance(entries, list):
+            continue
+        params = []
+        for entry in entries:
+            if not isinstance(entry, dict):
+                continue
+            params.append({
+                "ticket_id": ticket_id,
+                "seq": len(params) + 1,
+                "action": entry.get("action") or "unknown",
+                "message": entry.get("message"),
+                "timestamp": _parse_timestamp(entry.get("timestamp")),
+            })
+        if params:
+            bind.execute(insert_event, params)
+            bind.execute(update_seq, {"ticket_id": ticket_id, "seq": len(params)})
+
+
+def downgrade() -> None:
+    # tickets.logs is left untouched by upgrade(), so dropping the events is lossless
+    # for history written before the upgrade.
+    op.drop_table('ticket_events')
+    op.drop_column('tickets', 'event_seq')
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# benchmarks/assignment.py
+"""
+Supervisor notifications per ticket with broadcast against assignment
+(SUPERVISOR_ASSIGNMENT), counted in the outbox; nothing is sent.
+
+Creates `--tickets` tickets over `--clients` clients and reports, for each
+variant, the notifications queued per ticket. For assignment it also reports
+how evenly the open tickets spread over the supervisors, how often a client's
+ticket went to a supervisor who already had one of theirs, and whether
+notifier.reassign_overdue() hands every overdue ticket to someone else.
+
+Uses benchmark subscriptions, BENCH-ASSIGN tickets and their outbox rows, all
+deleted afterwards. Point DB_NAME at a scratch database.
+
+    python -m benchmarks.assignment
+    python -m benchmarks.assignment --supervisors 20 --tickets 400
+"""
+
+import argparse
+import time
+from collections import Counter
+
+from sqlalchemy import text
+
+import config
+import db
+import notifier
+
+BASE_USER_ID = 9400000
+ORDER_PREFIX = "BENCH-ASSIGN-"
+WHERE = f"ticket_id IN (SELECT ticket_id FROM tickets WHERE order_id LIKE '{ORDER_PREFIX}%')"
+
+
+def cleanup(subscriptions=True):
+    with db.get_connection() as conn:
+        conn.execute(text(f"DELETE FROM outbox WHERE {WHERE}"))
+        conn.execute(text("DELETE FROM tickets WHERE order_id LIKE :prefix"), {"prefix": ORDER_PREFIX + "%"})
+        if subscriptions:
+            conn.execute(text("DELETE FROM subscriptions WHERE user_id BETWEEN :low AND :high"),
+                         {"low": BASE_USER_ID, "high": BASE_USER_ID + 99999})
+            conn.execute(text("DELETE FROM clients WHERE name LIKE 'bench-client-%'"))
+        conn.commit()
+    db.clear_caches()
+
+
+def create_tickets(args, assignment):
+    config.SUPERVISOR_ASSIGNMENT = assignment
+    start = time.perf_counter()
+    for index in range(args.tickets):
+        db.add_ticket(f"{ORDER_PREFIX}{index}", "benchmark", "المخزن", "تالف", f"bench-client-{index % args.clients}",
+                      None, "Opened", BASE_USER_ID,
+                      notify=lambda conn, ticket: notifier.notify_supervisors(ticket, conn=conn))
+    elapsed = time.perf_counter() - start
+    with db.get_connection() as conn:
+        queued = conn.execute(text(f"SELECT count(*) FROM outbox WHERE {WHERE}")).scalar()
+    return queued, elapsed
+
+
+def assignments():
+    with db.get_connection() as conn:
+        return conn.execute(text("""
+            SELECT ticket_id, client_id, assigned_supervisor_id FROM tickets
+            WHERE order_id LIKE :prefix ORDER BY ticket_id
+        """), {"prefix": ORDER_PREFIX + "%"}).fetchall()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--supervisors", type=int, default=10)
+    parser.add_argument("--tickets", type=int, default=200)
+    parser.add_argument("--clients", type=int, default=15)
+    args = parser.parse_args()
+
+    db.init_db()
+    cleanup()
+    try:
+        for user_id in range(BASE_USER_ID, BASE_USER_ID + args.supervisors):
+            db.add_subscription(user_id, "0", "Supervisor", "Supervisor", None, "bench", None, None, user_id)
+        supervisors = len(db.get_supervisors())
+        print(f"{args.tickets} tickets, {args.clients} clients, {supervisors} supervisors\n")
+        print(f"{'variant':<10} {'queued':>7} {'per ticket':>10} {'ms/ticket':>9}")
+        for name, assignment in (("broadcast", False), ("assigned", True)):
+            cleanup(subscriptions=False)
+            queued, elapsed = create_tickets(args, assignment)
+            print(f"{name:<10} {queued:>7} {queued / args.tickets:>10.1f} {elapsed / args.tickets * 1000:>9.2f}")
+
+        rows = assignments()
+        load = Counter(row.assigned_supervisor_id for row in rows)
+        seen, repeat, affine = set(), 0, 0
+        for row in rows:
+            if any(client == row.client_id for client, _ in seen):
+                repeat += 1
+                affine += (row.client_id, row.assigned_supervisor_id) in seen
+            seen.add((row.client_id, row.assigned_supervisor_id))
+        print(f"\nopen tickets per supervisor: min {min(load.values())}, max {max(load.values())} "
+              f"over {len(load)} supervisors")
+        print(f"repeat-client tickets to a supervisor who had the client: {affine}/{repeat}")
+
+        # Every ticket overdue: each has to move to a different supervisor
+        before = {row.ticket_id: row.assigned_supervisor_id for row in rows}
+        with db.get_connection() as conn:
+            conn.execute(text(f"UPDATE tickets SET assigned_at = assigned_at - interval '1 hour' WHERE {WHERE}"))
+            conn.commit()
+        moved = notifier.reassign_overdue(timeout=60)
+        after = {row.ticket_id: row.assigned_supervisor_id for row in assignments()}
+        changed = sum(before[ticket_id] != after[ticket_id] for ticket_id in before)
+        print(f"reassign_overdue: {moved} moved, {changed}/{len(before)} now with another supervisor")
+    finally:
+        cleanup()
+
+
+if __name__ == "__main__":
+    main()
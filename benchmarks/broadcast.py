@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# benchmarks/broadcast.py
+"""
+A message to every DA through a per-recipient send loop against a broadcast
+(db.create_broadcast, sent by the dispatcher), against the local fake Bot API
+(benchmarks/fake_bot_api.py) with Telegram's rate limits.
+
+Seeds `--das` DA subscriptions, `--blocked` of which have blocked the bot (403).
+
+  send loop   bot.send_message() to each DA in turn, as a handler would; the first
+              error (a 429 or a blocked DA) ends it
+  broadcast   one broadcast; the dispatcher is stopped after `--restart-after`
+              seconds and a new one started, which carries on from the checkpoint
+
+Reports the DAs reached, failures, chats that got the message twice, 429s and
+the wall time.
+
+Uses benchmark subscriptions, broadcasts and their outbox rows, all deleted
+afterwards. Point DB_NAME at a scratch database.
+
+    python -m benchmarks.broadcast
+    python -m benchmarks.broadcast --das 3000 --restart-after 20
+"""
+
+import argparse
+import time
+from collections import Counter
+
+from sqlalchemy import text
+
+import db
+import dispatcher
+import notifier
+from benchmarks.fake_bot_api import FakeBotAPI
+from benchmarks.outbox import use_fake_api
+
+BASE_USER_ID = 9600000
+CREATED_BY = 9600000
+
+
+def cleanup():
+    with db.get_connection() as conn:
+        conn.execute(text("""
+            DELETE FROM outbox WHERE kind = 'broadcast'
+               AND dedup_key IN (SELECT 'broadcast:' || id FROM broadcasts WHERE created_by = :created_by)
+        """), {"created_by": CREATED_BY})
+        conn.execute(text("DELETE FROM broadcasts WHERE created_by = :created_by"), {"created_by": CREATED_BY})
+        conn.execute(text("DELETE FROM subscriptions WHERE user_id BETWEEN :low AND :high"),
+                     {"low": BASE_USER_ID, "high": BASE_USER_ID + 99999})
+        conn.commit()
+    db.clear_caches()
+
+
+def seed_das(count):
+    with db.get_connection() as conn:
+        conn.execute(text("""
+            INSERT INTO subscriptions (user_id, chat_id, phone, role, bot, username)
+            SELECT user_id, user_id, '0', 'DA', 'DA', 'bench' FROM generate_series(:low, :high) AS user_id
+        """), {"low": BASE_USER_ID, "high": BASE_USER_ID + count - 1})
+        conn.commit()
+
+
+async def send_loop(bot, chat_ids):
+    sent = 0
+    for chat_id in chat_ids:
+        try:
+            await bot.send_message(chat_id=chat_id, text="benchmark")
+        except Exception:
+            break
+        sent += 1
+    return sent
+
+
+def duplicates(fake):
+    chats = Counter(params.get("chat_id") for _, _, params, _ in fake.sent)
+    return sum(1 for count in chats.values() if count > 1)
+
+
+def wait_until_done(broadcast_id, timeout=600):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        broadcast = next(b for b in db.get_broadcasts(limit=50) if b['id'] == broadcast_id)
+        if broadcast['status'] == 'done':
+            return broadcast
+        time.sleep(0.5)
+    raise TimeoutError(f"broadcast {broadcast_id} not done after {timeout}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--das", type=int, default=1000)
+    parser.add_argument("--blocked", type=int, default=20)
+    parser.add_argument("--restart-after", type=float, default=10.0, help="seconds before the dispatcher restarts")
+    parser.add_argument("--latency", type=float, default=0.05, help="fake API seconds per request")
+    args = parser.parse_args()
+
+    db.init_db()
+    fake = notifier.run(FakeBotAPI(latency=args.latency).start())
+    cleanup()
+    try:
+        seed_das(args.das)
+        chat_ids = [sub['chat_id'] for sub in db.get_all_subscriptions() if sub['bot'] == "DA"]
+        # Spread the blocked DAs over the list
+        step = max(1, len(chat_ids) // max(1, args.blocked))
+        fake.blocked_chats = {str(chat_id) for chat_id in chat_ids[step // 2::step][:args.blocked]}
+        print(f"{len(chat_ids)} DAs, {len(fake.blocked_chats)} blocked; fake Bot API {fake.global_rate} msg/s "
+              f"per bot, {args.latency * 1000:.0f} ms per request\n")
+        print(f"{'variant':<10} {'reached':>8} {'failed':>6} {'twice':>5} {'429s':>5} {'wall s':>7}")
+
+        fake.reset()
+        bot = notifier.make_bot("1:benchmark", base_url=f"{fake.url}/bot")
+        start = time.monotonic()
+        reached = notifier.run(send_loop(bot, chat_ids))
+        wall = time.monotonic() - start
+        notifier.run(bot.shutdown())
+        print(f"{'send loop':<10} {reached:>8} {'-':>6} {duplicates(fake):>5} {fake.rate_limited:>5} {wall:>7.1f}"
+              f"  (gave up at DA {reached + 1})")
+
+        time.sleep(1.1)  # let the fake's one-second windows drain
+        use_fake_api(fake)
+        fake.reset()
+        start = time.monotonic()
+        broadcast = db.create_broadcast("DA", "benchmark", created_by=CREATED_BY)
+        running = dispatcher.Dispatcher().start()
+        time.sleep(args.restart_after)
+        running.stop()
+        checkpoint = next(b for b in db.get_broadcasts(limit=50) if b['id'] == broadcast['id'])
+        running = dispatcher.Dispatcher().start()
+        try:
+            done = wait_until_done(broadcast['id'])
+        finally:
+            running.stop()
+        wall = time.monotonic() - start
+        print(f"{'broadcast':<10} {done['delivered']:>8} {done['failed']:>6} {duplicates(fake):>5} "
+              f"{fake.rate_limited:>5} {wall:>7.1f}  (restarted with {checkpoint['queued']} queued, "
+              f"{checkpoint['delivered']} delivered)")
+    finally:
+        cleanup()
+        notifier.run(fake.stop())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# benchmarks/cards.py
+"""
+Ticket lifecycles with and without edit-in-place notifications, against the
+local fake Bot API (benchmarks/fake_bot_api.py).
+
+Each of `--tickets` tickets is opened (notify_supervisors), solved by a
+supervisor (supervisor_solution: notify_da) and closed by the DA (da_closed),
+with a dispatcher sending the outbox. "resend only" is the behaviour before
+notification_messages: every event sends a new message and nothing else.
+"edit in place" also refreshes the messages already sent about the ticket.
+Reports the Bot API calls by kind, the new messages per ticket, and how many
+messages were left showing buttons of a closed ticket.
+
+Uses benchmark subscriptions, BENCH-CARDS tickets and their outbox rows, all
+deleted afterwards. Point DB_NAME at a scratch database.
+
+    python -m benchmarks.cards
+    python -m benchmarks.cards --supervisors 20 --tickets 10
+"""
+
+import argparse
+import time
+
+from sqlalchemy import text
+
+import config
+import db
+import dispatcher
+import notifier
+from benchmarks.fake_bot_api import FakeBotAPI
+from benchmarks.outbox import use_fake_api, wait_for_outbox
+
+BASE_USER_ID = 9200000
+DA_USER_ID = BASE_USER_ID - 1
+ORDER_PREFIX = "BENCH-CARDS-"
+
+
+def cleanup():
+    cleanup_tickets()
+    with db.get_connection() as conn:
+        conn.execute(text("DELETE FROM subscriptions WHERE user_id BETWEEN :low AND :high"),
+                     {"low": DA_USER_ID, "high": BASE_USER_ID + 99999})
+        conn.commit()
+    db.clear_caches()
+
+
+def cleanup_tickets():
+    with db.get_connection() as conn:
+        conn.execute(text("""
+            DELETE FROM outbox
+            WHERE ticket_id IN (SELECT ticket_id FROM tickets WHERE order_id LIKE :prefix)
+        """), {"prefix": ORDER_PREFIX + "%"})
+        conn.execute(text("DELETE FROM tickets WHERE order_id LIKE :prefix"), {"prefix": ORDER_PREFIX + "%"})
+        conn.commit()
+
+
+def lifecycle(index):
+    """Open, solve and close one ticket, waiting for the outbox after each step."""
+    where = "ticket_id IN (SELECT ticket_id FROM tickets WHERE order_id LIKE '" + ORDER_PREFIX + "%')"
+    ticket_id = db.add_ticket(f"{ORDER_PREFIX}{index}", "benchmark", "المخزن", "تالف", "bench", None, "Opened",
+                              DA_USER_ID, notify=lambda conn, ticket: notifier.notify_supervisors(ticket, conn=conn))
+    wait_for_outbox(where)
+    db.apply_transition(ticket_id, "supervisor_solution", "الحل", actor=BASE_USER_ID,
+                        notify=lambda conn, ticket: notifier.notify_da(ticket, conn=conn))
+    wait_for_outbox(where)
+    db.apply_transition(ticket_id, "da_closed", actor=DA_USER_ID,
+                        notify=lambda conn, ticket: notifier.refresh_cards(conn, ticket))
+    wait_for_outbox(where)
+
+
+def stale_keyboards():
+    """Messages whose last send or edit left an inline keyboard (every ticket ends closed)."""
+    with db.get_connection() as conn:
+        rows = conn.execute(text("""
+            SELECT bot, chat_id, message_id, payload->'reply_markup' FROM outbox
+            WHERE status = 'done' AND delivered_as IN ('send', 'edit')
+              AND ticket_id IN (SELECT ticket_id FROM tickets WHERE order_id LIKE :prefix)
+            ORDER BY id
+        """), {"prefix": ORDER_PREFIX + "%"}).fetchall()
+    keyboards = {}
+    for bot, chat_id, message_id, markup in rows:
+        keyboards[bot, chat_id, message_id] = bool(markup and markup.get("inline_keyboard"))
+    return sum(keyboards.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--supervisors", type=int, default=10)
+    parser.add_argument("--tickets", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.05, help="fake API seconds per request")
+    args = parser.parse_args()
+
+    db.init_db()
+    # Every supervisor gets every ticket, as before assignment (benchmarks.assignment)
+    config.SUPERVISOR_ASSIGNMENT = False
+    refresh_cards = notifier.refresh_cards
+    # No rate limits: only the calls made are counted
+    fake = notifier.run(FakeBotAPI(latency=args.latency, global_rate=100000, per_chat_rate=100000).start())
+    cleanup()
+    try:
+        db.add_subscription(DA_USER_ID, "0", "DA", "DA", None, "bench", None, None, DA_USER_ID)
+        for user_id in range(BASE_USER_ID, BASE_USER_ID + args.supervisors):
+            db.add_subscription(user_id, "0", "Supervisor", "Supervisor", None, "bench", None, None, user_id)
+        supervisors = len(db.get_supervisors())
+        print(f"{args.tickets} ticket lifecycles (open, solve, close), {supervisors} supervisors, 1 DA\n")
+        print(f"{'variant':<14} {'sends':>6} {'edits':>6} {'new msgs/ticket':>15} {'stale keyboards':>15} {'wall s':>7}")
+        for name, refresh in (("resend only", False), ("edit in place", True)):
+            cleanup_tickets()
+            use_fake_api(fake)
+            fake.reset()
+            # notify_da() and the rest refresh through this too
+            notifier.refresh_cards = refresh_cards if refresh else (lambda conn, ticket, skip_bots=(): 0)
+            workers = dispatcher.Dispatcher(workers=2, poll_interval=0.2).start()
+            start = time.monotonic()
+            try:
+                for index in range(args.tickets):
+                    lifecycle(f"{name[0]}{index}")
+                wall = time.monotonic() - start
+            finally:
+                workers.stop()
+            methods = [method for _, method, _, _ in fake.sent]
+            sends = sum(method.startswith("send") for method in methods)
+            edits = sum(method.startswith("edit") for method in methods)
+            print(f"{name:<14} {sends:>6} {edits:>6} {sends / args.tickets:>15.1f} {stale_keyboards():>15} "
+                  f"{wall:>7.2f}")
+    finally:
+        notifier.refresh_cards = refresh_cards
+        cleanup()
+        notifier.run(fake.stop())
+
+
+if __name__ == "__main__":
+    main()
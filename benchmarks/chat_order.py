@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# benchmarks/chat_order.py
+"""
+The DA bot handling one update at a time, any BOT_CONCURRENT_UPDATES at once
+(PTB's concurrent_updates(n)), and BOT_CONCURRENT_UPDATES at once with each
+chat's in order (update_processor.ChatOrderedUpdateProcessor), against the
+local fake Bot API (benchmarks/fake_bot_api.py), which also stands in for the
+locus API.
+
+`--das` DAs report an issue at the same time, as in benchmarks/updates.py, but
+send each step `--gap` seconds after the last without waiting for it to be
+handled, like a DA tapping through the menus: the photo (a blocking Cloudinary
+upload of `--upload-latency` seconds) is often still uploading when "no edits"
+arrives. Reports the wall time, the time from an update arriving to its
+handler finishing, the updates that started while an earlier one of the same
+chat was still being handled, the tickets created (one per DA when each chat's
+updates are handled in order), handler errors, and the processor's queue depth.
+
+Uses benchmark subscriptions, BENCH-UPDATES tickets and their outbox rows, all
+deleted afterwards. Point DB_NAME at a scratch database.
+
+    python -m benchmarks.chat_order
+    python -m benchmarks.chat_order --das 100 --gap 0.05
+"""
+
+import argparse
+import asyncio
+import itertools
+import time
+import warnings
+
+import cloudinary.uploader
+from sqlalchemy import text
+from telegram import Update
+from telegram.ext import Application, TypeHandler
+from telegram.warnings import PTBUserWarning
+
+import config
+import da_bot
+import db
+from benchmarks.fake_bot_api import FakeBotAPI
+from benchmarks.outbox import percentile
+from benchmarks.updates import BASE_USER_ID, ORDER_PREFIX, TOKEN, cleanup, fake_upload, make_update, seed_das, steps
+from update_processor import ChatOrderedUpdateProcessor, chat_key
+
+
+async def run(fake, args, name, concurrent_updates):
+    cleanup()
+    seed_das(args.das)
+    builder = (Application.builder().token(TOKEN).base_url(f"{fake.url}/bot")
+               .base_file_url(f"{fake.url}/file/bot").updater(None).concurrent_updates(concurrent_updates))
+    application = da_bot.build_application(builder)
+    arrived, latencies, errors = {}, [], []
+    running = {}  # chat -> updates being handled
+    overlapping = [0]
+    pending = set()
+
+    async def begin(update, context):
+        chat = chat_key(update)
+        if running.get(chat):
+            overlapping[0] += 1
+        running[chat] = running.get(chat, 0) + 1
+
+    async def done(update, context):
+        running[chat_key(update)] -= 1
+        latencies.append(time.monotonic() - arrived[update.update_id])
+        pending.discard(update.update_id)
+
+    async def error(update, context):
+        errors.append(context.error)
+
+    # Around the bot's own handlers, the earliest of which are in group -1
+    application.add_handler(TypeHandler(Update, begin), group=-2)
+    application.add_handler(TypeHandler(Update, done), group=1)
+    application.add_error_handler(error)
+    update_ids = itertools.count(1)
+
+    async def da(user_id):
+        for kind, value in steps(user_id):
+            update_id = next(update_ids)
+            arrived[update_id] = time.monotonic()
+            pending.add(update_id)
+            await application.update_queue.put(
+                Update.de_json(make_update(update_id, user_id, kind, value), application.bot))
+            await asyncio.sleep(args.gap)
+
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+    try:
+        start = time.monotonic()
+        await asyncio.gather(*(da(user_id) for user_id in range(BASE_USER_ID, BASE_USER_ID + args.das)))
+        deadline = time.monotonic() + 120
+        while pending and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        wall = time.monotonic() - start
+    finally:
+        await application.stop()
+        await application.shutdown()
+        await application.post_shutdown(application)
+    with db.get_connection() as conn:
+        tickets = conn.execute(text("SELECT count(*) FROM tickets WHERE order_id LIKE :prefix"),
+                               {"prefix": ORDER_PREFIX + "%"}).scalar()
+    processor = application.update_processor
+    peak = processor.stats()["peak_waiting"] if isinstance(processor, ChatOrderedUpdateProcessor) else "-"
+    print(f"{name:<14} {len(latencies):>7} {wall:>7.1f} {percentile(latencies, 0.5) * 1000:>7.0f} "
+          f"{percentile(latencies, 0.99) * 1000:>7.0f} {overlapping[0]:>11} {tickets:>7} {len(errors):>6} "
+          f"{peak:>12}")
+
+
+async def main_async(args):
+    # No rate limits here: the bot's replies to each DA are not what's measured
+    fake = await FakeBotAPI(latency=args.latency, global_rate=100000, per_chat_rate=100000,
+                            locus_latency=args.locus_latency).start()
+    config.LOCUS_API_URL = f"{fake.url}/locus_info"
+    try:
+        print(f"{args.das} DAs x {len(steps(0))} updates {args.gap * 1000:.0f} ms apart; fake Bot API "
+              f"{args.latency * 1000:.0f} ms per request, locus API {args.locus_latency * 1000:.0f} ms, "
+              f"upload {args.upload_latency * 1000:.0f} ms\n")
+        print(f"{'variant':<14} {'updates':>7} {'wall s':>7} {'p50 ms':>7} {'p99 ms':>7} {'overlapping':>11} "
+              f"{'tickets':>7} {'errors':>6} {'peak waiting':>12}")
+        await run(fake, args, "one at once", False)
+        await run(fake, args, f"any {args.concurrent}", args.concurrent)
+        await run(fake, args, f"{args.concurrent}, per chat", ChatOrderedUpdateProcessor(args.concurrent,
+                                                                                         name="benchmark"))
+    finally:
+        await fake.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--das", type=int, default=40)
+    parser.add_argument("--gap", type=float, default=0.1, help="seconds between a DA's updates")
+    parser.add_argument("--concurrent", type=int, default=config.BOT_CONCURRENT_UPDATES,
+                        help="updates handled at once")
+    parser.add_argument("--latency", type=float, default=0.05, help="fake API seconds per request")
+    parser.add_argument("--locus-latency", type=float, default=0.3, help="locus API seconds per call")
+    parser.add_argument("--upload-latency", type=float, default=0.5, help="Cloudinary seconds per upload")
+    args = parser.parse_args()
+
+    warnings.filterwarnings("ignore", category=PTBUserWarning)
+    db.init_db()
+    cloudinary.uploader.upload = fake_upload(args.upload_latency)
+    try:
+        asyncio.run(main_async(args))
+    finally:
+        cleanup()
+
+
+if __name__ == "__main__":
+    main()
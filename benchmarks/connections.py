@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# benchmarks/connections.py
+"""
+Connection reuse of the Bot API clients, against the local fake Bot API
+(benchmarks/fake_bot_api.py).
+
+Sends `--sends` notifications `--gap` seconds apart, as a quiet bot does, and
+reports how many HTTP connections each client setup had to open
+(notifier.ConnectionCounter):
+
+  Bot per send       a new Bot for every notification, as the handlers used to do
+  shared, 5 s idle   one shared Bot with httpx's default keep-alive expiry
+  shared, tuned      notifier.make_bot() defaults (TELEGRAM_KEEPALIVE_EXPIRY)
+
+Against the real API every new connection also pays a TLS handshake.
+
+    python -m benchmarks.connections
+    python -m benchmarks.connections --sends 10 --gap 8
+"""
+
+import argparse
+import asyncio
+import time
+
+import notifier
+from benchmarks.fake_bot_api import FakeBotAPI
+
+TOKEN = "123456:benchmark"
+
+
+async def bot_per_send(base_url, counter, args):
+    latencies = []
+    for _ in range(args.sends):
+        bot = notifier.make_bot(TOKEN, counter, base_url=base_url)
+        start = time.perf_counter()
+        await bot.send_message(chat_id=1, text="benchmark")
+        latencies.append(time.perf_counter() - start)
+        await bot.shutdown()
+        await asyncio.sleep(args.gap)
+    return latencies
+
+
+async def shared(base_url, counter, args, **pool):
+    bot = notifier.make_bot(TOKEN, counter, base_url=base_url, **pool)
+    latencies = []
+    try:
+        for _ in range(args.sends):
+            start = time.perf_counter()
+            await bot.send_message(chat_id=1, text="benchmark")
+            latencies.append(time.perf_counter() - start)
+            await asyncio.sleep(args.gap)
+    finally:
+        await bot.shutdown()
+    return latencies
+
+
+async def main_async(args):
+    fake = await FakeBotAPI(latency=args.latency).start()
+    base_url = f"{fake.url}/bot"
+    variants = (
+        ("Bot per send", lambda counter: bot_per_send(base_url, counter, args)),
+        ("shared, 5 s idle", lambda counter: shared(base_url, counter, args, keepalive_expiry=5.0)),
+        ("shared, tuned", lambda counter: shared(base_url, counter, args)),
+    )
+    print(f"{args.sends} sends, {args.gap}s apart; fake Bot API {args.latency * 1000:.0f} ms per request\n")
+    print(f"{'variant':<17} {'requests':>8} {'opened':>6} {'reused':>6} {'mean ms':>8}")
+    try:
+        for name, variant in variants:
+            counter = notifier.ConnectionCounter()
+            latencies = await variant(counter)
+            stats = counter.stats()
+            print(f"{name:<17} {stats['requests']:>8} {stats['connections']:>6} {stats['reused']:>6} "
+                  f"{sum(latencies) / len(latencies) * 1000:>8.1f}")
+    finally:
+        await fake.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sends", type=int, default=5)
+    parser.add_argument("--gap", type=float, default=6.0, help="seconds between sends")
+    parser.add_argument("--latency", type=float, default=0.01, help="fake API seconds per request")
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# benchmarks/dedup.py
+"""
+Duplicate notifications from double-tapped buttons, with outbox dedup keys
+(notifier.event_key, notifier.double_tap_keys); nothing is sent.
+
+  repeat      the same confirm_sendclient notification queued `--presses` times
+              per ticket, as repeated taps do
+  concurrent  two threads queueing it at the same moment, and two threads
+              applying the same transition with the same message
+              (supervisor_solution, which notifies the DA)
+
+Reports the rows queued, the duplicates suppressed (notifier.suppressed_duplicates)
+and the cost of a suppressed press.
+
+Uses benchmark subscriptions, BENCH-DEDUP tickets and their outbox rows, all
+deleted afterwards. Point DB_NAME at a scratch database.
+
+    python -m benchmarks.dedup
+    python -m benchmarks.dedup --tickets 50 --presses 5
+"""
+
+import argparse
+import threading
+import time
+
+from sqlalchemy import text
+
+import config
+import db
+import notifier
+
+BASE_USER_ID = 9500000
+DA_USER_ID = BASE_USER_ID - 1
+CLIENT = "bench-dedup-client"
+ORDER_PREFIX = "BENCH-DEDUP-"
+WHERE = f"ticket_id IN (SELECT ticket_id FROM tickets WHERE order_id LIKE '{ORDER_PREFIX}%')"
+
+
+def cleanup():
+    with db.get_connection() as conn:
+        conn.execute(text(f"DELETE FROM outbox WHERE {WHERE}"))
+        conn.execute(text("DELETE FROM tickets WHERE order_id LIKE :prefix"), {"prefix": ORDER_PREFIX + "%"})
+        conn.execute(text("DELETE FROM subscriptions WHERE user_id BETWEEN :low AND :high"),
+                     {"low": DA_USER_ID, "high": BASE_USER_ID + 99999})
+        conn.execute(text("DELETE FROM clients WHERE name = :client"), {"client": CLIENT})
+        conn.commit()
+    db.clear_caches()
+
+
+def send_to_client(ticket):
+    """The queue() call of supervisor_bot.send_to_client()."""
+    message = f"<b>تذكرة من المشرف</b>\nتذكرة #{ticket['ticket_id']}\nالوصف: {ticket['issue_description']}"
+    dedup_key, skip_keys = notifier.double_tap_keys("send_to_client", ticket['ticket_id'], message)
+    return notifier.queue(None, "Client", [c['chat_id'] for c in db.get_clients_by_name(CLIENT)], message,
+                          kind="send_to_client", ticket_id=ticket['ticket_id'], mode="edit",
+                          dedup_key=dedup_key, skip_keys=skip_keys)
+
+
+def outbox_rows(kind):
+    with db.get_connection() as conn:
+        return conn.execute(text(f"SELECT count(*) FROM outbox WHERE kind = :kind AND {WHERE}"),
+                            {"kind": kind}).scalar()
+
+
+def together(*calls):
+    barrier = threading.Barrier(len(calls))
+
+    def run(call):
+        barrier.wait()
+        call()
+
+    threads = [threading.Thread(target=run, args=(call,)) for call in calls]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tickets", type=int, default=20)
+    parser.add_argument("--presses", type=int, default=3)
+    parser.add_argument("--clients", type=int, default=3, help="client chats per ticket")
+    args = parser.parse_args()
+
+    db.init_db()
+    config.SUPERVISOR_ASSIGNMENT = False
+    cleanup()
+    try:
+        db.add_subscription(DA_USER_ID, "0", "DA", "DA", None, "bench", None, None, DA_USER_ID)
+        for user_id in range(BASE_USER_ID, BASE_USER_ID + args.clients):
+            db.add_subscription(user_id, "0", "Client", "Client", CLIENT, "bench", None, None, user_id)
+        tickets = [db.get_ticket(db.add_ticket(f"{ORDER_PREFIX}{index}", "benchmark", "المخزن", "تالف", CLIENT,
+                                               None, "Opened", DA_USER_ID))
+                   for index in range(args.tickets)]
+
+        print(f"{args.tickets} tickets, {args.clients} client chats each\n")
+        print(f"{'case':<24} {'presses':>7} {'queued':>6} {'suppressed':>10} {'first ms':>8} {'dup ms':>7}")
+        notifier.suppressed_duplicates.clear()
+        first, duplicate = [], []
+        for ticket in tickets:
+            for press in range(args.presses):
+                start = time.perf_counter()
+                send_to_client(ticket)
+                (duplicate if press else first).append((time.perf_counter() - start) * 1000)
+        print(f"{'repeat confirm_sendclient':<24} {args.tickets * args.presses:>7} {outbox_rows('send_to_client'):>6} "
+              f"{notifier.suppressed_duplicates['send_to_client']:>10} {sum(first) / len(first):>8.2f} "
+              f"{sum(duplicate) / max(len(duplicate), 1):>7.2f}")
+
+        with db.get_connection() as conn:
+            conn.execute(text(f"DELETE FROM outbox WHERE {WHERE}"))
+            conn.commit()
+        notifier.suppressed_duplicates.clear()
+        for ticket in tickets:
+            together(lambda: send_to_client(ticket), lambda: send_to_client(ticket))
+        print(f"{'concurrent confirm':<24} {args.tickets * 2:>7} {outbox_rows('send_to_client'):>6} "
+              f"{notifier.suppressed_duplicates['send_to_client']:>10}")
+
+        applied = []
+        for ticket in tickets:
+            tap = lambda: applied.append(db.apply_transition(
+                ticket['ticket_id'], "supervisor_solution", "الحل", actor=BASE_USER_ID,
+                notify=lambda conn, t: notifier.notify_da(t, conn=conn))[1])
+            # supervisor_solution is allowed from any open status: only the repeated-event
+            # guard of db.apply_transition() stops the second tap
+            together(tap, tap)
+        print(f"{'concurrent transition':<24} {args.tickets * 2:>7} {outbox_rows('notify_da'):>6} "
+              f"{notifier.suppressed_duplicates['notify_da']:>10}   ({sum(applied)} applied)")
+    finally:
+        cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# benchmarks/digest.py
+"""
+Supervisor notifications under a burst of new tickets, one message per ticket
+against digest mode (SUPERVISOR_DIGEST_WINDOW), against the local fake Bot API
+(benchmarks/fake_bot_api.py) with Telegram's rate limits.
+
+Creates `--tickets` tickets over `--burst` seconds, each notifying every
+supervisor as finalize_ticket_da does, with a dispatcher sending the outbox,
+and reports the Bot API calls made, 429s, and how long the supervisors waited
+for each ticket (from its commit to the message naming it). One ticket in
+`--urgent-every` has an URGENT_ISSUE_TYPES issue type and bypasses the digest.
+
+Uses benchmark subscriptions, BENCH-DIGEST tickets and their outbox rows, all
+deleted afterwards. Point DB_NAME at a scratch database.
+
+    python -m benchmarks.digest
+    python -m benchmarks.digest --tickets 60 --burst 20 --window 15
+"""
+
+import argparse
+import re
+import time
+
+from sqlalchemy import text
+
+import config
+import db
+import dispatcher
+import notifier
+from benchmarks.fake_bot_api import FakeBotAPI
+from benchmarks.outbox import percentile, use_fake_api, wait_for_outbox
+
+BASE_USER_ID = 9300000
+ORDER_PREFIX = "BENCH-DIGEST-"
+URGENT_TYPE = "عطل بالسياره"
+WHERE = f"ticket_id IN (SELECT ticket_id FROM tickets WHERE order_id LIKE '{ORDER_PREFIX}%')"
+
+
+def cleanup(subscriptions=True):
+    with db.get_connection() as conn:
+        conn.execute(text(f"DELETE FROM outbox WHERE {WHERE}"))
+        conn.execute(text("DELETE FROM tickets WHERE order_id LIKE :prefix"), {"prefix": ORDER_PREFIX + "%"})
+        if subscriptions:
+            conn.execute(text("DELETE FROM subscriptions WHERE user_id BETWEEN :low AND :high"),
+                         {"low": BASE_USER_ID, "high": BASE_USER_ID + 99999})
+        conn.commit()
+    db.clear_caches()
+
+
+def burst(args, window):
+    config.SUPERVISOR_DIGEST_WINDOW = window
+    committed = {}
+    start = time.monotonic()
+    for index in range(args.tickets):
+        time.sleep(args.burst / args.tickets)
+        issue_type = URGENT_TYPE if index % args.urgent_every == 0 else "تالف"
+        ticket_id = db.add_ticket(f"{ORDER_PREFIX}{window}-{index}", "benchmark", "التسليم", issue_type, "bench",
+                                  None, "Opened", BASE_USER_ID,
+                                  notify=lambda conn, ticket: notifier.notify_supervisors(ticket, conn=conn))
+        committed[ticket_id] = time.monotonic()
+    wait_for_outbox(WHERE, timeout=600)
+    return committed, time.monotonic() - start
+
+
+def waits(fake, committed):
+    """Per (chat, ticket): seconds from the ticket's commit to the first message naming it."""
+    seen = {}
+    for _, _, params, accepted in fake.sent:
+        body = params.get("text") or params.get("caption") or ""
+        for ticket_id in map(int, re.findall(r"#(\d+)", body)):
+            if ticket_id in committed:
+                seen.setdefault((params.get("chat_id"), ticket_id), accepted - committed[ticket_id])
+    return list(seen.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--supervisors", type=int, default=10)
+    parser.add_argument("--tickets", type=int, default=30)
+    parser.add_argument("--burst", type=float, default=10.0, help="seconds over which the tickets arrive")
+    parser.add_argument("--window", type=float, default=10.0, help="SUPERVISOR_DIGEST_WINDOW for the digest run")
+    parser.add_argument("--urgent-every", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.05, help="fake API seconds per request")
+    args = parser.parse_args()
+
+    db.init_db()
+    # Every supervisor gets every ticket, as before assignment (benchmarks.assignment)
+    config.SUPERVISOR_ASSIGNMENT = False
+    config.URGENT_ISSUE_TYPES = [URGENT_TYPE]
+    fake = notifier.run(FakeBotAPI(latency=args.latency).start())
+    cleanup()
+    try:
+        for user_id in range(BASE_USER_ID, BASE_USER_ID + args.supervisors):
+            db.add_subscription(user_id, "0", "Supervisor", "Supervisor", None, "bench", None, None, user_id)
+        supervisors = len(db.get_supervisors())
+        print(f"{args.tickets} tickets over {args.burst:.0f}s, {supervisors} supervisors, "
+              f"1 in {args.urgent_every} urgent; fake Bot API {fake.global_rate} msg/s per bot, "
+              f"{fake.per_chat_rate} msg/s per chat\n")
+        print(f"{'variant':<14} {'API calls':>9} {'429s':>5} {'wall s':>7} {'wait p50 s':>10} {'p99 s':>7}")
+        for name, window in (("per ticket", 0), (f"digest {args.window:.0f}s", args.window)):
+            cleanup(subscriptions=False)
+            time.sleep(1.1)  # let the fake's one-second windows drain
+            use_fake_api(fake)
+            fake.reset()
+            workers = dispatcher.Dispatcher(workers=2).start()
+            try:
+                committed, wall = burst(args, window)
+            finally:
+                workers.stop()
+            waited = waits(fake, committed)
+            print(f"{name:<14} {len(fake.sent):>9} {fake.rate_limited:>5} {wall:>7.1f} "
+                  f"{percentile(waited, 0.5):>10.1f} {percentile(waited, 0.99):>7.1f}")
+    finally:
+        cleanup()
+        notifier.run(fake.stop())
+
+
+if __name__ == "__main__":
+    main()
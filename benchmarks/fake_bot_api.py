@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+# benchmarks/fake_bot_api.py
+"""
+A local stand-in for the Telegram Bot API, for benchmarks.
+
+Answers every method with a fake Message after a fixed latency and enforces
+Telegram's flood limits per bot token: `global_rate` messages per second
+overall and `per_chat_rate` per chat. Over-limit requests get a 429 with
+``retry_after``, exactly like the real API.
+
+sendPhoto with an image URL "downloads" it (`photo_fetch_latency` seconds, counted
+in `fetched`) and answers with a file_id that later sendPhoto calls by the same
+token may use instead; unknown file_ids get a 400, as from Telegram. Edits
+answer with the message they name. Chats in `blocked_chats` get a 403, as from
+a user who blocked the bot. getFile answers with a file that downloads from
+/file/bot<token>/<path>. getUpdates long-polls for the updates given to
+add_update(), or, once setWebhook gave a URL for the token, they are POSTed
+there after half of `latency` with the secret token header, over up to
+max_connections connections at once, as Telegram does; getUpdates then gets a 409.
+
+It also stands in for the locus API: /locus_info answers after `locus_latency`
+seconds with one order for the DA.
+
+Point a Bot at it with base_url=f"{server.url}/bot", or run it standalone:
+
+    python -m benchmarks.fake_bot_api --port 8081
+    TELEGRAM_BASE_URL=http://127.0.0.1:8081/bot python main.py
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from collections import defaultdict
+from urllib.parse import parse_qs
+
+import httpx
+
+
+class FakeBotAPI:
+    def __init__(self, latency=0.05, global_rate=30, per_chat_rate=1, host="127.0.0.1", port=0,
+                 photo_fetch_latency=0.0, locus_latency=0.0):
+        self.latency = latency
+        self.photo_fetch_latency = photo_fetch_latency
+        self.locus_latency = locus_latency
+        self.global_rate = global_rate
+        self.per_chat_rate = per_chat_rate
+        self.host = host
+        self.port = port
+        self.requests = 0
+        self.rate_limited = 0
+        self.fetched = 0  # photo URLs downloaded
+        self.polls = 0  # getUpdates requests
+        self.blocked_chats = set()  # chat ids (str) that answer 403
+        self.sent = []  # (token, method, params, monotonic time) of every accepted request
+        self._windows = defaultdict(list)  # (token, chat_id or None) -> accepted timestamps in the last second
+        self._message_id = 0
+        self._file_ids = set()  # (token, file_id) issued for downloaded photos
+        self._updates = defaultdict(list)  # token -> updates getUpdates has not been told were handled
+        self._update_added = {}  # token -> asyncio.Event set when an update is added
+        self._webhooks = {}  # token -> (url, secret token, asyncio.Semaphore of max_connections)
+        self._webhook_client = None
+        self._deliveries = set()  # tasks POSTing an update to a webhook
+        self._loop = None
+        self._server = None
+        self._connections = {}  # handler task -> its StreamWriter
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        for task in self._deliveries:
+            task.cancel()
+        await asyncio.gather(*self._deliveries, return_exceptions=True)
+        if self._webhook_client:
+            await self._webhook_client.aclose()
+        self._server.close()
+        for writer in self._connections.values():
+            writer.close()
+        await asyncio.gather(*self._connections, return_exceptions=True)
+        await self._server.wait_closed()
+
+    def reset(self):
+        self.requests = self.rate_limited = self.fetched = self.polls = 0
+        self.sent.clear()
+        self._windows.clear()
+
+    def add_update(self, token, update):
+        """Queue an update (a dict) for the bot with token's getUpdates; callable from any thread."""
+        self._loop.call_soon_threadsafe(self._add_update, token, update)
+
+    def _add_update(self, token, update):
+        if token in self._webhooks:
+            task = asyncio.ensure_future(self._deliver(token, update))
+            self._deliveries.add(task)
+            task.add_done_callback(self._deliveries.discard)
+            return
+        self._updates[token].append(update)
+        self._update_event(token).set()
+
+    async def _deliver(self, token, update):
+        url, secret, connections = self._webhooks[token]
+        if self._webhook_client is None:
+            self._webhook_client = httpx.AsyncClient(limits=httpx.Limits(max_connections=None))
+        headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+        async with connections:
+            # The way there: half a round trip
+            await asyncio.sleep(self.latency / 2)
+            # Telegram retries until the webhook answers 2xx
+            for _ in range(10):
+                try:
+                    response = await self._webhook_client.post(url, json=update, headers=headers)
+                    if response.status_code < 300:
+                        return
+                except httpx.HTTPError:
+                    pass
+                await asyncio.sleep(0.5)
+
+    def _set_webhook(self, token, params):
+        url = params.get("url")
+        if not url:
+            self._webhooks.pop(token, None)
+            return
+        self._webhooks[token] = (url, params.get("secret_token"),
+                                 asyncio.Semaphore(int(params.get("max_connections") or 40)))
+        # Updates waiting for getUpdates go to the webhook instead
+        for update in self._updates.pop(token, []):
+            self._add_update(token, update)
+
+    def _update_event(self, token):
+        return self._update_added.setdefault(token, asyncio.Event())
+
+    async def _get_updates(self, token, params):
+        # Updates below offset were handled: drop them, as Telegram does
+        offset = int(params.get("offset") or 0)
+        self._updates[token] = [u for u in self._updates[token] if u["update_id"] >= offset]
+        if not self._updates[token]:
+            event = self._update_event(token)
+            event.clear()
+            try:
+                await asyncio.wait_for(event.wait(), float(params.get("timeout") or 0))
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[token][:int(params.get("limit") or 100)]
+
+    # -- HTTP -----------------------------------------------------------------
+    async def _handle(self, reader, writer):
+        self._connections[asyncio.current_task()] = writer
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                request_line, *header_lines = head.decode("latin-1").split("\r\n")
+                headers = {}
+                for line in header_lines:
+                    if ":" in line:
+                        name, value = line.split(":", 1)
+                        headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                path = request_line.split(" ")[1]
+                status, payload = await self._dispatch(path, headers.get("content-type", ""), body)
+                data = json.dumps(payload).encode()
+                writer.write(
+                    f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                    f"Content-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n".encode() + data
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._connections.pop(asyncio.current_task(), None)
+            writer.close()
+
+    @staticmethod
+    def _params(content_type, body):
+        if not body:
+            return {}
+        if content_type.startswith("application/json"):
+            return json.loads(body)
+        if content_type.startswith("multipart/form-data"):
+            return {}  # uploads: the parameters are not needed here
+        return {key: values[-1] for key, values in parse_qs(body.decode()).items()}
+
+    async def _dispatch(self, path, content_type, body):
+        if path.startswith("/locus_info"):
+            await asyncio.sleep(self.locus_latency)
+            phone = parse_qs(path.partition("?")[2]).get("agent_phone", [""])[0]
+            return 200, {"data": [{"order_id": f"BENCH-{phone}", "client_name": "bench"}]}
+        if path.startswith("/file/"):
+            await asyncio.sleep(self.latency)
+            return 200, "fake file contents"
+        # /bot<token>/<method>
+        _, token_part, method = path.split("/", 2)
+        token = token_part[3:]
+        params = self._params(content_type, body)
+        self.requests += 1
+        if method == "getUpdates":
+            self.polls += 1
+            if token in self._webhooks:
+                return 409, {"ok": False, "error_code": 409,
+                             "description": "Conflict: can't use getUpdates method while webhook is active"}
+            # Half the round trip each way, so an update that arrives during a long poll takes half
+            await asyncio.sleep(self.latency / 2)
+            updates = await self._get_updates(token, params)
+            await asyncio.sleep(self.latency / 2)
+            return 200, {"ok": True, "result": updates}
+        await asyncio.sleep(self.latency)
+
+        if method == "getMe":
+            return 200, {"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "fake", "username": "fake_bot"}}
+        if method in ("setWebhook", "deleteWebhook"):
+            self._set_webhook(token, params if method == "setWebhook" else {})
+            return 200, {"ok": True, "result": True}
+        if method == "getWebhookInfo":
+            url = self._webhooks[token][0] if token in self._webhooks else ""
+            return 200, {"ok": True, "result": {"url": url, "has_custom_certificate": False,
+                                                "pending_update_count": len(self._updates[token])}}
+        if method == "getFile":
+            file_id = params.get("file_id", "")
+            return 200, {"ok": True, "result": {"file_id": file_id, "file_unique_id": file_id, "file_size": 18,
+                                                "file_path": f"photos/{file_id}.jpg"}}
+
+        chat_id = params.get("chat_id")
+        retry_after = self._admit(token, chat_id)
+        if retry_after:
+            self.rate_limited += 1
+            return 429, {"ok": False, "error_code": 429,
+                         "description": f"Too Many Requests: retry after {retry_after}",
+                         "parameters": {"retry_after": retry_after}}
+        if chat_id is not None and str(chat_id) in self.blocked_chats:
+            return 403, {"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"}
+        photo = params.get("photo") if method == "sendPhoto" else None
+        if photo:
+            if photo.startswith(("http://", "https://")):
+                await asyncio.sleep(self.photo_fetch_latency)
+                self.fetched += 1
+                photo = f"fake-file-{len(self._file_ids) + 1}"
+                self._file_ids.add((token, photo))
+            elif (token, photo) not in self._file_ids:
+                return 400, {"ok": False, "error_code": 400,
+                             "description": "Bad Request: wrong file identifier/HTTP URL specified"}
+        self.sent.append((token, method, params, time.monotonic()))
+        if method.startswith("edit") and params.get("message_id"):
+            message_id = int(params["message_id"])
+        else:
+            self._message_id += 1
+            message_id = self._message_id
+        message = {"message_id": message_id, "date": int(time.time()),
+                   "chat": {"id": int(chat_id) if chat_id else 0, "type": "private"}}
+        if params.get("text"):
+            message["text"] = params["text"]
+        if photo:
+            message["photo"] = [{"file_id": photo, "file_unique_id": photo, "width": 800, "height": 600}]
+            if params.get("caption"):
+                message["caption"] = params["caption"]
+        return 200, {"ok": True, "result": message}
+
+    def _admit(self, token, chat_id):
+        """Record the request and return 0, or the seconds to wait if it exceeds a limit."""
+        now = time.monotonic()
+        keys = [((token, None), self.global_rate)]
+        if chat_id is not None:
+            keys.append(((token, str(chat_id)), self.per_chat_rate))
+        for key, limit in keys:
+            window = self._windows[key]
+            while window and window[0] <= now - 1:
+                window.pop(0)
+            if len(window) >= limit:
+                return 1
+        for key, _ in keys:
+            self._windows[key].append(now)
+        return 0
+
+
+async def _serve(args):
+    server = await FakeBotAPI(args.latency, args.global_rate, args.per_chat_rate, port=args.port,
+                              photo_fetch_latency=args.photo_fetch_latency).start()
+    print(f"Fake Bot API on {server.url}/bot<token>/")
+    await asyncio.Event().wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per request")
+    parser.add_argument("--global-rate", type=int, default=30)
+    parser.add_argument("--per-chat-rate", type=int, default=1)
+    parser.add_argument("--photo-fetch-latency", type=float, default=0.0, help="seconds to download a photo URL")
+    asyncio.run(_serve(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# benchmarks/fanout.py
+"""
+Notification fan-out against the local fake Bot API (benchmarks/fake_bot_api.py).
+
+Sends one message to N distinct chats three ways and reports wall time,
+throughput, per-recipient latency (time from the start of the fan-out until
+that recipient's message was accepted) and how many requests were refused
+with 429:
+
+  sequential   one send after another, as the handlers used to do
+  gather       all sends at once with no rate limiting
+  FanOut       notifier.FanOut: concurrent within the global and per-chat limits
+
+    python -m benchmarks.fanout
+    python -m benchmarks.fanout --recipients 10 100 300 --latency 0.1
+"""
+
+import argparse
+import asyncio
+import time
+
+from telegram import Bot
+from telegram.error import TelegramError
+from telegram.request import HTTPXRequest
+
+import notifier
+from benchmarks.fake_bot_api import FakeBotAPI
+
+TOKEN = "123456:benchmark"
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else float("nan")
+
+
+async def _timed_send(bot, chat_id, start):
+    try:
+        await bot.send_message(chat_id=chat_id, text="benchmark")
+        return True, time.perf_counter() - start
+    except TelegramError:
+        return False, time.perf_counter() - start
+
+
+async def sequential(bot, chat_ids):
+    start = time.perf_counter()
+    return [await _timed_send(bot, chat_id, start) for chat_id in chat_ids]
+
+
+async def unthrottled(bot, chat_ids):
+    start = time.perf_counter()
+    return await asyncio.gather(*(_timed_send(bot, chat_id, start) for chat_id in chat_ids))
+
+
+async def fan_out(bot, chat_ids):
+    sender = notifier.FanOut(bot)
+    start = time.perf_counter()
+
+    async def timed(chat_id):
+        delivery = await sender.send(chat_id, "benchmark")
+        return delivery.ok, time.perf_counter() - start
+    return await asyncio.gather(*(timed(chat_id) for chat_id in chat_ids))
+
+
+async def main_async(args):
+    fake = await FakeBotAPI(latency=args.latency).start()
+    bot = Bot(token=TOKEN, base_url=f"{fake.url}/bot",
+              request=HTTPXRequest(connection_pool_size=notifier.MAX_CONCURRENT_SENDS, pool_timeout=30))
+    print(f"fake Bot API: {args.latency * 1000:.0f} ms per request, "
+          f"{fake.global_rate} msg/s per bot, {fake.per_chat_rate} msg/s per chat\n")
+    print(f"{'recipients':>10} {'variant':<11} {'wall s':>7} {'msg/s':>7} {'p50 ms':>8} {'p99 ms':>8} "
+          f"{'429s':>5} {'failed':>6}")
+    try:
+        for count in args.recipients:
+            chat_ids = list(range(1000, 1000 + count))
+            for name, variant in (("sequential", sequential), ("gather", unthrottled), ("FanOut", fan_out)):
+                await asyncio.sleep(1.1)  # let the fake's one-second windows drain
+                fake.reset()
+                start = time.perf_counter()
+                results = await variant(bot, chat_ids)
+                wall = time.perf_counter() - start
+                latencies = [latency * 1000 for ok, latency in results if ok]
+                failed = sum(1 for ok, _ in results if not ok)
+                print(f"{count:>10} {name:<11} {wall:>7.2f} {len(latencies) / wall:>7.1f} "
+                      f"{percentile(latencies, 0.5):>8.0f} {percentile(latencies, 0.99):>8.0f} "
+                      f"{fake.rate_limited:>5} {failed:>6}")
+            print()
+    finally:
+        await bot.shutdown()
+        await fake.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--recipients", type=int, nargs="+", default=[10, 100, 300])
+    parser.add_argument("--latency", type=float, default=0.05, help="fake API seconds per request")
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
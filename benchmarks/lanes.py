@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# benchmarks/lanes.py
+"""
+New-ticket alerts during a bulk fan-out, with every notification in one queue
+against the dispatcher's priority lanes (notifier.LANES), against the local fake
+Bot API (benchmarks/fake_bot_api.py) with Telegram's rate limits.
+
+Queues a bulk backlog of `--bulk` client-bot messages (a send_to_client to a
+client with that many contacts) and `--bulk` / 2 supervisor-bot messages, then
+creates `--tickets` tickets `--interval` seconds apart while it drains, each
+alerting its supervisor as finalize_ticket_da does. Reports how long the alerts
+took from their ticket's commit to the fake API accepting them, how long the
+bulk backlog took, and the 429s.
+
+  one queue   every notification in the normal lane, sent in the order queued, as
+              before lanes
+  lanes       alerts in the urgent lane, the backlog in the bulk lane
+
+Each lane gets `--workers` dispatcher workers.
+
+Uses benchmark subscriptions, BENCH-LANES tickets and their outbox rows, all
+deleted afterwards. Point DB_NAME at a scratch database.
+
+    python -m benchmarks.lanes
+    python -m benchmarks.lanes --bulk 1200 --tickets 20
+"""
+
+import argparse
+import re
+import time
+
+from sqlalchemy import text
+
+import config
+import db
+import dispatcher
+import notifier
+from benchmarks.fake_bot_api import FakeBotAPI
+from benchmarks.outbox import percentile, use_fake_api, wait_for_outbox
+
+BASE_USER_ID = 9400000
+BULK_CHAT_ID = 9500000
+ORDER_PREFIX = "BENCH-LANES-"
+BULK_KIND = "benchmark_bulk"
+ALERTS = f"ticket_id IN (SELECT ticket_id FROM tickets WHERE order_id LIKE '{ORDER_PREFIX}%')"
+
+
+def cleanup(subscriptions=True):
+    with db.get_connection() as conn:
+        conn.execute(text(f"DELETE FROM outbox WHERE kind = :kind OR {ALERTS}"), {"kind": BULK_KIND})
+        conn.execute(text("DELETE FROM tickets WHERE order_id LIKE :prefix"), {"prefix": ORDER_PREFIX + "%"})
+        if subscriptions:
+            conn.execute(text("DELETE FROM subscriptions WHERE user_id BETWEEN :low AND :high"),
+                         {"low": BASE_USER_ID, "high": BASE_USER_ID + 99999})
+        conn.commit()
+    db.clear_caches()
+
+
+def queue_bulk(args, lane):
+    with db.get_connection() as conn:
+        notifier.queue(conn, "Client", range(BULK_CHAT_ID, BULK_CHAT_ID + args.bulk), "benchmark",
+                       kind=BULK_KIND, lane=lane)
+        notifier.queue(conn, "Supervisor", range(BULK_CHAT_ID, BULK_CHAT_ID + args.bulk // 2), "benchmark",
+                       kind=BULK_KIND, lane=lane)
+        conn.commit()
+
+
+def run(fake, args, name, lanes):
+    cleanup(subscriptions=False)
+    time.sleep(1.1)  # let the fake's one-second windows drain
+    use_fake_api(fake)
+    fake.reset()
+    one_queue = lanes == ("normal",)
+    kind_lanes = notifier.KIND_LANES
+    if one_queue:
+        notifier.KIND_LANES = {}
+    workers = dispatcher.Dispatcher(workers=args.workers, lanes=lanes).start()
+    committed = {}
+    try:
+        start = time.monotonic()
+        queue_bulk(args, "normal" if one_queue else "bulk")
+        for index in range(args.tickets):
+            time.sleep(args.interval)
+            ticket_id = db.add_ticket(f"{ORDER_PREFIX}{name}-{index}", "benchmark", "التسليم", "تالف", "bench",
+                                      None, "Opened", BASE_USER_ID,
+                                      notify=lambda conn, ticket: notifier.notify_supervisors(ticket, conn=conn))
+            committed[ticket_id] = time.monotonic()
+        wait_for_outbox(f"kind = '{BULK_KIND}' OR {ALERTS}", timeout=600)
+    finally:
+        workers.stop()
+        notifier.KIND_LANES = kind_lanes
+    alerts, bulk_done = [], start
+    for _, _, params, accepted in fake.sent:
+        body = params.get("text") or params.get("caption") or ""
+        match = re.search(r"#(\d+)", body)
+        if match and int(match.group(1)) in committed:
+            alerts.append(accepted - committed[int(match.group(1))])
+        elif body == "benchmark":
+            bulk_done = max(bulk_done, accepted)
+    print(f"{name:<10} {percentile(alerts, 0.5) * 1000:>11.0f} {percentile(alerts, 0.99) * 1000:>7.0f} "
+          f"{max(alerts) * 1000:>7.0f} {bulk_done - start:>7.1f} {fake.rate_limited:>5}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bulk", type=int, default=600, help="client contacts in the fan-out")
+    parser.add_argument("--tickets", type=int, default=10)
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between tickets")
+    parser.add_argument("--workers", type=int, default=2, help="dispatcher workers per lane")
+    parser.add_argument("--latency", type=float, default=0.05, help="fake API seconds per request")
+    args = parser.parse_args()
+
+    db.init_db()
+    fake = notifier.run(FakeBotAPI(latency=args.latency).start())
+    cleanup()
+    try:
+        db.add_subscription(BASE_USER_ID, "0", "Supervisor", "Supervisor", None, "bench", None, None, BASE_USER_ID)
+        print(f"bulk: {args.bulk} client-bot + {args.bulk // 2} supervisor-bot messages; {args.tickets} new "
+              f"tickets {args.interval:.1f}s apart; fake Bot API {fake.global_rate} msg/s per bot, "
+              f"{args.latency * 1000:.0f} ms per request; lane shares {config.OUTBOX_LANE_SHARES}\n")
+        print(f"{'variant':<10} {'alert p50 ms':>11} {'p99 ms':>7} {'max ms':>7} {'bulk s':>7} {'429s':>5}")
+        run(fake, args, "one queue", ("normal",))
+        run(fake, args, "lanes", notifier.LANES)
+    finally:
+        cleanup()
+        notifier.run(fake.stop())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# benchmarks/outbox.py
+"""
+Handler latency and dispatch throughput of the notification outbox, against the
+local fake Bot API (benchmarks/fake_bot_api.py).
+
+  handler     creating a ticket and notifying the supervisors, as
+              finalize_ticket_da does: "inline" creates the ticket and then waits
+              for the fan-out (the behaviour before the outbox), "outbox" queues
+              the notifications in the ticket's transaction and returns. For the
+              outbox the time until the fake API accepted each message
+              ("delivered") is reported as well.
+  drain       time for a dispatcher with 1, 2 and 4 workers to send a backlog of
+              queued notifications spread over the three bots
+
+Uses benchmark subscriptions, BENCH-OUTBOX tickets and outbox rows, all deleted
+afterwards. Point DB_NAME at a scratch database.
+
+    python -m benchmarks.outbox
+    python -m benchmarks.outbox --supervisors 20 --tickets 10 --backlog 600
+"""
+
+import argparse
+import re
+import time
+
+from sqlalchemy import text
+
+import config
+import db
+import dispatcher
+import notifier
+from benchmarks.fake_bot_api import FakeBotAPI
+
+BASE_USER_ID = 9100000
+ORDER_PREFIX = "BENCH-OUTBOX-"
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else float("nan")
+
+
+def use_fake_api(fake):
+    """Point fresh notifier senders (empty rate-limit buckets) at the fake API."""
+    notifier.senders = {
+        bot: notifier.FanOut(notifier.make_bot(f"{index}:benchmark", base_url=f"{fake.url}/bot"))
+        for index, bot in enumerate(("DA", "Supervisor", "Client"), 1)
+    }
+
+
+def seed_supervisors(count):
+    for user_id in range(BASE_USER_ID, BASE_USER_ID + count):
+        db.add_subscription(user_id, "0", "Supervisor", "Supervisor", None, "bench", None, None, user_id)
+
+
+def cleanup():
+    with db.get_connection() as conn:
+        conn.execute(text("""
+            DELETE FROM outbox WHERE kind = 'benchmark'
+               OR ticket_id IN (SELECT ticket_id FROM tickets WHERE order_id LIKE :prefix)
+        """), {"prefix": ORDER_PREFIX + "%"})
+        conn.execute(text("DELETE FROM tickets WHERE order_id LIKE :prefix"), {"prefix": ORDER_PREFIX + "%"})
+        conn.execute(text("DELETE FROM subscriptions WHERE user_id BETWEEN :low AND :high"),
+                     {"low": BASE_USER_ID, "high": BASE_USER_ID + 99999})
+        conn.commit()
+    db.clear_caches()
+
+
+def pending_count(where):
+    with db.get_connection() as conn:
+        return conn.execute(text(f"SELECT count(*) FROM outbox WHERE status = 'pending' AND ({where})")).scalar()
+
+
+def wait_for_outbox(where, timeout=300):
+    deadline = time.monotonic() + timeout
+    while pending_count(where) and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+
+def add_ticket(index, notify=None):
+    return db.add_ticket(f"{ORDER_PREFIX}{index}", "benchmark", "المخزن", "تالف", "bench", None, "Opened",
+                         BASE_USER_ID, notify=notify)
+
+
+def create_inline(index):
+    ticket_id = add_ticket(index)
+    ticket = db.get_ticket(ticket_id)
+    chat_ids = [sup["chat_id"] for sup in db.get_supervisors()]
+    notifier.run(notifier.senders["Supervisor"].send_many(chat_ids, f"تذكرة جديدة #{ticket['ticket_id']}"))
+    return ticket_id
+
+
+def create_outbox(index):
+    return add_ticket(index, notify=lambda conn, ticket: notifier.notify_supervisors(ticket, conn=conn))
+
+
+def handler_latency(fake, args):
+    supervisors = len(db.get_supervisors())
+    # Space the tickets so their notifications fit the rate limits: one per chat per
+    # second, GLOBAL_RATE - GLOBAL_BURST per second in total
+    interval = max(1.1, supervisors / (notifier.GLOBAL_RATE - notifier.GLOBAL_BURST))
+    print(f"handler: {args.tickets} tickets, {supervisors} supervisors each, one every {interval:.1f}s")
+    print(f"{'variant':<8} {'p50 ms':>8} {'p99 ms':>8} {'delivered p50 ms':>17} {'p99 ms':>8}")
+    for name, create in (("inline", create_inline), ("outbox", create_outbox)):
+        use_fake_api(fake)
+        fake.reset()
+        workers = dispatcher.Dispatcher(workers=2).start() if name == "outbox" else None
+        latencies, committed = [], {}
+        try:
+            for index in range(args.tickets):
+                time.sleep(interval)
+                start = time.monotonic()
+                ticket_id = create(index)
+                committed[ticket_id] = time.monotonic()
+                latencies.append((committed[ticket_id] - start) * 1000)
+            if workers:
+                wait_for_outbox("kind = 'notify_supervisors'")
+        finally:
+            if workers:
+                workers.stop()
+        delivered = []
+        if workers:
+            for _, _, params, accepted in fake.sent:
+                match = re.search(r"#(\d+)", params.get("text", ""))
+                if match and int(match.group(1)) in committed:
+                    delivered.append((accepted - committed[int(match.group(1))]) * 1000)
+        print(f"{name:<8} {percentile(latencies, 0.5):>8.1f} {percentile(latencies, 0.99):>8.1f} "
+              f"{percentile(delivered, 0.5):>17.0f} {percentile(delivered, 0.99):>8.0f}")
+    print()
+
+
+def drain(fake, args):
+    print(f"drain: {args.backlog} queued notifications, round-robin over the 3 bots, distinct chats")
+    print(f"{'workers':>7} {'wall s':>7} {'msg/s':>7} {'429s':>5}")
+    for workers in (1, 2, 4):
+        time.sleep(1.1)  # let the fake's one-second windows drain
+        use_fake_api(fake)
+        fake.reset()
+        with db.get_connection() as conn:
+            for index in range(args.backlog):
+                db.enqueue_notifications(conn, ("DA", "Supervisor", "Client")[index % 3],
+                                         [BASE_USER_ID + index], "benchmark", {"text": "benchmark"})
+            conn.commit()
+        start = time.monotonic()
+        running = dispatcher.Dispatcher(workers=workers).start()
+        try:
+            wait_for_outbox("kind = 'benchmark'")
+            wall = time.monotonic() - start
+        finally:
+            running.stop()
+        print(f"{workers:>7} {wall:>7.2f} {running.sent / wall:>7.1f} {fake.rate_limited:>5}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--supervisors", type=int, default=10)
+    parser.add_argument("--tickets", type=int, default=10)
+    parser.add_argument("--backlog", type=int, default=450)
+    parser.add_argument("--latency", type=float, default=0.05, help="fake API seconds per request")
+    args = parser.parse_args()
+
+    db.init_db()
+    # Every supervisor gets every ticket, as before assignment (benchmarks.assignment)
+    config.SUPERVISOR_ASSIGNMENT = False
+    fake = notifier.run(FakeBotAPI(latency=args.latency).start())
+    print(f"fake Bot API: {args.latency * 1000:.0f} ms per request, "
+          f"{fake.global_rate} msg/s per bot, {fake.per_chat_rate} msg/s per chat\n")
+    cleanup()
+    try:
+        seed_supervisors(args.supervisors)
+        handler_latency(fake, args)
+        drain(fake, args)
+    finally:
+        cleanup()
+        notifier.run(fake.stop())
+
+
+if __name__ == "__main__":
+    main()
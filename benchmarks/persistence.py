@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# benchmarks/persistence.py
+"""
+The DA bot's conversations without persistence against persistence.PostgresPersistence,
+on one replica and on two behind a round-robin load balancer, against the local
+fake Bot API (benchmarks/fake_bot_api.py), which also stands in for the locus API.
+
+`--das` DAs report an issue as in benchmarks/updates.py, each step `--gap`
+seconds after the last was handled (a DA reading and answering), first all on
+one replica, which shows what persistence costs each update, then on two: the
+steps of each DA alternate between them, so every step lands on the replica
+that did not handle the one before, and halfway through replica A is stopped and
+a new one started in its place. Reports the tickets created (one per DA when
+every step carries on where the last left off), the time from an update arriving
+to its handler finishing, and the rows written to bot_state and in how many
+transactions. Then checks that /cancel ends a stored conversation: its bot_state
+row is deleted, so a restart doesn't bring back the draft; exits 1 if not.
+
+Uses benchmark subscriptions, BENCH-UPDATES tickets, their outbox rows and the
+benchmark bot's bot_state rows, all deleted afterwards. Point DB_NAME at a
+scratch database.
+
+    python -m benchmarks.persistence
+    python -m benchmarks.persistence --das 100 --flush-interval 1.0 --gap 1.5
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import sys
+import time
+import warnings
+
+import cloudinary.uploader
+from sqlalchemy import text
+from telegram import Update
+from telegram.ext import Application, TypeHandler
+from telegram.warnings import PTBUserWarning
+
+import config
+import da_bot
+import db
+import invalidation
+from benchmarks.fake_bot_api import FakeBotAPI
+from benchmarks.outbox import percentile
+from benchmarks.updates import BASE_USER_ID, ORDER_PREFIX, TOKEN, cleanup, fake_upload, make_update, seed_das, steps
+from persistence import PostgresPersistence
+
+BOT_ID = TOKEN.split(":")[0]
+
+
+def cleanup_state():
+    with db.get_connection() as conn:
+        conn.execute(text("DELETE FROM bot_state WHERE bot = :bot"), {"bot": BOT_ID})
+        conn.commit()
+
+
+class Replica:
+    def __init__(self, fake, args, name, persistent):
+        builder = (Application.builder().token(TOKEN).base_url(f"{fake.url}/bot")
+                   .base_file_url(f"{fake.url}/file/bot").updater(None)
+                   .concurrent_updates(config.BOT_CONCURRENT_UPDATES))
+        if persistent:
+            builder = builder.persistence(PostgresPersistence(BOT_ID, args.flush_interval, origin=name))
+        self.application = da_bot.build_application(builder)
+        self.handled = {}
+        self.application.add_handler(TypeHandler(Update, self._done), group=1)
+
+    async def _done(self, update, context):
+        self.handled.pop(update.update_id).set_result(time.monotonic())
+
+    async def handle(self, update):
+        future = self.handled[update.update_id] = asyncio.get_running_loop().create_future()
+        await self.application.update_queue.put(update)
+        return await future
+
+    async def start(self):
+        await self.application.initialize()
+        await self.application.post_init(self.application)
+        await self.application.start()
+        return self
+
+    async def stop(self):
+        await self.application.stop()
+        await self.application.shutdown()
+        await self.application.post_shutdown(self.application)
+
+
+async def run(fake, args, name, persistent, spread):
+    cleanup()
+    cleanup_state()
+    seed_das(args.das)
+    replicas = [await Replica(fake, args, "A", persistent).start()]
+    if spread:
+        replicas.append(await Replica(fake, args, "B", persistent).start())
+    update_ids = itertools.count(1)
+    latencies = []
+    restarted = asyncio.Event()
+    halfway = len(steps(0)) // 2
+
+    async def restart_a():
+        # Like a deploy: A flushes on its way down, and its replacement loads what is stored
+        await replicas[0].stop()
+        replicas[0] = await Replica(fake, args, "A2", persistent).start()
+        restarted.set()
+
+    async def da(index, user_id):
+        for step, (kind, value) in enumerate(steps(user_id)):
+            if spread and step == halfway:
+                if index == 0:
+                    await restart_a()
+                else:
+                    await restarted.wait()
+            update_id = next(update_ids)
+            replica = replicas[(index + step) % len(replicas)]
+            arrived = time.monotonic()
+            update = Update.de_json(make_update(update_id, user_id, kind, value), replica.application.bot)
+            latencies.append(await replica.handle(update) - arrived)
+            await asyncio.sleep(args.gap)
+
+    try:
+        start = time.monotonic()
+        await asyncio.gather(*(da(index, user_id) for index, user_id in
+                               enumerate(range(BASE_USER_ID, BASE_USER_ID + args.das))))
+        wall = time.monotonic() - start
+    finally:
+        for replica in replicas:
+            await replica.stop()
+    with db.get_connection() as conn:
+        tickets = conn.execute(text("SELECT count(*) FROM tickets WHERE order_id LIKE :prefix"),
+                               {"prefix": ORDER_PREFIX + "%"}).scalar()
+    persistences = [r.application.persistence for r in replicas if r.application.persistence]
+    written = sum(p.written for p in persistences)
+    flushes = sum(p.flushes for p in persistences)
+    name = f"{name}, {'2 replicas' if spread else '1 replica'}"
+    print(f"{name:<24} {len(latencies):>7} {wall:>7.1f} {percentile(latencies, 0.5) * 1000:>7.0f} "
+          f"{percentile(latencies, 0.99) * 1000:>7.0f} {tickets:>7} "
+          f"{(str(written) + ' in ' + str(flushes)) if persistent else '-':>16}")
+
+
+def stored_conversation(user_id):
+    key = json.dumps([user_id, user_id])
+    return [row for row in db.load_bot_state(BOT_ID, "conversation:da_conversation") if row[1] == key]
+
+
+async def check_cancel(fake, args):
+    """True if /cancel deletes the DA's stored conversation, as seen after a restart."""
+    cleanup()
+    cleanup_state()
+    seed_das(1)
+    update_ids = itertools.count(1)
+
+    async def send(steps):
+        # Stopping the replica flushes its persistence, like a deploy
+        replica = await Replica(fake, args, "A", True).start()
+        try:
+            for kind, value in steps:
+                await replica.handle(Update.de_json(make_update(next(update_ids), BASE_USER_ID, kind, value),
+                                                    replica.application.bot))
+        finally:
+            await replica.stop()
+        return bool(stored_conversation(BASE_USER_ID))
+
+    started = await send([("text", "/start"), ("callback", "menu_add_issue")])
+    cancelled = not await send([("text", "/cancel")])
+    print(f"\n{'ok' if started and cancelled else 'FAIL'}   /cancel deletes the stored conversation "
+          f"(stored after /start: {started}, deleted after /cancel: {cancelled})")
+    return started and cancelled
+
+
+async def main_async(args):
+    # No rate limits here: the bot's replies to each DA are not what's measured
+    fake = await FakeBotAPI(latency=args.latency, global_rate=100000, per_chat_rate=100000,
+                            locus_latency=args.locus_latency).start()
+    config.LOCUS_API_URL = f"{fake.url}/locus_info"
+    try:
+        print(f"{args.das} DAs x {len(steps(0))} updates {args.gap * 1000:.0f} ms apart; with 2 replicas they "
+              f"alternate and one restarts halfway; flush every {args.flush_interval * 1000:.0f} ms\n")
+        print(f"{'variant':<24} {'updates':>7} {'wall s':>7} {'p50 ms':>7} {'p99 ms':>7} {'tickets':>7} "
+              f"{'rows written':>16}")
+        for spread in (False, True):
+            await run(fake, args, "in memory", False, spread)
+            await run(fake, args, "postgres", True, spread)
+        return await check_cancel(fake, args)
+    finally:
+        await fake.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--das", type=int, default=40)
+    parser.add_argument("--gap", type=float, default=1.0, help="seconds between a DA's steps")
+    parser.add_argument("--flush-interval", type=float, default=0.5, help="seconds between writes to bot_state")
+    parser.add_argument("--latency", type=float, default=0.05, help="fake API seconds per request")
+    parser.add_argument("--locus-latency", type=float, default=0.3, help="locus API seconds per call")
+    parser.add_argument("--upload-latency", type=float, default=0.5, help="Cloudinary seconds per upload")
+    args = parser.parse_args()
+
+    warnings.filterwarnings("ignore", category=PTBUserWarning)
+    db.init_db()
+    invalidation.start_listener()
+    cloudinary.uploader.upload = fake_upload(args.upload_latency)
+    try:
+        ok = asyncio.run(main_async(args))
+    finally:
+        cleanup()
+        cleanup_state()
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
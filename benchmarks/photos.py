@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# benchmarks/photos.py
+"""
+Photo sends by image URL against file_id reuse (notifier.send_photo), against the
+local fake Bot API (benchmarks/fake_bot_api.py).
+
+Sends each of `--images` ticket photos to `--recipients` chats `--rounds`
+times, as notify_supervisors and then the ticket listings do, and reports how
+many times the images had to be downloaded from their URL and the per-send
+latency. The fake API charges `--fetch-latency` seconds per download, standing
+in for Telegram fetching the image from Cloudinary. A stored file_id that
+Telegram rejects is checked to fall back to the URL.
+
+Stores file_ids in photo_file_ids under a benchmark bot id and deletes them
+afterwards. Point DB_NAME at a scratch database.
+
+    python -m benchmarks.photos
+    python -m benchmarks.photos --recipients 50 --fetch-latency 0.5
+"""
+
+import argparse
+import asyncio
+import time
+import uuid
+
+from sqlalchemy import text
+
+import db
+import notifier
+from benchmarks.fake_bot_api import FakeBotAPI
+
+TOKEN = "777777:benchmark"
+
+
+async def timed(send):
+    start = time.perf_counter()
+    await send
+    return time.perf_counter() - start
+
+
+async def by_url(bot, chat_id, url):
+    return await bot.send_photo(chat_id=chat_id, photo=url, caption="benchmark")
+
+
+async def by_file_id(bot, chat_id, url):
+    return await notifier.send_photo(bot, chat_id, url, caption="benchmark")
+
+
+async def main_async(args):
+    # No rate limits here: only the photo downloads are measured
+    fake = await FakeBotAPI(latency=args.latency, global_rate=100000, per_chat_rate=100000,
+                            photo_fetch_latency=args.fetch_latency).start()
+    bot = notifier.make_bot(TOKEN, base_url=f"{fake.url}/bot")
+    print(f"{args.images} images x {args.recipients} recipients x {args.rounds} rounds; "
+          f"fake Bot API {args.latency * 1000:.0f} ms per request, "
+          f"{args.fetch_latency * 1000:.0f} ms per photo download\n")
+    print(f"{'variant':<9} {'sends':>6} {'downloads':>9} {'p50 ms':>8} {'p99 ms':>8}")
+    try:
+        for name, send in (("URL", by_url), ("file_id", by_file_id)):
+            fake.reset()
+            run = uuid.uuid4().hex[:8]
+            latencies = []
+            for _ in range(args.rounds):
+                for image in range(args.images):
+                    url = f"https://res.cloudinary.com/bench/image/upload/{run}-{image}.jpg"
+                    latencies += await asyncio.gather(*(
+                        timed(send(bot, chat_id, url)) for chat_id in range(1, args.recipients + 1)
+                    ))
+            latencies.sort()
+            print(f"{name:<9} {len(latencies):>6} {fake.fetched:>9} "
+                  f"{latencies[len(latencies) // 2] * 1000:>8.1f} "
+                  f"{latencies[min(len(latencies) - 1, int(0.99 * len(latencies)))] * 1000:>8.1f}")
+
+        # A stored file_id Telegram no longer accepts
+        url = f"https://res.cloudinary.com/bench/image/upload/{uuid.uuid4().hex[:8]}-stale.jpg"
+        await asyncio.to_thread(db.set_photo_file_id, url, notifier._bot_key(bot), "stale-file-id")
+        message = await notifier.send_photo(bot, 1, url, caption="benchmark")
+        stored = await asyncio.to_thread(db.get_photo_file_id, url, notifier._bot_key(bot))
+        ok = message.photo and stored == message.photo[-1].file_id
+        print(f"\nrejected file_id falls back to the URL and is replaced: {'ok' if ok else 'FAIL'}")
+    finally:
+        await bot.shutdown()
+        await fake.stop()
+        with db.get_connection() as conn:
+            conn.execute(text("DELETE FROM photo_file_ids WHERE bot = :bot"), {"bot": notifier._bot_key(bot)})
+            conn.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", type=int, default=5)
+    parser.add_argument("--recipients", type=int, default=20)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.05, help="fake API seconds per request")
+    parser.add_argument("--fetch-latency", type=float, default=0.3, help="fake API seconds per photo download")
+    args = parser.parse_args()
+    db.init_db()
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# benchmarks/runner.py
+"""
+Memory and Postgres connections of `python main.py` in its two modes, one
+process per bot and the dispatcher against all in one process, with the bots
+polling the local fake Bot API (benchmarks/fake_bot_api.py).
+
+Once the bots are up, `--users` users per bot each send /start and open the
+bot's ticket list, `--rounds` times over, all at once. Reports:
+
+  idle / peak conns   connections to the database held by main.py once started,
+                      and the most at any point under load
+  max conns           the most its DB pools and LISTEN connections could open
+  RSS / PSS           memory of main.py and its child processes after the load;
+                      PSS counts pages the forked processes share once
+
+Uses benchmark subscriptions and their bots' stored conversations, deleted afterwards. Point DB_NAME at a scratch
+database.
+
+    python -m benchmarks.runner
+    python -m benchmarks.runner --users 100 --rounds 5
+"""
+
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+from sqlalchemy import text
+
+import config
+import db
+import notifier
+from benchmarks.fake_bot_api import FakeBotAPI
+from benchmarks.updates import make_update
+
+BASE_USER_ID = 9800000
+# Distinct tokens: each bot polls its own updates
+TOKENS = {"DA": "101:runner-da", "Supervisor": "102:runner-supervisor", "Client": "103:runner-client"}
+MENUS = {"DA": "menu_query_issue", "Supervisor": "menu_show_all", "Client": "menu_show_tickets"}
+# A user has one subscription per chat: each bot gets its own range of users
+FIRST_USER_ID = {"DA": BASE_USER_ID, "Supervisor": BASE_USER_ID + 10000, "Client": BASE_USER_ID + 20000}
+
+
+def cleanup():
+    with db.get_connection() as conn:
+        conn.execute(text("DELETE FROM subscriptions WHERE user_id BETWEEN :low AND :high"),
+                     {"low": BASE_USER_ID, "high": BASE_USER_ID + 99999})
+        conn.commit()
+    db.clear_caches()
+    forget_conversations()
+
+
+def forget_conversations():
+    # Each mode starts the users' conversations afresh, not where the last one left them
+    with db.get_connection() as conn:
+        conn.execute(text("DELETE FROM bot_state WHERE bot = ANY(:bots)"),
+                     {"bots": [token.split(":")[0] for token in TOKENS.values()]})
+        conn.commit()
+
+
+def seed_users(count):
+    for bot, first in FIRST_USER_ID.items():
+        for user_id in range(first, first + count):
+            db.add_subscription(user_id, "0", bot, bot, None, "bench", "bench", None, user_id)
+
+
+def database_connections():
+    with db.get_connection() as conn:
+        return conn.execute(text("""
+            SELECT count(*) FROM pg_stat_activity WHERE datname = current_database() AND pid <> pg_backend_pid()
+        """)).scalar()
+
+
+def process_tree(pid):
+    pids, index = [pid], 0
+    while index < len(pids):
+        for task in os.listdir(f"/proc/{pids[index]}/task"):
+            with open(f"/proc/{pids[index]}/task/{task}/children") as f:
+                pids += [int(child) for child in f.read().split()]
+        index += 1
+    return pids
+
+
+def memory_mb(pids):
+    """Total (RSS, PSS) of pids in MB."""
+    rss = pss = 0
+    for pid in pids:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                name, value = line.split(":", 1)
+                if name == "Rss":
+                    rss += int(value.split()[0])
+                elif name == "Pss":
+                    pss += int(value.split()[0])
+    return rss / 1024, pss / 1024
+
+
+def wait_until_quiet(fake, quiet=1.0, timeout=120):
+    """Wait until the bots have sent nothing for `quiet` seconds."""
+    deadline = time.monotonic() + timeout
+    sent = -1
+    while len(fake.sent) != sent and time.monotonic() < deadline:
+        sent = len(fake.sent)
+        time.sleep(quiet)
+
+
+def run(fake, args, mode, baseline):
+    env = dict(os.environ, TELEGRAM_BASE_URL=f"{fake.url}/bot", TELEGRAM_BASE_FILE_URL=f"{fake.url}/file/bot",
+               DA_BOT_TOKEN=TOKENS["DA"], SUPERVISOR_BOT_TOKEN=TOKENS["Supervisor"],
+               CLIENT_BOT_TOKEN=TOKENS["Client"])
+    main_py = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "main.py")
+    process = subprocess.Popen([sys.executable, main_py, "--mode", mode], env=env, start_new_session=True,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    peak, sampling = [0], threading.Event()
+
+    def sample():
+        while not sampling.is_set():
+            peak[0] = max(peak[0], database_connections() - baseline)
+            time.sleep(0.1)
+
+    try:
+        time.sleep(args.startup)
+        idle = database_connections() - baseline
+        sampler = threading.Thread(target=sample, daemon=True)
+        sampler.start()
+        fake.reset()
+        update_id = 0
+        for _ in range(args.rounds):
+            for index in range(args.users):
+                for bot, token in TOKENS.items():
+                    user_id = FIRST_USER_ID[bot] + index
+                    for kind, value in (("text", "/start"), ("callback", MENUS[bot])):
+                        update_id += 1
+                        fake.add_update(token, make_update(update_id, user_id, kind, value))
+        wait_until_quiet(fake)
+        sampling.set()
+        sampler.join()
+        rss, pss = memory_mb(process_tree(process.pid))
+        processes = len(process_tree(process.pid))
+    finally:
+        os.killpg(process.pid, signal.SIGINT)
+        try:
+            process.wait(30)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+    # Each process's pool, its invalidation listener, and the dispatcher's LISTEN connection
+    pools = 4 if mode == "processes" else 1
+    max_connections = pools * (config.DB_POOL_SIZE + config.DB_MAX_OVERFLOW + 1) + 1
+    print(f"{mode:<10} {processes:>9} {idle:>10} {peak[0]:>10} {max_connections:>9} {rss:>7.0f} {pss:>7.0f} "
+          f"{len(fake.sent):>7}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50, help="users per bot")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--startup", type=float, default=8.0, help="seconds to let main.py start")
+    parser.add_argument("--latency", type=float, default=0.05, help="fake API seconds per request")
+    args = parser.parse_args()
+
+    db.init_db()
+    # No rate limits here: only the bots' footprint is measured
+    fake = notifier.run(FakeBotAPI(latency=args.latency, global_rate=100000, per_chat_rate=100000).start())
+    cleanup()
+    try:
+        seed_users(args.users)
+        print(f"{args.users} users per bot x {args.rounds} rounds of /start and the ticket list; "
+              f"DB pool {config.DB_POOL_SIZE}+{config.DB_MAX_OVERFLOW} per process\n")
+        print(f"{'mode':<10} {'processes':>9} {'idle conns':>10} {'peak conns':>10} {'max conns':>9} "
+              f"{'RSS MB':>7} {'PSS MB':>7} {'replies':>7}")
+        for mode in ("processes", "single"):
+            forget_conversations()
+            baseline = database_connections()
+            run(fake, args, mode, baseline)
+            time.sleep(1)
+    finally:
+        cleanup()
+        notifier.run(fake.stop())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# benchmarks/ticket_records.py
+"""
+Cost per ticket of the list queries: the old ``SELECT *`` + ``dict(row._mapping)``
+against the projected TicketDetail / TicketSummary records in db.py.
+
+Reports, per ticket: bytes sent by the server (pg_column_size of the selected
+row), Python memory held by the result list, and time to fetch and build it.
+
+Usage (point DB_NAME at a scratch database):
+
+    python -m benchmarks.ticket_records              # 100k benchmark tickets
+    python -m benchmarks.ticket_records --rows 20000 --keep
+"""
+
+import argparse
+import gc
+import time
+import tracemalloc
+
+from sqlalchemy import text
+
+import db
+
+BENCH_PREFIX = "BENCH-"
+WHERE = f"WHERE order_id LIKE '{BENCH_PREFIX}%'"
+
+
+def seed(conn, rows):
+    """Top the benchmark tickets up to `rows`, with descriptions and legacy logs of a realistic size."""
+    existing = conn.execute(text(f"SELECT count(*) FROM tickets {WHERE}")).scalar()
+    if existing < rows:
+        conn.execute(text("""
+            INSERT INTO tickets (order_id, issue_description, issue_reason, issue_type, client,
+                                 status, da_id, logs, event_seq, created_at)
+            SELECT :prefix || lpad(n::text, 9, '0'),
+                   repeat('وصف المشكلة كما أدخله الوكيل ', 20),
+                   'المخزن', 'تالف', 'client-' || (n % 200),
+                   CASE WHEN n % 20 = 0 THEN 'Opened' ELSE 'Closed' END,
+                   1000 + n % 500,
+                   '[' || repeat('{"action": "create", "message": "seeded benchmark log entry", '
+                                 '"timestamp": "2025-01-01T00:00:00"},', 8) || '{}]',
+                   0, now() - (n || ' seconds')::interval
+            FROM generate_series(:start, :stop) AS n
+        """), {"prefix": BENCH_PREFIX, "start": existing + 1, "stop": rows})
+        conn.commit()
+        conn.execute(text("ANALYZE tickets"))
+        conn.commit()
+
+
+def wire_bytes(conn, select_list):
+    return conn.execute(text(
+        f"SELECT avg(pg_column_size(r.*)) FROM (SELECT {select_list} FROM tickets {WHERE}) r"
+    )).scalar()
+
+
+def variants():
+    return [
+        ("SELECT * -> dict", "*", lambda rows: [dict(row._mapping) for row in rows]),
+        ("TicketDetail", db.TICKET_DETAIL_COLUMNS, lambda rows: [db.TicketDetail._make(row) for row in rows]),
+        ("TicketSummary", db.TICKET_SUMMARY_COLUMNS, db._summaries),
+    ]
+
+
+def measure(conn, select_list, build, repeat):
+    statement = text(f"SELECT {select_list} FROM tickets {WHERE}")
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        records = build(conn.execute(statement).fetchall())
+        best = min(best, time.perf_counter() - start)
+        del records
+
+    # Memory held by the finished list (the raw rows are freed once it is built)
+    gc.collect()
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    records = build(conn.execute(statement).fetchall())
+    gc.collect()
+    held = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+    return len(records), held, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100_000, help="benchmark tickets to measure")
+    parser.add_argument("--repeat", type=int, default=3, help="timing runs per variant (best is reported)")
+    parser.add_argument("--keep", action="store_true", help="keep the benchmark tickets afterwards")
+    args = parser.parse_args()
+
+    db.init_db()
+    with db.get_connection() as conn:
+        seed(conn, args.rows)
+        print(f"{'':<18} {'wire B/ticket':>14} {'memory B/ticket':>16} {'us/ticket':>10}")
+        for name, select_list, build in variants():
+            count, held, seconds = measure(conn, select_list, build, args.repeat)
+            print(f"{name:<18} {wire_bytes(conn, select_list):>14.0f} {held / count:>16.0f} "
+                  f"{seconds / count * 1e6:>10.2f}")
+        print(f"\n{count} tickets")
+        if not args.keep:
+            conn.execute(text(f"DELETE FROM tickets {WHERE}"))
+            conn.commit()
+
+
+if __name__ == "__main__":
+    main()
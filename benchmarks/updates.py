@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# benchmarks/updates.py
+"""
+Update throughput of the DA bot handling one update at a time, as the Updater's
+dispatcher thread did before the asyncio port, against BOT_CONCURRENT_UPDATES at
+once, against the local fake Bot API (benchmarks/fake_bot_api.py), which also
+stands in for the locus API.
+
+`--das` DAs report an issue at the same time, each sending its next update once
+the previous one is handled: /start, "add issue" (a locus API call of
+`--locus-latency` seconds), the order, reason and type, the description, "attach
+a photo", the photo (downloaded from the fake API and uploaded to Cloudinary, here
+a blocking call of `--upload-latency` seconds), and "no edits", which creates the
+ticket and queues the supervisors' alert. Reports the updates handled per second,
+the time each update took from arriving to being handled, and handler errors.
+
+Uses benchmark subscriptions, BENCH-UPDATES tickets and their outbox rows, all
+deleted afterwards. Point DB_NAME at a scratch database.
+
+    python -m benchmarks.updates
+    python -m benchmarks.updates --das 100 --locus-latency 1.0
+"""
+
+import argparse
+import asyncio
+import itertools
+import time
+import warnings
+
+import cloudinary.uploader
+from sqlalchemy import text
+from telegram import Update
+from telegram.ext import Application, TypeHandler
+from telegram.warnings import PTBUserWarning
+
+import config
+import da_bot
+import db
+from benchmarks.fake_bot_api import FakeBotAPI
+from benchmarks.outbox import percentile
+
+BASE_USER_ID = 9700000
+ORDER_PREFIX = "BENCH-UPDATES-"
+TOKEN = "888888:benchmark"
+
+
+def cleanup():
+    with db.get_connection() as conn:
+        conn.execute(text("""
+            DELETE FROM outbox WHERE ticket_id IN (SELECT ticket_id FROM tickets WHERE order_id LIKE :prefix)
+        """), {"prefix": ORDER_PREFIX + "%"})
+        conn.execute(text("DELETE FROM tickets WHERE order_id LIKE :prefix"), {"prefix": ORDER_PREFIX + "%"})
+        conn.execute(text("DELETE FROM subscriptions WHERE user_id BETWEEN :low AND :high"),
+                     {"low": BASE_USER_ID, "high": BASE_USER_ID + 99999})
+        conn.commit()
+    db.clear_caches()
+
+
+def seed_das(count):
+    # The fake locus API answers with order BENCH-<phone>
+    for user_id in range(BASE_USER_ID, BASE_USER_ID + count):
+        db.add_subscription(user_id, f"UPDATES-{user_id}", "DA", "DA", None, "bench", "bench", None, user_id)
+
+
+def steps(user_id):
+    """The updates of one DA reporting an issue: (kind, text or callback data)."""
+    return [("text", "/start"), ("callback", "menu_add_issue"),
+            ("callback", f"select_order|{ORDER_PREFIX}{user_id}|bench"), ("callback", "issue_reason_المخزن"),
+            ("callback", "issue_type_تالف"), ("text", "benchmark"), ("callback", "attach_yes"),
+            ("photo", None), ("callback", "da_edit_no")]
+
+
+def make_update(update_id, user_id, kind, value):
+    user = {"id": user_id, "is_bot": False, "first_name": "bench"}
+    message = {"message_id": update_id, "date": int(time.time()), "chat": {"id": user_id, "type": "private"},
+               "from": user}
+    if kind == "callback":
+        message["text"] = "bench"
+        return {"update_id": update_id, "callback_query": {"id": str(update_id), "from": user,
+                                                           "chat_instance": "bench", "data": value,
+                                                           "message": message}}
+    if kind == "photo":
+        message["photo"] = [{"file_id": f"bench-{update_id}", "file_unique_id": f"bench-{update_id}",
+                             "width": 800, "height": 600}]
+    else:
+        message["text"] = value
+        if value.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(value)}]
+    return {"update_id": update_id, "message": message}
+
+
+def fake_upload(latency):
+    counter = itertools.count()
+
+    def upload(file, **options):
+        # Blocking, like the Cloudinary SDK's own upload
+        time.sleep(latency)
+        return {"secure_url": f"https://res.cloudinary.com/bench/image/upload/{next(counter)}.jpg"}
+    return upload
+
+
+async def run(fake, args, name, concurrent_updates):
+    builder = (Application.builder().token(TOKEN).base_url(f"{fake.url}/bot")
+               .base_file_url(f"{fake.url}/file/bot").updater(None).concurrent_updates(concurrent_updates))
+    application = da_bot.build_application(builder)
+    handled, errors = {}, []
+
+    async def done(update, context):
+        handled.pop(update.update_id).set_result(time.monotonic())
+
+    async def error(update, context):
+        errors.append(context.error)
+
+    # Group 1 runs after the bot's own handlers
+    application.add_handler(TypeHandler(Update, done), group=1)
+    application.add_error_handler(error)
+    update_ids = itertools.count(1)
+    latencies = []
+
+    async def da(user_id):
+        for kind, value in steps(user_id):
+            update_id = next(update_ids)
+            handled[update_id] = asyncio.get_running_loop().create_future()
+            arrived = time.monotonic()
+            await application.update_queue.put(
+                Update.de_json(make_update(update_id, user_id, kind, value), application.bot))
+            latencies.append(await handled[update_id] - arrived)
+
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+    try:
+        start = time.monotonic()
+        await asyncio.gather(*(da(user_id) for user_id in range(BASE_USER_ID, BASE_USER_ID + args.das)))
+        wall = time.monotonic() - start
+    finally:
+        await application.stop()
+        await application.shutdown()
+        await application.post_shutdown(application)
+    with db.get_connection() as conn:
+        tickets = conn.execute(text("SELECT count(*) FROM tickets WHERE order_id LIKE :prefix"),
+                               {"prefix": ORDER_PREFIX + "%"}).scalar()
+        conn.execute(text("""
+            DELETE FROM outbox WHERE ticket_id IN (SELECT ticket_id FROM tickets WHERE order_id LIKE :prefix)
+        """), {"prefix": ORDER_PREFIX + "%"})
+        conn.execute(text("DELETE FROM tickets WHERE order_id LIKE :prefix"), {"prefix": ORDER_PREFIX + "%"})
+        conn.commit()
+    print(f"{name:<12} {len(latencies):>7} {wall:>7.1f} {len(latencies) / wall:>9.1f} "
+          f"{percentile(latencies, 0.5) * 1000:>7.0f} {percentile(latencies, 0.99) * 1000:>7.0f} "
+          f"{tickets:>7} {len(errors):>6}")
+
+
+async def main_async(args):
+    # No rate limits here: the bot's replies to each DA are not what's measured
+    fake = await FakeBotAPI(latency=args.latency, global_rate=100000, per_chat_rate=100000,
+                            locus_latency=args.locus_latency).start()
+    config.LOCUS_API_URL = f"{fake.url}/locus_info"
+    try:
+        print(f"{args.das} DAs x {len(steps(0))} updates; fake Bot API {args.latency * 1000:.0f} ms per request, "
+              f"locus API {args.locus_latency * 1000:.0f} ms, upload {args.upload_latency * 1000:.0f} ms\n")
+        print(f"{'variant':<12} {'updates':>7} {'wall s':>7} {'updates/s':>9} {'p50 ms':>7} {'p99 ms':>7} "
+              f"{'tickets':>7} {'errors':>6}")
+        await run(fake, args, "one at once", False)
+        await run(fake, args, f"{args.concurrent} at once", args.concurrent)
+    finally:
+        await fake.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--das", type=int, default=40)
+    parser.add_argument("--concurrent", type=int, default=config.BOT_CONCURRENT_UPDATES,
+                        help="updates handled at once after the port")
+    parser.add_argument("--latency", type=float, default=0.05, help="fake API seconds per request")
+    parser.add_argument("--locus-latency", type=float, default=0.3, help="locus API seconds per call")
+    parser.add_argument("--upload-latency", type=float, default=0.5, help="Cloudinary seconds per upload")
+    args = parser.parse_args()
+
+    warnings.filterwarnings("ignore", category=PTBUserWarning)
+    db.init_db()
+    cloudinary.uploader.upload = fake_upload(args.upload_latency)
+    cleanup()
+    try:
+        seed_das(args.das)
+        asyncio.run(main_async(args))
+    finally:
+        cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# benchmarks/webhook.py
+"""
+Update-to-handler latency of the three bots polling for their updates
+(main.py --mode single) against taking them from the webhook server
+(main.py --mode webhook, webhook.py), with the local fake Bot API
+(benchmarks/fake_bot_api.py) playing Telegram: `--latency` seconds is a round
+trip to it, so an update reaches a waiting long poll or the webhook half of it
+after it is sent.
+
+`--users` users per bot each send /start `--rounds` times; the updates for all
+three bots arrive at `--rate` per second, evenly spaced. Reports the time from
+Telegram having an update to the bot's handlers starting on it, the Bot API
+requests made for the updates (getUpdates) and the webhook requests rejected.
+Before the run a POST with a wrong secret token is sent to each bot's path,
+which the server must reject.
+
+    python -m benchmarks.webhook
+    python -m benchmarks.webhook --rate 200 --latency 0.15
+"""
+
+import argparse
+import asyncio
+import itertools
+import time
+import warnings
+
+import httpx
+from telegram import Update
+from telegram.ext import Application, TypeHandler
+from telegram.warnings import PTBUserWarning
+
+import client_bot
+import config
+import da_bot
+import db
+import supervisor_bot
+import webhook
+from benchmarks.fake_bot_api import FakeBotAPI
+from benchmarks.outbox import percentile
+from benchmarks.updates import make_update
+
+BASE_USER_ID = 9500000
+TOKENS = {"da": "201:webhook-da", "supervisor": "202:webhook-supervisor", "client": "203:webhook-client"}
+MODULES = {"da": da_bot, "supervisor": supervisor_bot, "client": client_bot}
+SECRET = "benchmark-secret"
+
+
+async def run(fake, args, use_webhook):
+    arrived, sent = {}, {}
+    applications = {}
+    for name, token in TOKENS.items():
+        builder = (Application.builder().token(token).base_url(f"{fake.url}/bot")
+                   .base_file_url(f"{fake.url}/file/bot").concurrent_updates(config.BOT_CONCURRENT_UPDATES))
+        if use_webhook:
+            builder = builder.updater(None)
+        application = MODULES[name].build_application(builder)
+
+        async def record(update, context):
+            arrived[update.update_id] = time.monotonic()
+
+        # Runs before the bot's own handlers, the earliest of which are in group -1
+        application.add_handler(TypeHandler(Update, record), group=-2)
+        applications[name] = application
+
+    server = webhook.WebhookServer(applications, SECRET, host="127.0.0.1", port=0, prefix="/telegram")
+    rejected = 0
+    for application in applications.values():
+        await application.initialize()
+        if application.post_init:
+            await application.post_init(application)
+        if application.updater:
+            await application.updater.start_polling()
+        await application.start()
+    try:
+        if use_webhook:
+            await server.start()
+            await webhook.set_webhooks({name: app.bot for name, app in applications.items()},
+                                       url=f"{server.url}/telegram", secret=SECRET)
+            async with httpx.AsyncClient() as client:
+                for name in TOKENS:
+                    response = await client.post(f"{server.url}/telegram/{name}", json={"update_id": 0},
+                                                 headers={webhook.SECRET_HEADER: "wrong"})
+                    rejected += response.status_code == 403
+        fake.reset()
+        updates = [(token, BASE_USER_ID + user) for _ in range(args.rounds)
+                   for user in range(args.users) for token in TOKENS.values()]
+        update_ids = itertools.count(1)
+        start = time.monotonic()
+        for index, (token, user_id) in enumerate(updates):
+            delay = start + index / args.rate - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            update_id = next(update_ids)
+            sent[update_id] = time.monotonic()
+            fake.add_update(token, make_update(update_id, user_id, "text", "/start"))
+        deadline = time.monotonic() + 30
+        while len(arrived) < len(sent) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        polls = fake.polls
+    finally:
+        await server.stop()
+        for application in applications.values():
+            if application.updater and application.updater.running:
+                await application.updater.stop()
+            await application.stop()
+            await application.shutdown()
+            if application.post_shutdown:
+                await application.post_shutdown(application)
+    latencies = [arrived[update_id] - sent[update_id] for update_id in sent if update_id in arrived]
+    name = "webhook" if use_webhook else "polling"
+    print(f"{name:<8} {len(latencies):>7}/{len(sent):<7} {percentile(latencies, 0.5) * 1000:>7.1f} "
+          f"{percentile(latencies, 0.99) * 1000:>7.1f} {max(latencies) * 1000:>7.1f} {polls:>9} "
+          f"{(str(rejected) + '/3') if use_webhook else '-':>8}")
+
+
+async def main_async(args):
+    # No rate limits here: the bots' replies are not what's measured
+    fake = await FakeBotAPI(latency=args.latency, global_rate=100000, per_chat_rate=100000).start()
+    try:
+        print(f"{args.users} users per bot x {args.rounds} rounds at {args.rate:g} updates/s; "
+              f"fake Bot API {args.latency * 1000:.0f} ms round trip\n")
+        print(f"{'variant':<8} {'handled':>15} {'p50 ms':>7} {'p99 ms':>7} {'max ms':>7} {'getUpdates':>9} "
+              f"{'rejected':>8}")
+        await run(fake, args, use_webhook=False)
+        await run(fake, args, use_webhook=True)
+    finally:
+        await fake.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50, help="users per bot")
+    parser.add_argument("--rounds", type=int, default=4)
+    parser.add_argument("--rate", type=float, default=100.0, help="updates per second, all bots together")
+    parser.add_argument("--latency", type=float, default=0.1, help="fake API seconds per round trip")
+    args = parser.parse_args()
+
+    warnings.filterwarnings("ignore", category=PTBUserWarning)
+    db.init_db()
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
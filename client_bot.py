@@ -2,19 +2,21 @@
 # client_bot.py
 
 import logging
-import json
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ForceReply, Bot
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
-    Updater,
+    Application,
     CommandHandler,
     MessageHandler,
-    Filters,
+    filters,
     CallbackQueryHandler,
     ConversationHandler,
-    CallbackContext
+    ContextTypes
 )
 import db
 import config
+import invalidation
+import notifier
+import persistence
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO
@@ -24,67 +26,72 @@ logger = logging.getLogger(__name__)
 # Conversation states
 (SUBSCRIPTION_PHONE, SUBSCRIPTION_CLIENT, MAIN_MENU, AWAITING_RESPONSE) = range(4)
 
-def safe_edit_message(query, text, reply_markup=None, parse_mode="HTML"):
+# Tickets shown per page; the rest are behind a "more" button
+TICKETS_PAGE_SIZE = 10
+
+async def safe_edit_message(query, text, reply_markup=None, parse_mode="HTML"):
     """
     Safely edits a message. If the original message is a photo (has a caption),
     it uses edit_message_caption() instead of edit_message_text().
     """
     if hasattr(query.message, "caption") and query.message.caption:
-        return query.edit_message_caption(caption=text, reply_markup=reply_markup, parse_mode=parse_mode)
+        return await query.edit_message_caption(caption=text, reply_markup=reply_markup, parse_mode=parse_mode)
     else:
-        return query.edit_message_text(text=text, reply_markup=reply_markup, parse_mode=parse_mode)
+        return await query.edit_message_text(text=text, reply_markup=reply_markup, parse_mode=parse_mode)
 
-def start(update: Update, context: CallbackContext) -> int:
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user = update.effective_user
-    sub = db.get_subscription(user.id, "Client")
+    sub = await db.run_async(db.get_subscription, user.id, "Client")
     if not sub:
-        update.message.reply_text("أهلاً! يرجى إدخال رقم هاتفك للاشتراك (Client):")
+        await update.message.reply_text("أهلاً! يرجى إدخال رقم هاتفك للاشتراك (Client):")
         return SUBSCRIPTION_PHONE
     elif not sub['client']:
-        update.message.reply_text("يرجى إدخال اسم العميل الذي تمثله (مثال: بيبس):")
+        await update.message.reply_text("يرجى إدخال اسم العميل الذي تمثله (مثال: بيبس):")
         return SUBSCRIPTION_CLIENT
     else:
         keyboard = [[InlineKeyboardButton("عرض المشاكل", callback_data="menu_show_tickets")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
-        update.message.reply_text(f"مرحباً {user.first_name}", reply_markup=reply_markup)
+        await update.message.reply_text(f"مرحباً {user.first_name}", reply_markup=reply_markup)
         return MAIN_MENU
 
-def subscription_phone(update: Update, context: CallbackContext) -> int:
+async def subscription_phone(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     phone = update.message.text.strip()
     user = update.effective_user
-    db.add_subscription(
-        user.id, phone, 'Client', "Client", None,
+    await db.run_async(
+        db.add_subscription, user.id, phone, 'Client', "Client", None,
         user.username, user.first_name, user.last_name, update.effective_chat.id
     )
-    update.message.reply_text(
+    await update.message.reply_text(
         "تم استقبال رقم الهاتف. الآن، يرجى إدخال اسم العميل الذي تمثله (مثال: بيبس):"
     )
     return SUBSCRIPTION_CLIENT
 
-def subscription_client(update: Update, context: CallbackContext) -> int:
+async def subscription_client(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     client_name = update.message.text.strip()
     user = update.effective_user
-    sub = db.get_subscription(user.id, 'Client')
+    sub = await db.run_async(db.get_subscription, user.id, 'Client')
     phone = sub['phone'] if sub and sub['phone'] != "unknown" else "unknown"
-    db.add_subscription(
-        user.id, phone, 'Client', "Client", client_name,
+    await db.run_async(
+        db.add_subscription, user.id, phone, 'Client', "Client", client_name,
         user.username, user.first_name, user.last_name, update.effective_chat.id
     )
     keyboard = [[InlineKeyboardButton("عرض المشاكل", callback_data="menu_show_tickets")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    update.message.reply_text("تم الاشتراك بنجاح كـ Client!", reply_markup=reply_markup)
+    await update.message.reply_text("تم الاشتراك بنجاح كـ Client!", reply_markup=reply_markup)
     return MAIN_MENU
 
-def client_main_menu_callback(update: Update, context: CallbackContext) -> int:
+async def client_main_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
-    query.answer()
+    await query.answer()
     data = query.data
 
-    if data == "menu_show_tickets":
-        sub = db.get_subscription(query.from_user.id, "Client")
-        client_name = sub['client']
-        # Filter tickets for this client with status "Awaiting Client Response"
-        tickets = [t for t in db.get_all_open_tickets() if t['status'] == "Awaiting Client Response" and t['client'] == client_name]
+    if data == "menu_show_tickets" or data.startswith("more_pending|"):
+        cursor = db.decode_cursor(data.split("|", 1)[1]) if data.startswith("more_pending|") else None
+        # Tickets for this client with status "Awaiting Client Response"
+        tickets, next_cursor = await db.run_async(
+            db.get_tickets_by_client_page, query.from_user.id, cursor, TICKETS_PAGE_SIZE,
+            status="Awaiting Client Response", full_description=True
+        )
 
         if tickets:
             for ticket in tickets:
@@ -103,34 +110,36 @@ def client_main_menu_callback(update: Update, context: CallbackContext) -> int:
                 reply_markup = InlineKeyboardMarkup(keyboard)
                 if ticket.get('image_url'):
                     # Send a single message with the image and caption containing all details
-                    context.bot.send_photo(
-                        chat_id=update.effective_chat.id,
-                        photo=ticket['image_url'],
+                    await notifier.send_photo(
+                        context.bot,
+                        update.effective_chat.id,
+                        ticket['image_url'],
                         caption=text,
-                        reply_markup=reply_markup,
-                        parse_mode="HTML"
+                        reply_markup=reply_markup
                     )
                 else:
-                    context.bot.send_message(
+                    await context.bot.send_message(
                         chat_id=update.effective_chat.id,
                         text=text,
                         reply_markup=reply_markup,
                         parse_mode="HTML"
                     )
+            if next_cursor:
+                keyboard = [[InlineKeyboardButton("عرض المزيد",
+                                                  callback_data=f"more_pending|{db.encode_cursor(next_cursor)}")]]
+                await context.bot.send_message(chat_id=update.effective_chat.id, text="يوجد المزيد من التذاكر.",
+                                               reply_markup=InlineKeyboardMarkup(keyboard))
         else:
-            context.bot.send_message(chat_id=update.effective_chat.id, text="لا توجد تذاكر في انتظار ردك.")
+            await context.bot.send_message(chat_id=update.effective_chat.id, text="لا توجد تذاكر في انتظار ردك.")
         return MAIN_MENU
 
     elif data.startswith("solve|"):
         parts = data.split("|")
         ticket_id = int(parts[1])
-        ticket = db.get_ticket(ticket_id)
-        if ticket['status'] in ("Client Responded", "Client Ignored", "Closed"):
-            safe_edit_message(query, text="التذكرة مغلقة أو تمت معالجتها بالفعل ولا يمكن تعديلها.")
-            return MAIN_MENU
+        # The status is checked atomically when the solution is written
         context.user_data['ticket_id'] = ticket_id
         context.user_data['action'] = 'solve'
-        context.bot.send_message(
+        await context.bot.send_message(
             chat_id=query.message.chat.id,
             text="من فضلك أدخل الحل للمشكلة:"
         )
@@ -138,36 +147,45 @@ def client_main_menu_callback(update: Update, context: CallbackContext) -> int:
 
     elif data.startswith("ignore|"):
         ticket_id = int(data.split("|")[1])
-        ticket = db.get_ticket(ticket_id)
-        if ticket['status'] in ("Client Responded", "Client Ignored", "Closed"):
-            safe_edit_message(query, text="التذكرة مغلقة أو تمت معالجتها بالفعل ولا يمكن تعديلها.")
+        ticket, applied = await db.run_async(
+            db.apply_transition, ticket_id, "client_ignored", "ignored", actor=query.from_user.id,
+            notify=lambda conn, ticket: notify_supervisors_client_response(ticket_id, ignored=True, ticket=ticket,
+                                                                           conn=conn))
+        if not ticket:
+            await safe_edit_message(query, text="التذكرة غير موجودة.")
+            return MAIN_MENU
+        if not applied:
+            await safe_edit_message(query, text="التذكرة مغلقة أو تمت معالجتها بالفعل ولا يمكن تعديلها.")
             return MAIN_MENU
-        db.update_ticket_status(ticket_id, "Client Ignored", {"action": "client_ignored"})
-        db.update_ticket_status(ticket_id, "Client Responded", {"action": "client_final_response", "message": "ignored"})
-        notify_supervisors_client_response(ticket_id, ignored=True)
-        safe_edit_message(query, text="تم إرسال ردك (تم تجاهل التذكرة).")
+        await safe_edit_message(query, text="تم إرسال ردك (تم تجاهل التذكرة).")
         return MAIN_MENU
 
     else:
-        safe_edit_message(query, text="الإجراء غير معروف.")
+        await safe_edit_message(query, text="الإجراء غير معروف.")
         return MAIN_MENU
 
-def client_awaiting_response_handler(update: Update, context: CallbackContext) -> int:
+async def client_awaiting_response_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     solution = update.message.text.strip()
     ticket_id = context.user_data.get('ticket_id')
-    ticket = db.get_ticket(ticket_id)
-    if ticket['status'] in ("Client Responded", "Client Ignored", "Closed"):
-        update.message.reply_text("التذكرة مغلقة أو تمت معالجتها بالفعل ولا يمكن تعديلها.")
+    ticket, applied = await db.run_async(
+        db.apply_transition, ticket_id, "client_solution", solution, actor=update.effective_user.id,
+        notify=lambda conn, ticket: notify_supervisors_client_response(ticket_id, solution=solution, ticket=ticket,
+                                                                       conn=conn))
+    if not ticket:
+        await update.message.reply_text("التذكرة غير موجودة.")
+        context.user_data.pop('ticket_id', None)
         return MAIN_MENU
-    db.update_ticket_status(ticket_id, "Client Responded", {"action": "client_solution", "message": solution})
-    notify_supervisors_client_response(ticket_id, solution=solution)
-    update.message.reply_text("تم إرسال الحل إلى المشرف.")
+    if not applied:
+        await update.message.reply_text("التذكرة مغلقة أو تمت معالجتها بالفعل ولا يمكن تعديلها.")
+        context.user_data.pop('ticket_id', None)
+        return MAIN_MENU
+    await update.message.reply_text("تم إرسال الحل إلى المشرف.")
     context.user_data.pop('ticket_id', None)
     return MAIN_MENU
 
-def notify_supervisors_client_response(ticket_id, solution=None, ignored=False):
-    ticket = db.get_ticket(ticket_id)
-    bot = Bot(token=config.SUPERVISOR_BOT_TOKEN)
+def notify_supervisors_client_response(ticket_id, solution=None, ignored=False, ticket=None, conn=None):
+    if ticket is None:
+        ticket = db.get_ticket(ticket_id)
     if ignored:
         text = (
             f"<b>تنبيه:</b> تم تجاهل التذكرة #{ticket_id} من قبل العميل.\n"
@@ -186,89 +204,95 @@ def notify_supervisors_client_response(ticket_id, solution=None, ignored=False):
         )
         keyboard = [[InlineKeyboardButton("إرسال للحالة إلى الوكيل", callback_data=f"sendto_da|{ticket_id}")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    for sup in db.get_supervisors():
-        try:
-            if ticket.get('image_url'):
-                bot.send_photo(
-                    chat_id=sup['chat_id'],
-                    photo=ticket['image_url'],
-                    caption=text,
-                    reply_markup=reply_markup,
-                    parse_mode="HTML"
-                )
-            else:
-                bot.send_message(
-                    chat_id=sup['chat_id'],
-                    text=text,
-                    reply_markup=reply_markup,
-                    parse_mode="HTML"
-                )
-        except Exception as e:
-            logger.error(f"Error notifying supervisor {sup['chat_id']}: {e}")
+    if ignored:
+        digest_line = f"⚠️ #{ticket_id} · {ticket['order_id']} · تجاهل العميل التذكرة"
+    else:
+        digest_line = f"💬 #{ticket_id} · {ticket['order_id']} · حل العميل: {(solution or '')[:80]}"
+    queued = notifier.queue_for_supervisors(conn, ticket, text, reply_markup, digest_line,
+                                            "notify_supervisors_client_response", photo=ticket.get('image_url'),
+                                            dedup_key=notifier.event_key("notify_supervisors_client_response",
+                                                                         ticket))
+    notifier.refresh_cards(conn, ticket, skip_bots=("Supervisor",))
+    return queued
 
-def default_handler_client(update: Update, context: CallbackContext) -> int:
+async def default_handler_client(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     keyboard = [[InlineKeyboardButton("عرض المشاكل", callback_data="menu_show_tickets")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    update.message.reply_text("الرجاء اختيار خيار:", reply_markup=reply_markup)
+    await update.message.reply_text("الرجاء اختيار خيار:", reply_markup=reply_markup)
     return MAIN_MENU
 
+async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    await update.message.reply_text("تم إلغاء العملية.")
+    return ConversationHandler.END
+
 # --- GLOBAL HANDLERS ---
 
-def global_solve_callback(update: Update, context: CallbackContext) -> None:
+async def global_solve_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Global callback to handle any 'solve|' callbacks if the conversation handler
     is not active.
     """
     query = update.callback_query
-    query.answer()
+    await query.answer()
     data = query.data.split("|")
     ticket_id = int(data[1])
     context.user_data['ticket_id'] = ticket_id
     context.user_data['action'] = 'solve'
-    context.bot.send_message(
+    await context.bot.send_message(
         chat_id=query.message.chat.id,
         text="من فضلك أدخل الحل للمشكلة:"
     )
 
-def global_text_handler(update: Update, context: CallbackContext) -> None:
+async def global_text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Global text handler that checks if there is a pending solution.
     """
     if context.user_data.get('ticket_id') and context.user_data.get('action') == 'solve':
-        client_awaiting_response_handler(update, context)
+        await client_awaiting_response_handler(update, context)
     else:
-        default_handler_client(update, context)
+        await default_handler_client(update, context)
 
-def main():
-    updater = Updater(config.CLIENT_BOT_TOKEN, use_context=True)
-    dp = updater.dispatcher
+def build_application(builder=None) -> Application:
+    """
+    The client bot's Application with all its handlers, from builder
+    (default: notifier.application_builder() for CLIENT_BOT_TOKEN).
+    """
+    if builder is None:
+        builder = notifier.application_builder(config.CLIENT_BOT_TOKEN)
+    application = builder.build()
 
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler('start', start)],
         states={
             SUBSCRIPTION_PHONE: [
-                MessageHandler(Filters.text & ~Filters.command, subscription_phone)
+                MessageHandler(filters.TEXT & ~filters.COMMAND, subscription_phone)
             ],
             SUBSCRIPTION_CLIENT: [
-                MessageHandler(Filters.text & ~Filters.command, subscription_client)
+                MessageHandler(filters.TEXT & ~filters.COMMAND, subscription_client)
             ],
             MAIN_MENU: [
-                CallbackQueryHandler(client_main_menu_callback, pattern="^(menu_show_tickets|solve\\|.*|ignore\\|.*)")
+                CallbackQueryHandler(client_main_menu_callback, pattern="^(menu_show_tickets|more_pending\\|.*|solve\\|.*|ignore\\|.*)")
             ],
             AWAITING_RESPONSE: [
-                MessageHandler(Filters.text & ~Filters.command, client_awaiting_response_handler)
+                MessageHandler(filters.TEXT & ~filters.COMMAND, client_awaiting_response_handler)
             ]
         },
-        fallbacks=[CommandHandler('cancel', lambda u, c: u.message.reply_text("تم إلغاء العملية."))],
-        allow_reentry=True
+        fallbacks=[CommandHandler('cancel', cancel)],
+        allow_reentry=True,
+        name="client_conversation",
+        persistent=application.persistence is not None
     )
     
-    dp.add_handler(conv_handler)
-    dp.add_handler(CallbackQueryHandler(global_solve_callback, pattern="^solve\\|"))
-    dp.add_handler(MessageHandler(Filters.text, global_text_handler))
-    
-    updater.start_polling()
-    updater.idle()
+    application.add_handler(conv_handler)
+    application.add_handler(CallbackQueryHandler(global_solve_callback, pattern="^solve\\|"))
+    application.add_handler(MessageHandler(filters.TEXT, global_text_handler))
+    # Conversations other replicas move along (persistence.py)
+    persistence.attach(application)
+    return application
+
+def main():
+    invalidation.start_listener()
+    build_application().run_polling()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -31,6 +31,103 @@ DB_PASSWORD = get_env_var('DB_PASSWORD', '', required=False)
 
 # Construct Database URL
 DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+# Connections each process keeps open to Postgres, and how many more it may open under load
+DB_POOL_SIZE = int(get_env_var('DB_POOL_SIZE', '5', required=False))
+DB_MAX_OVERFLOW = int(get_env_var('DB_MAX_OVERFLOW', '10', required=False))
 
 # Optional: Supervisor chat ID for notifications
 SUPERVISOR_CHAT_ID = get_env_var('SUPERVISOR_CHAT_ID', required=False)
+
+# In-process caches (db.get_subscription, get_supervisors, get_ticket, ...)
+SUBSCRIPTION_CACHE_SIZE = int(get_env_var('SUBSCRIPTION_CACHE_SIZE', '4096', required=False))
+SUBSCRIPTION_CACHE_TTL = float(get_env_var('SUBSCRIPTION_CACHE_TTL', '60', required=False))
+TICKET_CACHE_SIZE = int(get_env_var('TICKET_CACHE_SIZE', '1024', required=False))
+# 0 disables ticket caching until the invalidation listener is running
+TICKET_CACHE_TTL = float(get_env_var('TICKET_CACHE_TTL', '0', required=False))
+# TTL for all caches while the LISTEN/NOTIFY invalidation listener is connected (invalidation.py)
+CACHE_TTL_WITH_INVALIDATION = float(get_env_var('CACHE_TTL_WITH_INVALIDATION', '3600', required=False))
+
+# Bot API endpoint for the bots and outgoing notifications (point at a local fake server for benchmarks)
+TELEGRAM_BASE_URL = get_env_var('TELEGRAM_BASE_URL', 'https://api.telegram.org/bot', required=False)
+TELEGRAM_BASE_FILE_URL = get_env_var('TELEGRAM_BASE_FILE_URL', 'https://api.telegram.org/file/bot', required=False)
+
+# How main.py runs the three bots and the dispatcher: "processes", one process each, or
+# "single", all in one process on one event loop, sharing its DB pool, caches and Bots,
+# or "webhook", as "single" but taking the updates from a webhook (see WEBHOOK_URL)
+RUN_MODE = get_env_var('RUN_MODE', 'processes', required=False)
+
+# Webhook mode (main.py --mode webhook, webhook.py): Telegram POSTs each bot's updates
+# to WEBHOOK_URL/da, /supervisor and /client, e.g. https://bots.example.com/telegram,
+# which a load balancer forwards to the replica listening on WEBHOOK_PORT (one serving
+# at a time: conversations reach other replicas only after a flush, see webhook.py)
+WEBHOOK_URL = get_env_var('WEBHOOK_URL', '', required=False)
+WEBHOOK_LISTEN = get_env_var('WEBHOOK_LISTEN', '0.0.0.0', required=False)
+WEBHOOK_PORT = int(get_env_var('WEBHOOK_PORT', '8443', required=False))
+# Sent by Telegram in X-Telegram-Bot-Api-Secret-Token with every update: 1-256 of A-Z, a-z, 0-9, _ and -
+WEBHOOK_SECRET = get_env_var('WEBHOOK_SECRET', '', required=False)
+# Connections Telegram opens to the webhook at once, per bot (1-100)
+WEBHOOK_MAX_CONNECTIONS = int(get_env_var('WEBHOOK_MAX_CONNECTIONS', '40', required=False))
+
+# Bots (da_bot, supervisor_bot, client_bot): updates each bot handles at once, so
+# one user's slow locus lookup or photo upload doesn't hold up the others; a
+# chat's own updates are still handled one at a time, in order (update_processor.py)
+BOT_CONCURRENT_UPDATES = int(get_env_var('BOT_CONCURRENT_UPDATES', '32', required=False))
+# Updates each bot takes off its queue at once, handled or waiting for their chat or a handler
+BOT_MAX_PENDING_UPDATES = int(get_env_var('BOT_MAX_PENDING_UPDATES', '1000', required=False))
+# Conversation states and user_data in Postgres (persistence.py): changes are written
+# in one batch this many seconds apart, and can then be resumed by another replica
+PERSISTENCE_FLUSH_INTERVAL = float(get_env_var('PERSISTENCE_FLUSH_INTERVAL', '1', required=False))
+# Stored conversations and user_data untouched for this many days are deleted
+PERSISTENCE_RETENTION_DAYS = int(get_env_var('PERSISTENCE_RETENTION_DAYS', '30', required=False))
+# Orders of a DA for a day (da_bot, "add issue")
+LOCUS_API_URL = get_env_var('LOCUS_API_URL', 'https://3e5440qr0c.execute-api.eu-west-3.amazonaws.com/dev/locus_info',
+                            required=False)
+
+# Notification outbox dispatcher (dispatcher.py)
+# Workers per priority lane
+DISPATCHER_WORKERS = int(get_env_var('DISPATCHER_WORKERS', '2', required=False))
+OUTBOX_BATCH_SIZE = int(get_env_var('OUTBOX_BATCH_SIZE', '50', required=False))
+# After this many failed attempts a notification is marked dead and no longer retried
+OUTBOX_MAX_ATTEMPTS = int(get_env_var('OUTBOX_MAX_ATTEMPTS', '8', required=False))
+# Delivered notifications are deleted after this many days
+OUTBOX_RETENTION_DAYS = int(get_env_var('OUTBOX_RETENTION_DAYS', '7', required=False))
+# Priority lanes (notifier.LANES): each lane has its own dispatcher workers, and when
+# lanes compete for a bot's Telegram rate budget each gets this share of it (an idle
+# lane's share goes to the others). "lane=share,..."
+OUTBOX_LANE_SHARES = {lane.strip(): float(share) for lane, share in
+                      (item.split('=') for item in
+                       get_env_var('OUTBOX_LANE_SHARES', 'urgent=0.6,normal=0.3,bulk=0.1',
+                                   required=False).split(',') if item.strip())}
+
+# HTTP connection pool of each Bot API client (notifier.get_bot). Idle connections
+# are kept open this many seconds, so notifications a few seconds apart reuse them.
+TELEGRAM_POOL_SIZE = int(get_env_var('TELEGRAM_POOL_SIZE', '16', required=False))
+TELEGRAM_KEEPALIVE_EXPIRY = float(get_env_var('TELEGRAM_KEEPALIVE_EXPIRY', '60', required=False))
+
+# Supervisor digest mode: new-ticket and client-response notifications to each
+# supervisor are collected for this many seconds and sent as one summary message.
+# 0 sends each one as it happens.
+SUPERVISOR_DIGEST_WINDOW = float(get_env_var('SUPERVISOR_DIGEST_WINDOW', '0', required=False))
+# Comma-separated issue types that are always notified at once, digest mode or not
+URGENT_ISSUE_TYPES = [issue_type.strip() for issue_type in
+                      get_env_var('URGENT_ISSUE_TYPES', '', required=False).split(',') if issue_type.strip()]
+
+# Supervisor assignment: each new ticket goes to one available supervisor (fewest open
+# tickets, preferring one who handled the client before) instead of all of them, and
+# moves to another if it waits ASSIGNMENT_TIMEOUT seconds for them. 0 broadcasts.
+SUPERVISOR_ASSIGNMENT = get_env_var('SUPERVISOR_ASSIGNMENT', '1', required=False) not in ('0', 'false', 'False')
+ASSIGNMENT_TIMEOUT = float(get_env_var('ASSIGNMENT_TIMEOUT', '900', required=False))
+# A supervisor who handled the client before is preferred over one with up to this many fewer open tickets
+ASSIGNMENT_AFFINITY_SLACK = int(get_env_var('ASSIGNMENT_AFFINITY_SLACK', '2', required=False))
+
+# Broadcasts (supervisor bot /broadcast, webapp /broadcasts): recipients are queued in
+# chunks of this many, the next one once fewer than a chunk are still waiting to be sent
+BROADCAST_CHUNK_SIZE = int(get_env_var('BROADCAST_CHUNK_SIZE', '500', required=False))
+# Comma-separated user_ids of the supervisors allowed to /broadcast; empty allows no one
+BROADCAST_ADMIN_IDS = [int(user_id) for user_id in
+                       get_env_var('BROADCAST_ADMIN_IDS', '', required=False).split(',') if user_id.strip()]
+
+# Web dashboard (webapp.py): starting a broadcast from /broadcasts needs this secret;
+# empty leaves the page read-only. Flask's debugger stays off unless WEBAPP_DEBUG is set.
+WEBAPP_ADMIN_SECRET = get_env_var('WEBAPP_ADMIN_SECRET', '', required=False)
+WEBAPP_DEBUG = get_env_var('WEBAPP_DEBUG', '0', required=False) not in ('0', 'false', 'False')
@@ -1,12 +1,20 @@
-from sqlalchemy import Column, Integer, String, Text, ForeignKey, create_engine, text, DateTime  
+from sqlalchemy import Column, Integer, BigInteger, Boolean, String, Text, ForeignKey, Index, Computed, create_engine, text, DateTime, func
 import datetime  
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import declarative_base, relationship, sessionmaker
 from sqlalchemy.pool import QueuePool
 from sqlalchemy.sql import text
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
-import json 
+import asyncio
+import functools
+from collections import namedtuple
+from types import MappingProxyType
+import json
 import logging 
-from config import DATABASE_URL
+from cache import TTLCache
+from config import (DATABASE_URL, DB_POOL_SIZE, DB_MAX_OVERFLOW, SUBSCRIPTION_CACHE_SIZE,
+                    SUBSCRIPTION_CACHE_TTL, TICKET_CACHE_SIZE, TICKET_CACHE_TTL)
 
 logger = logging.getLogger(__name__)
 
@@ -17,8 +25,8 @@ Base = declarative_base()
 engine = create_engine(
     DATABASE_URL,
     poolclass=QueuePool,
-    pool_size=5,
-    max_overflow=10,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
     pool_timeout=30,
     pool_recycle=1800
 )
@@ -37,6 +45,26 @@ def get_connection():
 def get_db_session():
     return SessionLocal()
 
+# Threads that run queries for async code (the bots' handlers), one per connection
+# the pool can hand out, so no more queries wait on the pool than it can serve
+_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE + DB_MAX_OVERFLOW, thread_name_prefix="db")
+
+async def run_async(func, *args, **kwargs):
+    """Await func(*args, **kwargs) on the db threads: a function of this module, or sync code that calls them."""
+    return await asyncio.get_running_loop().run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+# Client Model (tickets and subscriptions reference clients by id; name_key is the
+# normalized name every lookup by name goes through)
+class Client(Base):
+    __tablename__ = "clients"
+
+    client_id = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False)
+    name_key = Column(String, Computed("lower(btrim(name))", persisted=True), nullable=False, unique=True)
+
+    def __repr__(self):
+        return f"<Client(client_id={self.client_id}, name={self.name})>"
+
 # Ticket Model
 class Ticket(Base):
     __tablename__ = "tickets"
@@ -46,18 +74,154 @@ class Ticket(Base):
     issue_description = Column(Text, nullable=False)
     issue_reason = Column(String, nullable=False)
     issue_type = Column(String, nullable=False)
-    client = Column(String, nullable=False)
+    client = Column(String, nullable=False)  # display name, as entered
+    client_id = Column(Integer, ForeignKey("clients.client_id"), nullable=True)
     image_url = Column(String, nullable=True)
     status = Column(String, default="Opened", nullable=False)
     da_id = Column(Integer, nullable=False)
-    logs = Column(Text, nullable=True)
-    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    # user_id of the supervisor the ticket is routed to (assign_supervisor()), and since when
+    assigned_supervisor_id = Column(BigInteger, nullable=True)
+    assigned_at = Column(DateTime, nullable=True)
+    logs = Column(Text, nullable=True)  # legacy JSON history, superseded by ticket_events
+    event_seq = Column(Integer, default=0, server_default="0", nullable=False)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow, server_default=func.now(), nullable=False)
+
+    __table_args__ = (
+        Index("ix_tickets_open_created_at", "created_at", "ticket_id",
+              postgresql_where=text("status <> 'Closed'")),
+        Index("ix_tickets_da_id_created_at", "da_id", "created_at", "ticket_id"),
+        Index("ix_tickets_client_id_created_at", "client_id", "created_at", "ticket_id"),
+        Index("ix_tickets_order_id_pattern", "order_id", postgresql_ops={"order_id": "text_pattern_ops"}),
+        Index("ix_tickets_assigned_open", "assigned_supervisor_id", "assigned_at",
+              postgresql_where=text("status <> 'Closed'")),
+        Index("ix_tickets_order_id_trgm", "order_id", postgresql_using="gin",
+              postgresql_ops={"order_id": "gin_trgm_ops"}),
+    )
 
     def __repr__(self):
         return f"<Ticket(ticket_id={self.ticket_id}, order_id={self.order_id}, status={self.status})>"
 
+# Ticket Event Model (append-only history, one row per status change)
+class TicketEvent(Base):
+    __tablename__ = "ticket_events"
+
+    ticket_id = Column(Integer, ForeignKey("tickets.ticket_id", ondelete="CASCADE"), primary_key=True)
+    seq = Column(Integer, primary_key=True)
+    action = Column(String, nullable=False)
+    message = Column(Text, nullable=True)
+    actor = Column(BigInteger, nullable=True)
+    timestamp = Column(DateTime, server_default=func.now())
+
+    def __repr__(self):
+        return f"<TicketEvent(ticket_id={self.ticket_id}, seq={self.seq}, action={self.action})>"
+
+# Outbox Model (one row per notification to one chat, committed in the same transaction
+# as the write that caused it; dispatcher.py sends them)
+class OutboxMessage(Base):
+    __tablename__ = "outbox"
+
+    id = Column(BigInteger, primary_key=True)
+    bot = Column(String, nullable=False)  # 'DA', 'Supervisor' or 'Client'
+    chat_id = Column(BigInteger, nullable=False)
+    kind = Column(String, nullable=False)  # the notifier function that queued it
+    lane = Column(String, nullable=False, server_default="normal")  # priority lane: notifier.LANES
+    ticket_id = Column(Integer, nullable=True)
+    payload = Column(JSONB, nullable=False)  # text, reply_markup, photo
+    status = Column(String, nullable=False, server_default="pending")  # pending, done or dead
+    attempts = Column(Integer, nullable=False, server_default="0")
+    next_attempt_at = Column(DateTime, nullable=False, server_default=func.now())
+    last_error = Column(Text, nullable=True)
+    message_id = Column(BigInteger, nullable=True)
+    delivered_as = Column(String, nullable=True)  # 'send', 'edit' or 'skip' (nothing to refresh)
+    dedup_key = Column(String, nullable=True)  # queued at most once per (dedup_key, bot, chat_id)
+    created_at = Column(DateTime, server_default=func.now())
+    sent_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        Index("ix_outbox_lane_due", "lane", "next_attempt_at", "id", postgresql_where=text("status = 'pending'")),
+        Index("ix_outbox_digest", "bot", "chat_id",
+              postgresql_where=text("status = 'pending' AND payload->>'mode' = 'digest'")),
+        Index("uq_outbox_dedup", "dedup_key", "bot", "chat_id", unique=True,
+              postgresql_where=text("dedup_key IS NOT NULL")),
+    )
+
+    def __repr__(self):
+        return f"<OutboxMessage(id={self.id}, bot={self.bot}, chat_id={self.chat_id}, status={self.status})>"
+
+# Notification Message Model (the latest message each bot sent a chat about a ticket,
+# which later status changes edit in place instead of sending another)
+class NotificationMessage(Base):
+    __tablename__ = "notification_messages"
+
+    ticket_id = Column(Integer, ForeignKey("tickets.ticket_id", ondelete="CASCADE"), primary_key=True)
+    bot = Column(String, primary_key=True)
+    chat_id = Column(BigInteger, primary_key=True)
+    message_id = Column(BigInteger, nullable=False)
+    has_photo = Column(Boolean, nullable=False, server_default="false")  # edit the caption, not the text
+    text = Column(Text, nullable=False)  # as sent, without the status line refreshes append
+    updated_at = Column(DateTime, server_default=func.now())
+
+    def __repr__(self):
+        return f"<NotificationMessage(ticket_id={self.ticket_id}, bot={self.bot}, chat_id={self.chat_id})>"
+
+# Photo file_id Model (Telegram's id for an image a bot already sent, so later sends
+# of the same image_url don't make Telegram download it again; ids are per bot)
+class PhotoFileId(Base):
+    __tablename__ = "photo_file_ids"
+
+    image_url = Column(String, primary_key=True)
+    bot = Column(String, primary_key=True)  # bot id, the token's prefix
+    file_id = Column(String, nullable=False)
+    created_at = Column(DateTime, server_default=func.now())
+
+    def __repr__(self):
+        return f"<PhotoFileId(bot={self.bot}, image_url={self.image_url})>"
+
+# Broadcast Model (a message to every subscriber of a bot, optionally one client's
+# contacts only, queued into the outbox a chunk at a time; see notifier.advance_broadcasts)
+class Broadcast(Base):
+    __tablename__ = "broadcasts"
+
+    id = Column(Integer, primary_key=True)
+    bot = Column(String, nullable=False)  # 'DA' or 'Client': the sender, and whose subscribers get it
+    client_id = Column(Integer, ForeignKey("clients.client_id"), nullable=True)
+    text = Column(Text, nullable=False)
+    status = Column(String, nullable=False, server_default="running")  # running or done
+    last_subscription_id = Column(Integer, nullable=False, server_default="0")  # checkpoint: last recipient queued
+    total = Column(Integer, nullable=False, server_default="0")  # recipients when it started
+    queued = Column(Integer, nullable=False, server_default="0")
+    delivered = Column(Integer, nullable=True)  # outbox outcomes, recorded when done
+    failed = Column(Integer, nullable=True)
+    created_by = Column(BigInteger, nullable=True)
+    created_at = Column(DateTime, server_default=func.now())
+    finished_at = Column(DateTime, nullable=True)
+
+    def __repr__(self):
+        return f"<Broadcast(id={self.id}, bot={self.bot}, status={self.status})>"
+
+
+class BotState(Base):
+    __tablename__ = "bot_state"
+
+    bot = Column(String, primary_key=True)  # bot id, the token's prefix
+    kind = Column(String, primary_key=True)  # 'user_data' or 'conversation:<handler name>'
+    key = Column(String, primary_key=True)  # user id, or the conversation key as a JSON list
+    data = Column(JSONB, nullable=False)  # the user_data dict, or the conversation state
+    updated_at = Column(DateTime, server_default=func.now(), nullable=False)
+
+    def __repr__(self):
+        return f"<BotState(bot={self.bot}, kind={self.kind}, key={self.key})>"
+
 def init_db():
     with get_connection() as conn:
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS clients (
+                client_id SERIAL PRIMARY KEY,
+                name TEXT NOT NULL,
+                name_key TEXT GENERATED ALWAYS AS (lower(btrim(name))) STORED NOT NULL UNIQUE
+            )
+        """))
+
         # Create subscriptions table with a unique constraint on user_id and chat_id
         conn.execute(text("""
             CREATE TABLE IF NOT EXISTS subscriptions (
@@ -68,9 +232,11 @@ def init_db():
                 role TEXT,
                 bot TEXT,
                 client TEXT,
+                client_id INTEGER REFERENCES clients(client_id),
                 username TEXT,
                 first_name TEXT,
                 last_name TEXT,
+                available BOOLEAN NOT NULL DEFAULT TRUE,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 UNIQUE(user_id, chat_id)
             )
@@ -84,27 +250,350 @@ def init_db():
                 issue_reason TEXT NOT NULL,
                 issue_type TEXT NOT NULL,
                 client TEXT NOT NULL,
+                client_id INTEGER REFERENCES clients(client_id),
                 image_url TEXT,
                 status TEXT DEFAULT 'Opened',
                 da_id BIGINT NOT NULL,
                 logs TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                event_seq INTEGER NOT NULL DEFAULT 0,
+                created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )
+        """))
+        for statement in (
+            "ALTER TABLE tickets ADD COLUMN IF NOT EXISTS event_seq INTEGER NOT NULL DEFAULT 0",
+            "ALTER TABLE tickets ADD COLUMN IF NOT EXISTS assigned_supervisor_id BIGINT",
+            "ALTER TABLE tickets ADD COLUMN IF NOT EXISTS assigned_at TIMESTAMP",
+            "ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS available BOOLEAN NOT NULL DEFAULT TRUE",
+        ):
+            conn.execute(text(statement))
+        for table in ("tickets", "subscriptions"):
+            conn.execute(text(
+                f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS client_id INTEGER REFERENCES clients(client_id)"
+            ))
+        # Rows written before clients existed (or by older code) get their client_id here
+        for statement in CLIENT_BACKFILL_STATEMENTS:
+            conn.execute(text(statement))
+
+        # Append-only ticket history; (ticket_id, seq) doubles as the lookup index
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS ticket_events (
+                ticket_id INTEGER NOT NULL REFERENCES tickets(ticket_id) ON DELETE CASCADE,
+                seq INTEGER NOT NULL,
+                action TEXT NOT NULL,
+                message TEXT,
+                actor BIGINT,
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (ticket_id, seq)
+            )
+        """))
+        # Pagination keys on created_at: legacy tickets without one get their first event's time
+        for statement in TICKET_CREATED_AT_BACKFILL_STATEMENTS:
+            conn.execute(text(statement))
+
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                id BIGSERIAL PRIMARY KEY,
+                bot TEXT NOT NULL,
+                chat_id BIGINT NOT NULL,
+                kind TEXT NOT NULL,
+                lane TEXT NOT NULL DEFAULT 'normal',
+                ticket_id INTEGER,
+                payload JSONB NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                last_error TEXT,
+                message_id BIGINT,
+                delivered_as TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                sent_at TIMESTAMP
+            )
+        """))
+        conn.execute(text("ALTER TABLE outbox ADD COLUMN IF NOT EXISTS delivered_as TEXT"))
+        conn.execute(text("ALTER TABLE outbox ADD COLUMN IF NOT EXISTS dedup_key TEXT"))
+        conn.execute(text("ALTER TABLE outbox ADD COLUMN IF NOT EXISTS lane TEXT NOT NULL DEFAULT 'normal'"))
+
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS notification_messages (
+                ticket_id INTEGER NOT NULL REFERENCES tickets(ticket_id) ON DELETE CASCADE,
+                bot TEXT NOT NULL,
+                chat_id BIGINT NOT NULL,
+                message_id BIGINT NOT NULL,
+                has_photo BOOLEAN NOT NULL DEFAULT FALSE,
+                text TEXT NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (ticket_id, bot, chat_id)
+            )
+        """))
+
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS broadcasts (
+                id SERIAL PRIMARY KEY,
+                bot TEXT NOT NULL,
+                client_id INTEGER REFERENCES clients(client_id),
+                text TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'running',
+                last_subscription_id INTEGER NOT NULL DEFAULT 0,
+                total INTEGER NOT NULL DEFAULT 0,
+                queued INTEGER NOT NULL DEFAULT 0,
+                delivered INTEGER,
+                failed INTEGER,
+                created_by BIGINT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                finished_at TIMESTAMP
+            )
+        """))
+
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS photo_file_ids (
+                image_url TEXT NOT NULL,
+                bot TEXT NOT NULL,
+                file_id TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (image_url, bot)
+            )
+        """))
+
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS bot_state (
+                bot TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL,
+                data JSONB NOT NULL,
+                updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (bot, kind, key)
             )
         """))
+
+        # One index per hot query below; keep in sync with the Alembic migrations
+        for statement in (
+            "CREATE UNIQUE INDEX IF NOT EXISTS uq_subscriptions_user_id_bot ON subscriptions (user_id, bot)",
+            "CREATE INDEX IF NOT EXISTS ix_subscriptions_role_bot ON subscriptions (role, bot)",
+            "CREATE INDEX IF NOT EXISTS ix_subscriptions_client_id_role ON subscriptions (client_id, role)",
+            "CREATE INDEX IF NOT EXISTS ix_tickets_open_created_at ON tickets (created_at, ticket_id) "
+            "WHERE status <> 'Closed'",
+            "CREATE INDEX IF NOT EXISTS ix_tickets_da_id_created_at ON tickets (da_id, created_at, ticket_id)",
+            "CREATE INDEX IF NOT EXISTS ix_tickets_client_id_created_at ON tickets (client_id, created_at, ticket_id)",
+            # Superseded by the client_id indexes
+            "DROP INDEX IF EXISTS ix_subscriptions_role_lower_client",
+            "DROP INDEX IF EXISTS ix_subscriptions_client",
+            "DROP INDEX IF EXISTS ix_tickets_client_created_at",
+            "CREATE INDEX IF NOT EXISTS ix_tickets_order_id_pattern ON tickets (order_id text_pattern_ops)",
+            # assign_supervisor() load counts, claim_overdue_assignment()
+            "CREATE INDEX IF NOT EXISTS ix_tickets_assigned_open ON tickets (assigned_supervisor_id, assigned_at) "
+            "WHERE status <> 'Closed'",
+            # claim_outbox(): only undelivered rows, one lane's in due order
+            "CREATE INDEX IF NOT EXISTS ix_outbox_lane_due ON outbox (lane, next_attempt_at, id) "
+            "WHERE status = 'pending'",
+            # Superseded by ix_outbox_lane_due
+            "DROP INDEX IF EXISTS ix_outbox_due",
+            # enqueue_notifications(digest_window=...) and claim_outbox(): a chat's collected digest entries
+            "CREATE INDEX IF NOT EXISTS ix_outbox_digest ON outbox (bot, chat_id) "
+            "WHERE status = 'pending' AND payload->>'mode' = 'digest'",
+            # enqueue_notifications(dedup_key=...): the ON CONFLICT arbiter
+            "CREATE UNIQUE INDEX IF NOT EXISTS uq_outbox_dedup ON outbox (dedup_key, bot, chat_id) "
+            "WHERE dedup_key IS NOT NULL",
+        ):
+            conn.execute(text(statement))
+        try:
+            with conn.begin_nested():
+                conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+                conn.execute(text(
+                    "CREATE INDEX IF NOT EXISTS ix_tickets_order_id_trgm ON tickets USING gin (order_id gin_trgm_ops)"
+                ))
+        except Exception as e:
+            logger.warning("pg_trgm unavailable, substring order search will scan tickets: %s", e)
         conn.commit()
+
+TICKET_CREATED_AT_BACKFILL_STATEMENTS = (
+    """
+    UPDATE tickets t SET created_at = COALESCE(
+        (SELECT min(e.timestamp) FROM ticket_events e WHERE e.ticket_id = t.ticket_id), 'epoch')
+    WHERE created_at IS NULL
+    """,
+    "ALTER TABLE tickets ALTER COLUMN created_at SET NOT NULL",
+)
+
+# Create a clients row for every distinct normalized client name (keeping the most
+# used spelling) and point tickets and subscriptions at it. Only touches rows
+# without a client_id, so it is cheap to re-run.
+CLIENT_BACKFILL_STATEMENTS = (
+    """
+    INSERT INTO clients (name)
+    SELECT DISTINCT ON (lower(name)) name
+    FROM (
+        SELECT btrim(client) AS name, count(*) AS uses
+        FROM (
+            SELECT client FROM tickets WHERE client_id IS NULL
+            UNION ALL
+            SELECT client FROM subscriptions WHERE client_id IS NULL
+        ) c
+        WHERE btrim(client) <> ''
+        GROUP BY btrim(client)
+    ) n
+    ORDER BY lower(name), uses DESC, name
+    ON CONFLICT (name_key) DO NOTHING
+    """,
+    """
+    UPDATE tickets t SET client_id = c.client_id
+    FROM clients c
+    WHERE t.client_id IS NULL AND c.name_key = lower(btrim(t.client))
+    """,
+    """
+    UPDATE subscriptions s SET client_id = c.client_id
+    FROM clients c
+    WHERE s.client_id IS NULL AND c.name_key = lower(btrim(s.client))
+    """,
+)
+
+# The client_id for the :client name parameter, NULL if there is no such client
+CLIENT_ID_BY_NAME_SQL = "(SELECT client_id FROM clients WHERE name_key = lower(btrim(:client)))"
+
+def get_or_create_client_id(conn, name):
+    """Return the client_id for a client name (matched on its normalized key), creating
+    the client if needed. conn is a Connection or Session; the caller commits."""
+    if name is None or not name.strip():
+        return None
+    return conn.execute(
+        text("""
+            INSERT INTO clients (name) VALUES (btrim(:name))
+            ON CONFLICT (name_key) DO UPDATE SET name = clients.name
+            RETURNING client_id
+        """),
+        {"name": name}
+    ).scalar()
+
+# -----------------------------------------------------------------------------
+# Ticket records
+# -----------------------------------------------------------------------------
+def _record_type(name, fields):
+    """An immutable namedtuple that also supports the ticket['col'] / ticket.get('col')
+    access the bots and templates use, so it can stand in for the old row dicts."""
+    base = namedtuple(name, fields)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        return tuple.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in self._fields else default
+
+    def keys(self):
+        return self._fields
+
+    return type(name, (base,), {"__slots__": (), "__getitem__": __getitem__, "get": get, "keys": keys})
+
+# Full ticket, for single-ticket reads and writes. The legacy logs column is never read.
+TICKET_DETAIL_FIELDS = ("ticket_id", "order_id", "issue_description", "issue_reason", "issue_type",
+                        "client", "image_url", "status", "da_id", "event_seq", "created_at",
+                        "assigned_supervisor_id")
+# List views: the description is cut to what a list entry shows, ending in "…" when cut
+TICKET_SUMMARY_FIELDS = ("ticket_id", "order_id", "issue_description", "issue_reason", "issue_type",
+                         "client", "image_url", "status", "da_id", "created_at")
+DESCRIPTION_PREVIEW_LENGTH = 200
+
+TicketDetail = _record_type("TicketDetail", TICKET_DETAIL_FIELDS)
+TicketSummary = _record_type("TicketSummary", TICKET_SUMMARY_FIELDS)
+
+TICKET_DETAIL_COLUMNS = ", ".join(TICKET_DETAIL_FIELDS)
+TICKET_SUMMARY_COLUMNS = ", ".join(
+    f"CASE WHEN length(issue_description) > {DESCRIPTION_PREVIEW_LENGTH} "
+    f"THEN left(issue_description, {DESCRIPTION_PREVIEW_LENGTH - 1}) || '…' "
+    f"ELSE issue_description END AS issue_description"
+    if field == "issue_description" else field
+    for field in TICKET_SUMMARY_FIELDS
+)
+# Summary fields with the whole description, for lists with no detail view to open
+TICKET_LIST_COLUMNS = ", ".join(TICKET_SUMMARY_FIELDS)
+
+def _summaries(rows):
+    return [TicketSummary._make(row) for row in rows]
+
 def get_all_tickets():
     with get_connection() as conn:
-        result = conn.execute(text("SELECT * FROM tickets")).fetchall()
-    return [dict(row._mapping) for row in result] if result else []
-def get_subscription(user_id, bot):
+        result = conn.execute(text(f"SELECT {TICKET_SUMMARY_COLUMNS} FROM tickets")).fetchall()
+    return _summaries(result)
+# -----------------------------------------------------------------------------
+# Caches and cross-process invalidation
+# -----------------------------------------------------------------------------
+# Subscriptions change rarely, so the per-user lookups and the fan-out lists are
+# served from process-local caches; add_subscription() invalidates them. Cached
+# rows are shared between callers and therefore read-only.
+subscription_cache = TTLCache(maxsize=SUBSCRIPTION_CACHE_SIZE, ttl=SUBSCRIPTION_CACHE_TTL)
+subscription_list_cache = TTLCache(maxsize=256, ttl=SUBSCRIPTION_CACHE_TTL)
+# get_ticket(); only worth enabling together with the invalidation listener
+ticket_cache = TTLCache(maxsize=TICKET_CACHE_SIZE, ttl=TICKET_CACHE_TTL)
+
+# Every write that affects a cache also sends a NOTIFY on this channel, in the same
+# transaction, so it is delivered only on commit. invalidation.py listens for them
+# in the other processes and calls apply_invalidation().
+INVALIDATION_CHANNEL = "ftbot_cache_invalidation"
+# Called with each "bot_state" message from save_bot_state() (persistence.py)
+bot_state_listeners = []
+
+def _notify_invalidation(conn, kind, **key):
+    """Queue an invalidation message on conn (a Connection or Session) for other processes."""
+    conn.execute(
+        text("SELECT pg_notify(:channel, :payload)"),
+        {"channel": INVALIDATION_CHANNEL, "payload": json.dumps(dict(key, kind=kind))}
+    )
+
+def apply_invalidation(payload):
+    """Evict the cache entries named by a NOTIFY payload from _notify_invalidation()."""
+    message = json.loads(payload)
+    kind = message.get("kind")
+    if kind == "subscription":
+        invalidate_subscription(message["user_id"], message["bot"])
+    elif kind == "ticket":
+        invalidate_ticket(message["ticket_id"])
+    elif kind == "bot_state":
+        for listener in bot_state_listeners:
+            listener(message)
+    else:
+        logger.warning("Unknown cache invalidation message: %s", payload)
+
+def clear_caches():
+    subscription_cache.clear()
+    subscription_list_cache.clear()
+    ticket_cache.clear()
+
+def set_cache_ttl(subscription_ttl, ticket_ttl):
+    subscription_cache.ttl = subscription_list_cache.ttl = subscription_ttl
+    ticket_cache.ttl = ticket_ttl
+
+def invalidate_ticket(ticket_id):
+    ticket_cache.invalidate(ticket_id)
+
+def _subscription_row(row):
+    return MappingProxyType(dict(row._mapping))
+
+def _subscription_rows(rows):
+    return tuple(_subscription_row(row) for row in rows)
+
+def invalidate_subscription(user_id, bot):
+    """Drop everything cached about a subscription after it changed."""
+    subscription_cache.invalidate((user_id, bot))
+    # Role or client changes move the user between fan-out lists
+    subscription_list_cache.clear()
+
+def cache_stats():
+    return {"subscriptions": subscription_cache.stats(), "lists": subscription_list_cache.stats(),
+            "tickets": ticket_cache.stats(), "photo_file_ids": photo_file_id_cache.stats()}
+
+def _load_subscription(user_id, bot):
     with get_connection() as conn:
         result = conn.execute(
             text("SELECT * FROM subscriptions WHERE user_id = :user_id AND bot = :bot"),
             {"user_id": user_id, "bot": bot}
         ).fetchone()
-    if not result:
-        return None
-    return dict(result._mapping)
+    return _subscription_row(result) if result else None
+
+def get_subscription(user_id, bot):
+    return subscription_cache.get_or_load((user_id, bot), lambda: _load_subscription(user_id, bot))
 def get_user(user_id, bot):
     return get_subscription(user_id, bot)
 def update_ticket_details(ticket_id, new_description):
@@ -116,7 +605,9 @@ def update_ticket_details(ticket_id, new_description):
             logger.error("Ticket with ID %s not found!", ticket_id)
             return False
         ticket.issue_description = new_description
+        _notify_invalidation(session, "ticket", ticket_id=ticket_id)
         session.commit()
+        invalidate_ticket(ticket_id)
         return True
     except Exception as e:
         session.rollback()
@@ -126,10 +617,14 @@ def update_ticket_details(ticket_id, new_description):
         session.close()
 
 def get_users_by_role(role, client=None):
+    key = ("users_by_role", role.capitalize(), client.strip().lower() if client else None)
+    return subscription_list_cache.get_or_load(key, lambda: _load_users_by_role(role, client))
+
+def _load_users_by_role(role, client):
     with get_connection() as conn:
         if client:
             result = conn.execute(
-                text("SELECT * FROM subscriptions WHERE role = :role AND LOWER(client) = LOWER(:client)"),
+                text(f"SELECT * FROM subscriptions WHERE client_id = {CLIENT_ID_BY_NAME_SQL} AND role = :role"),
                 {"role": role.capitalize(), "client": client}
             )
         else:
@@ -138,7 +633,7 @@ def get_users_by_role(role, client=None):
                 {"role": role.capitalize()}
             )
         users = result.fetchall()
-    return [dict(row._mapping) for row in users] if users else []
+    return _subscription_rows(users)
 
 def add_subscription(user_id, phone, role, bot, client, username, first_name, last_name, chat_id):
     """Insert or update a subscription into the database."""
@@ -146,11 +641,12 @@ def add_subscription(user_id, phone, role, bot, client, username, first_name, la
         conn.execute(
             text("""
                 INSERT INTO subscriptions 
-                (user_id, phone, role, bot, client, username, first_name, last_name, chat_id)
-                VALUES (:user_id, :phone, :role, :bot, :client, :username, :first_name, :last_name, :chat_id)
+                (user_id, phone, role, bot, client, client_id, username, first_name, last_name, chat_id)
+                VALUES (:user_id, :phone, :role, :bot, :client, :client_id, :username, :first_name, :last_name, :chat_id)
                 ON CONFLICT (user_id, bot) DO UPDATE SET 
                     phone = EXCLUDED.phone,
                     client = EXCLUDED.client,
+                    client_id = EXCLUDED.client_id,
                     username = EXCLUDED.username,
                     first_name = EXCLUDED.first_name,
                     last_name = EXCLUDED.last_name
@@ -161,14 +657,24 @@ def add_subscription(user_id, phone, role, bot, client, username, first_name, la
                 "role": role,
                 "bot": bot,
                 "client": client,
+                "client_id": get_or_create_client_id(conn, client),
                 "username": username,
                 "first_name": first_name,
                 "last_name": last_name,
                 "chat_id": chat_id
             }
         )
+        _notify_invalidation(conn, "subscription", user_id=user_id, bot=bot)
         conn.commit()
-def add_ticket(order_id, issue_description, issue_reason, issue_type, client, image_url, status, da_id):
+    invalidate_subscription(user_id, bot)
+def add_ticket(order_id, issue_description, issue_reason, issue_type, client, image_url, status, da_id,
+               notify=None):
+    """Insert a ticket and return its id, or None on failure.
+
+    notify(conn, ticket), if given, runs inside the same transaction after the
+    insert (e.g. a notifier function queueing outbox rows), so the ticket and its
+    notifications are committed together or not at all.
+    """
     session = get_db_session()
     try:
         new_ticket = Ticket(
@@ -177,11 +683,20 @@ def add_ticket(order_id, issue_description, issue_reason, issue_type, client, im
             issue_reason=issue_reason,
             issue_type=issue_type,
             client=client,
+            client_id=get_or_create_client_id(session, client),
             image_url=image_url,
             status=status,
             da_id=da_id
         )
         session.add(new_ticket)
+        session.flush()
+        _notify_invalidation(session, "ticket", ticket_id=new_ticket.ticket_id)
+        if notify:
+            row = session.execute(
+                text(f"SELECT {TICKET_DETAIL_COLUMNS} FROM tickets WHERE ticket_id = :ticket_id"),
+                {"ticket_id": new_ticket.ticket_id}
+            ).fetchone()
+            notify(session, TicketDetail._make(row))
         session.commit()
         return new_ticket.ticket_id
     except Exception as e:
@@ -194,103 +709,356 @@ def add_ticket(order_id, issue_description, issue_reason, issue_type, client, im
 def get_all_open_tickets():
     with get_connection() as conn:
         result = conn.execute(
-            text("SELECT * FROM tickets WHERE status != 'Closed'")
+            text(f"SELECT {TICKET_SUMMARY_COLUMNS} FROM tickets WHERE status != 'Closed'")
         ).fetchall()
-    return [dict(row._mapping) for row in result] if result else []
+    return _summaries(result)
 
 def get_tickets_by_user(user_id):
     with get_connection() as conn:
         result = conn.execute(
-            text("SELECT * FROM tickets WHERE da_id = :user_id"),
+            text(f"SELECT {TICKET_SUMMARY_COLUMNS} FROM tickets WHERE da_id = :user_id"),
             {"user_id": user_id}
         ).fetchall()
-    return [dict(row._mapping) for row in result] if result else []
+    return _summaries(result)
 
 def get_ticket(ticket_id):
+    return ticket_cache.get_or_load(ticket_id, lambda: _load_ticket(ticket_id))
+
+def _load_ticket(ticket_id):
     with get_connection() as conn:
         result = conn.execute(
-            text("SELECT * FROM tickets WHERE ticket_id = :ticket_id"),
+            text(f"SELECT {TICKET_DETAIL_COLUMNS} FROM tickets WHERE ticket_id = :ticket_id"),
             {"ticket_id": ticket_id}
         ).fetchone()
-    return dict(result._mapping) if result else None
+    return TicketDetail._make(result) if result else None
 
-def update_ticket_status(ticket_id, new_status, log_entry=None):
-    session = get_db_session()
+# -----------------------------------------------------------------------------
+# Ticket state machine
+# -----------------------------------------------------------------------------
+OPEN_STATUSES = (
+    "Opened",
+    "Pending DA Action",
+    "Awaiting Client Response",
+    "Client Responded",
+    "Client Ignored",
+    "Additional Info Provided",
+    "Pending DA Response",
+)
+# Statuses in which the client has not answered yet
+CLIENT_PENDING_STATUSES = tuple(
+    s for s in OPEN_STATUSES if s not in ("Client Responded", "Client Ignored")
+)
+
+# Statuses in which the ticket waits for a supervisor (see claim_overdue_assignment())
+SUPERVISOR_PENDING_STATUSES = ("Opened", "Client Responded", "Client Ignored", "Additional Info Provided")
+
+# action -> (new status, statuses the ticket must currently be in)
+TICKET_TRANSITIONS = {
+    "supervisor_solution": ("Pending DA Action", OPEN_STATUSES),
+    "supervisor_moreinfo": ("Pending DA Response", OPEN_STATUSES),
+    "supervisor_forward": ("Pending DA Action", ("Client Responded", "Client Ignored")),
+    "da_moreinfo": ("Additional Info Provided", ("Pending DA Response", "Additional Info Provided")),
+    "da_closed": ("Closed", OPEN_STATUSES),
+    "client_solution": ("Client Responded", CLIENT_PENDING_STATUSES),
+    "client_ignored": ("Client Responded", CLIENT_PENDING_STATUSES),
+}
+SUPERVISOR_ACTIONS = ("supervisor_solution", "supervisor_moreinfo", "supervisor_forward")
+
+def _transition(ticket_id, new_status, action, message, actor, allowed_from, notify=None):
+    """Run the status UPDATE (and event INSERT) as one statement.
+
+    Returns (ticket, applied). When allowed_from is given the UPDATE only matches
+    tickets currently in one of those statuses whose latest event is not this same
+    action and message; otherwise the current row is returned with applied=False. ticket is None if the ticket does not exist.
+    notify(conn, ticket) runs in the same transaction, only if the update applied.
+    """
+    guard = " AND status = ANY(:allowed_from)" if allowed_from is not None else ""
+    dedup = bool(action and allowed_from is not None)
+    if dedup:
+        # The same action with the same message twice in a row (a double-tapped button, a
+        # retried handler) is a duplicate, not a new event: one primary-key lookup
+        guard += """
+                  AND NOT EXISTS (
+                      SELECT 1 FROM ticket_events e
+                      WHERE e.ticket_id = tickets.ticket_id AND e.seq = tickets.event_seq
+                        AND e.action = :action AND e.message IS NOT DISTINCT FROM :message
+                  )"""
+    # A supervisor acting on a ticket takes it over from its assignee
+    takeover = action in SUPERVISOR_ACTIONS and actor is not None
+    assign = ", assigned_supervisor_id = :actor, assigned_at = CURRENT_TIMESTAMP" if takeover else ""
+    if action:
+        updated = f"""
+            updated AS (
+                UPDATE tickets
+                SET status = :status, event_seq = event_seq + 1{assign}
+                WHERE ticket_id = :ticket_id{guard}
+                RETURNING {TICKET_DETAIL_COLUMNS}
+            ), event AS (
+                INSERT INTO ticket_events (ticket_id, seq, action, message, actor)
+                SELECT ticket_id, event_seq, :action, :message, :actor FROM updated
+            )"""
+    else:
+        updated = f"""
+            updated AS (
+                UPDATE tickets SET status = :status
+                WHERE ticket_id = :ticket_id{guard}
+                RETURNING {TICKET_DETAIL_COLUMNS}
+            )"""
+    statement = text(f"""
+        WITH {updated}
+        SELECT {TICKET_DETAIL_COLUMNS}, TRUE AS applied FROM updated
+        UNION ALL
+        SELECT {TICKET_DETAIL_COLUMNS}, FALSE AS applied FROM tickets
+        WHERE ticket_id = :ticket_id AND NOT EXISTS (SELECT 1 FROM updated)
+    """)
+    params = {"status": new_status, "ticket_id": ticket_id}
+    if action:
+        params.update(action=action, message=message, actor=actor)
+    if allowed_from is not None:
+        params["allowed_from"] = list(allowed_from)
     try:
-        ticket = session.query(Ticket).filter(Ticket.ticket_id == ticket_id).first()
-        if not ticket:
-            logger.error("Ticket with ID %s not found!", ticket_id)
-            return False
-        ticket.status = new_status
-        if log_entry:
-            logs = []
-            if ticket.logs:
-                try:
-                    logs = json.loads(ticket.logs)
-                except Exception as e:
-                    logger.error("Error parsing logs for ticket %s: %s", ticket_id, e)
-            log_entry["timestamp"] = datetime.datetime.now().isoformat()
-            logs.append(log_entry)
-            ticket.logs = json.dumps(logs)
-        session.commit()
-        # Refresh ticket so that subsequent queries see updated data
-        session.refresh(ticket)
-        return True
+        with get_connection() as conn:
+            if dedup:
+                # Wait for a concurrent transition first, so the statement's snapshot
+                # includes the event it wrote
+                conn.execute(text("SELECT 1 FROM tickets WHERE ticket_id = :ticket_id FOR UPDATE"),
+                             {"ticket_id": ticket_id})
+            result = conn.execute(statement, params).fetchone()
+            if result and result.applied:
+                _notify_invalidation(conn, "ticket", ticket_id=ticket_id)
+                if notify:
+                    notify(conn, TicketDetail._make(result[:-1]))
+            conn.commit()
     except Exception as e:
-        session.rollback()
         logger.error("Error updating ticket %s: %s", ticket_id, e)
-        return False
-    finally:
-        session.close()
+        return None, False
+    if not result:
+        logger.error("Ticket with ID %s not found!", ticket_id)
+        return None, False
+    *columns, applied = result
+    if applied:
+        invalidate_ticket(ticket_id)
+    return TicketDetail._make(columns), applied
+
+def apply_transition(ticket_id, action, message=None, actor=None, notify=None):
+    """Apply a named transition from TICKET_TRANSITIONS as a compare-and-set.
+
+    Returns (ticket, applied): applied is False when the ticket's current status
+    does not allow the transition, or it would repeat the latest event exactly, in
+    which case ticket is the unchanged row.
+    ticket is None if the ticket does not exist. notify(conn, ticket) queues the
+    transition's notifications in the same transaction (see add_ticket()).
+    """
+    new_status, allowed_from = TICKET_TRANSITIONS[action]
+    ticket, applied = _transition(ticket_id, new_status, action, message, actor, allowed_from, notify)
+    if ticket and not applied:
+        logger.info("Ticket %s: transition %s rejected in status %s", ticket_id, action, ticket["status"])
+    return ticket, applied
+
+def transition_ticket(ticket_id, new_status, action=None, message=None, actor=None):
+    """Unconditionally change the ticket status and append its event in a single statement.
+
+    Returns the updated ticket row, or None if the ticket does not exist or the
+    write failed. The status UPDATE bumps tickets.event_seq under the row lock, so
+    concurrent transitions get distinct sequence numbers without reading the history.
+    """
+    ticket, _ = _transition(ticket_id, new_status, action, message, actor, None)
+    return ticket
+
+def update_ticket_status(ticket_id, new_status, log_entry=None, actor=None):
+    """Boolean wrapper around transition_ticket() for callers that don't need the row."""
+    log_entry = log_entry or {}
+    ticket = transition_ticket(ticket_id, new_status, log_entry.get("action"), log_entry.get("message"), actor)
+    return ticket is not None
+
+def get_ticket_events(ticket_id):
+    """Return the ticket history in the order it was written."""
+    with get_connection() as conn:
+        result = conn.execute(
+            text("""
+                SELECT seq, action, message, actor, timestamp
+                FROM ticket_events
+                WHERE ticket_id = :ticket_id
+                ORDER BY seq
+            """),
+            {"ticket_id": ticket_id}
+        ).fetchall()
+    return [dict(row._mapping) for row in result] if result else []
+
+def get_latest_ticket_event(ticket_id, action):
+    """Return the most recent event with the given action for a ticket, or None."""
+    with get_connection() as conn:
+        result = conn.execute(
+            text("""
+                SELECT seq, action, message, actor, timestamp
+                FROM ticket_events
+                WHERE ticket_id = :ticket_id AND action = :action
+                ORDER BY seq DESC
+                LIMIT 1
+            """),
+            {"ticket_id": ticket_id, "action": action}
+        ).fetchone()
+    return dict(result._mapping) if result else None
+
 def get_tickets_by_client(user_id):
-    """Retrieve all tickets for a given client using the user's subscription information."""
+    """Retrieve all tickets for the client a Client-bot subscriber represents."""
     with get_connection() as conn:
-        # First, fetch the subscription for the client bot using the user ID
         result = conn.execute(
-            text("SELECT client FROM subscriptions WHERE user_id = :user_id AND bot = 'Client'"),
+            text(f"""
+                SELECT {TICKET_SUMMARY_COLUMNS} FROM tickets
+                WHERE client_id = (SELECT client_id FROM subscriptions WHERE user_id = :user_id AND bot = 'Client')
+            """),
             {"user_id": user_id}
-        ).fetchone()
-        
-        if not result:
-            logger.warning(f"No subscription found for user ID: {user_id} (Client bot)")
-            return []
-        
-        # Get the client name from the subscription
-        client_name = result[0]
-        if not client_name:
-            logger.warning(f"Subscription found for user ID: {user_id} but client name is missing")
-            return []
-        
-        logger.info(f"Found client '{client_name}' for user ID: {user_id}")
-        
-        # Now, fetch tickets where the 'client' field matches the subscription's client name
-        tickets = conn.execute(
-            text("SELECT * FROM tickets WHERE client = :client"),
-            {"client": client_name}
         ).fetchall()
-        
-        return [dict(row._mapping) for row in tickets] if tickets else []
+    return _summaries(result)
 
-def search_tickets_by_order(order_id):
-    with engine.connect() as conn:
-        result = conn.execute(
-            text("SELECT * FROM tickets WHERE order_id ILIKE :order_id"),
-            {"order_id": f"%{order_id}%"}
+# -----------------------------------------------------------------------------
+# Keyset pagination
+# -----------------------------------------------------------------------------
+DEFAULT_PAGE_SIZE = 50
+
+def encode_cursor(cursor):
+    """Serialize a (created_at, ticket_id) cursor for callback data and URLs."""
+    created_at, ticket_id = cursor
+    return f"{created_at.isoformat()},{ticket_id}"
+
+def decode_cursor(value):
+    """Inverse of encode_cursor(); returns None for a missing or malformed cursor."""
+    if not value:
+        return None
+    try:
+        created_at, ticket_id = value.rsplit(",", 1)
+        return datetime.datetime.fromisoformat(created_at), int(ticket_id)
+    except ValueError:
+        return None
+
+def get_tickets_page(cursor=None, page_size=DEFAULT_PAGE_SIZE, status=None, client=None, reason=None,
+                     issue_type=None, da_id=None, client_user_id=None, open_only=False, full_description=False):
+    """Return one page of tickets, newest first, and the cursor of the next page.
+
+    cursor is the (created_at, ticket_id) pair returned by the previous call and
+    next_cursor is None on the last page. The remaining arguments are optional
+    equality filters; client_user_id restricts the page to the client of that
+    Client-bot subscriber and open_only skips closed tickets. Descriptions are
+    previews unless full_description, for lists that are the only place a
+    ticket's description is shown.
+    """
+    page_size = max(1, page_size)
+    conditions = []
+    params = {"limit": page_size + 1}
+    if cursor:
+        conditions.append("(created_at, ticket_id) < (:cursor_created_at, :cursor_ticket_id)")
+        params["cursor_created_at"], params["cursor_ticket_id"] = cursor
+    if open_only:
+        conditions.append("status <> 'Closed'")
+    for column, value in (("status", status), ("issue_reason", reason),
+                          ("issue_type", issue_type), ("da_id", da_id)):
+        if value is not None:
+            conditions.append(f"{column} = :{column}")
+            params[column] = value
+    if client is not None:
+        conditions.append(f"client_id = {CLIENT_ID_BY_NAME_SQL}")
+        params["client"] = client
+    if client_user_id is not None:
+        conditions.append(
+            "client_id = (SELECT client_id FROM subscriptions WHERE user_id = :client_user_id AND bot = 'Client')"
         )
-        tickets = result.fetchall()
-    processed = []
-    for ticket in tickets:
-        try:
-            if hasattr(ticket, "_mapping"):
-                processed.append(dict(ticket._mapping))
-            elif isinstance(ticket, dict):
-                processed.append(ticket)
-            else:
-                processed.append(dict(ticket))
-        except Exception as e:
-            # Log the error and skip this ticket
-            logging.error("Error converting ticket %s: %s", ticket, e)
-    return processed
+        params["client_user_id"] = client_user_id
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    with get_connection() as conn:
+        result = conn.execute(
+            text(f"""
+                SELECT {TICKET_LIST_COLUMNS if full_description else TICKET_SUMMARY_COLUMNS} FROM tickets
+                {where}
+                ORDER BY created_at DESC, ticket_id DESC
+                LIMIT :limit
+            """),
+            params
+        ).fetchall()
+    tickets = _summaries(result[:page_size])
+    next_cursor = None
+    if len(result) > page_size:
+        last = tickets[-1]
+        next_cursor = (last["created_at"], last["ticket_id"])
+    return tickets, next_cursor
+
+def get_all_tickets_page(cursor=None, page_size=DEFAULT_PAGE_SIZE, **filters):
+    return get_tickets_page(cursor, page_size, **filters)
+
+def get_open_tickets_page(cursor=None, page_size=DEFAULT_PAGE_SIZE, **filters):
+    return get_tickets_page(cursor, page_size, open_only=True, **filters)
+
+def get_tickets_by_user_page(user_id, cursor=None, page_size=DEFAULT_PAGE_SIZE, **filters):
+    return get_tickets_page(cursor, page_size, da_id=user_id, **filters)
+
+def get_tickets_by_client_page(user_id, cursor=None, page_size=DEFAULT_PAGE_SIZE, **filters):
+    return get_tickets_page(cursor, page_size, client_user_id=user_id, **filters)
+
+def _escape_like(value):
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+# Order-id search tiers, tried in this order. Exact and prefix matches are
+# served by ix_tickets_order_id_pattern (text_pattern_ops); substring matches
+# by the pg_trgm GIN index ix_tickets_order_id_trgm, ranked by match position.
+ORDER_SEARCH_QUERIES = {
+    "exact": f"""
+        SELECT {TICKET_SUMMARY_COLUMNS} FROM tickets
+        WHERE order_id = :q
+        ORDER BY ticket_id DESC
+        LIMIT :limit
+    """,
+    "prefix": f"""
+        SELECT {TICKET_SUMMARY_COLUMNS} FROM tickets
+        WHERE order_id LIKE :prefix AND order_id <> :q
+        ORDER BY order_id USING ~<~, ticket_id DESC
+        LIMIT :limit
+    """,
+    "substring": f"""
+        SELECT {TICKET_SUMMARY_COLUMNS} FROM tickets
+        WHERE order_id ILIKE :contains AND order_id NOT LIKE :prefix
+        ORDER BY strpos(lower(order_id), lower(:q)), length(order_id), ticket_id DESC
+        LIMIT :limit
+    """,
+    # Shorter than a trigram: newest first along the primary key, which stops
+    # at the first :limit matches instead of ranking every one
+    "short_substring": f"""
+        SELECT {TICKET_SUMMARY_COLUMNS} FROM tickets
+        WHERE order_id ILIKE :contains AND order_id NOT LIKE :prefix
+        ORDER BY ticket_id DESC
+        LIMIT :limit
+    """,
+}
+# Trigram indexes cannot narrow patterns shorter than one trigram
+MIN_SUBSTRING_SEARCH_LENGTH = 3
+
+def search_tickets_by_order(order_id, limit=20, mode="auto"):
+    """Search tickets by order id, best matches first, at most `limit` results.
+
+    mode is "exact", "prefix", "substring" or "auto", which tries the three in
+    that order and stops as soon as `limit` tickets were found. Substring
+    matches of a query shorter than MIN_SUBSTRING_SEARCH_LENGTH come newest
+    first rather than ranked.
+    """
+    q = order_id.strip()
+    if not q:
+        return []
+    modes = ("exact", "prefix", "substring") if mode == "auto" else (mode,)
+    if len(q) < MIN_SUBSTRING_SEARCH_LENGTH:
+        modes = tuple("short_substring" if tier == "substring" else tier for tier in modes)
+    escaped = _escape_like(q)
+    params = {"q": q, "prefix": f"{escaped}%", "contains": f"%{escaped}%"}
+    tickets = []
+    with get_connection() as conn:
+        for tier in modes:
+            result = conn.execute(
+                text(ORDER_SEARCH_QUERIES[tier]),
+                dict(params, limit=limit - len(tickets))
+            ).fetchall()
+            tickets.extend(_summaries(result))
+            if len(tickets) >= limit:
+                break
+    return tickets
+
 def get_all_subscriptions():
     with get_connection() as conn:
         result = conn.execute(text("SELECT * FROM subscriptions")).fetchall()
@@ -298,21 +1066,587 @@ def get_all_subscriptions():
 
 def get_supervisors():
     """Retrieve all subscriptions for supervisors (bot='Supervisor' and role='Supervisor')."""
+    return subscription_list_cache.get_or_load(("supervisors",), _load_supervisors)
+
+def _load_supervisors():
     with get_connection() as conn:
         result = conn.execute(
             text("SELECT * FROM subscriptions WHERE role = :role AND bot = 'Supervisor'"),
             {"role": "Supervisor"}
         ).fetchall()
-    return [dict(row._mapping) for row in result] if result else []
+    return _subscription_rows(result)
 
 def get_clients_by_name(client_name):
     """Retrieve all subscriptions with the given client name (for Client role)."""
+    key = ("clients", client_name.strip().lower() if client_name else None)
+    return subscription_list_cache.get_or_load(key, lambda: _load_clients_by_name(client_name))
+
+def _load_clients_by_name(client_name):
     with get_connection() as conn:
         result = conn.execute(
-            text("SELECT * FROM subscriptions WHERE client = :client"),
+            text(f"SELECT * FROM subscriptions WHERE client_id = {CLIENT_ID_BY_NAME_SQL}"),
             {"client": client_name}
         ).fetchall()
-    return [dict(row._mapping) for row in result] if result else []
+    return _subscription_rows(result)
+
+# -----------------------------------------------------------------------------
+# Photo file_ids
+# -----------------------------------------------------------------------------
+# A file_id never changes once issued, so entries are only dropped when Telegram
+# rejects one; the TTL just bounds how long another process's new id goes unseen.
+photo_file_id_cache = TTLCache(maxsize=4096, ttl=600)
+
+def get_photo_file_id(image_url, bot):
+    """The file_id `bot` got when it last sent image_url, or None."""
+    return photo_file_id_cache.get_or_load((image_url, bot), lambda: _load_photo_file_id(image_url, bot))
+
+def _load_photo_file_id(image_url, bot):
+    with get_connection() as conn:
+        return conn.execute(
+            text("SELECT file_id FROM photo_file_ids WHERE image_url = :image_url AND bot = :bot"),
+            {"image_url": image_url, "bot": bot}
+        ).scalar()
+
+def set_photo_file_id(image_url, bot, file_id):
+    try:
+        with get_connection() as conn:
+            conn.execute(
+                text("""
+                    INSERT INTO photo_file_ids (image_url, bot, file_id) VALUES (:image_url, :bot, :file_id)
+                    ON CONFLICT (image_url, bot) DO UPDATE SET file_id = EXCLUDED.file_id
+                """),
+                {"image_url": image_url, "bot": bot, "file_id": file_id}
+            )
+            conn.commit()
+    except Exception as e:
+        logger.error("Error storing file_id for %s: %s", image_url, e)
+        return
+    photo_file_id_cache.set((image_url, bot), file_id)
+
+def forget_photo_file_id(image_url, bot, file_id):
+    """Drop a file_id Telegram rejected (unless another send already replaced it)."""
+    photo_file_id_cache.invalidate((image_url, bot))
+    with get_connection() as conn:
+        conn.execute(
+            text("DELETE FROM photo_file_ids WHERE image_url = :image_url AND bot = :bot AND file_id = :file_id"),
+            {"image_url": image_url, "bot": bot, "file_id": file_id}
+        )
+        conn.commit()
+
+# -----------------------------------------------------------------------------
+# Supervisor assignment
+# -----------------------------------------------------------------------------
+# Any constant works; it only has to differ from other advisory locks on the database
+ASSIGNMENT_LOCK_KEY = 0x66746273
+
+def assign_supervisor(conn, ticket_id, exclude=(), affinity_slack=2):
+    """Route ticket_id to the available supervisor with the fewest open tickets, on conn.
+
+    A supervisor who was assigned a ticket of the same client before counts as
+    affinity_slack tickets less loaded. Supervisors in exclude are passed over.
+    Assignments are serialized with an advisory lock, so concurrent tickets see each
+    other's load. Returns the chosen subscription's (user_id, chat_id), or None if no
+    supervisor is available (the ticket is left as it was). Call invalidate_ticket()
+    after committing.
+    """
+    conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": ASSIGNMENT_LOCK_KEY})
+    assigned = conn.execute(
+        text("""
+            WITH chosen AS (
+                SELECT s.user_id, s.chat_id
+                FROM subscriptions s
+                CROSS JOIN LATERAL (
+                    SELECT count(*) AS open_tickets FROM tickets t
+                    WHERE t.assigned_supervisor_id = s.user_id AND t.status <> 'Closed'
+                ) load
+                CROSS JOIN LATERAL (
+                    SELECT EXISTS (
+                        SELECT 1 FROM tickets t
+                        WHERE t.client_id = (SELECT client_id FROM tickets WHERE ticket_id = :ticket_id)
+                          AND t.assigned_supervisor_id = s.user_id AND t.ticket_id <> :ticket_id
+                    ) AS has_client
+                ) affinity
+                WHERE s.role = 'Supervisor' AND s.bot = 'Supervisor' AND s.available
+                  AND s.user_id <> ALL(CAST(:exclude AS BIGINT[]))
+                ORDER BY load.open_tickets - CASE WHEN affinity.has_client THEN :slack ELSE 0 END,
+                         load.open_tickets, s.user_id
+                LIMIT 1
+            )
+            UPDATE tickets t
+            SET assigned_supervisor_id = chosen.user_id, assigned_at = CURRENT_TIMESTAMP
+            FROM chosen
+            WHERE t.ticket_id = :ticket_id
+            RETURNING chosen.user_id, chosen.chat_id
+        """),
+        {"ticket_id": ticket_id, "exclude": list(exclude), "slack": affinity_slack}
+    ).fetchone()
+    if assigned:
+        _notify_invalidation(conn, "ticket", ticket_id=ticket_id)
+    return assigned
+
+def touch_assignment(conn, ticket_id):
+    """Restart the assignee's reassignment timeout: the ticket needs them again."""
+    conn.execute(
+        text("UPDATE tickets SET assigned_at = CURRENT_TIMESTAMP WHERE ticket_id = :ticket_id"),
+        {"ticket_id": ticket_id}
+    )
+
+def claim_overdue_assignment(conn, timeout_seconds):
+    """Lock one ticket that has waited for its assignee longer than timeout_seconds, on conn.
+
+    Returns the ticket (TicketDetail) or None. SKIP LOCKED lets several dispatchers
+    look for overdue tickets at once.
+    """
+    row = conn.execute(
+        text(f"""
+            SELECT {TICKET_DETAIL_COLUMNS} FROM tickets
+            WHERE status <> 'Closed' AND status = ANY(:pending)
+              AND assigned_supervisor_id IS NOT NULL
+              AND assigned_at < CURRENT_TIMESTAMP - make_interval(secs => :timeout)
+            ORDER BY assigned_at
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        """),
+        {"pending": list(SUPERVISOR_PENDING_STATUSES), "timeout": timeout_seconds}
+    ).fetchone()
+    return TicketDetail._make(row) if row else None
+
+def set_supervisor_available(user_id, available):
+    """Take a supervisor in or out of assign_supervisor(); returns False if they are not subscribed."""
+    with get_connection() as conn:
+        result = conn.execute(
+            text("""
+                UPDATE subscriptions SET available = :available
+                WHERE user_id = :user_id AND bot = 'Supervisor'
+            """),
+            {"user_id": user_id, "available": available}
+        )
+        _notify_invalidation(conn, "subscription", user_id=user_id, bot="Supervisor")
+        conn.commit()
+    invalidate_subscription(user_id, "Supervisor")
+    return result.rowcount > 0
+
+# -----------------------------------------------------------------------------
+# Notification outbox
+# -----------------------------------------------------------------------------
+# enqueue_notifications() NOTIFYs this channel in the queueing transaction, with
+# the lane as payload, so the lane's idle dispatchers wake as soon as it commits
+# instead of at their next poll.
+OUTBOX_CHANNEL = "ftbot_outbox"
+
+OUTBOX_COLUMNS = "id, bot, chat_id, kind, lane, ticket_id, payload, attempts"
+
+def enqueue_notifications(conn, bot, chat_ids, kind, payload, ticket_id=None, digest_window=None,
+                          dedup_key=None, lane="normal", skip_keys=()):
+    """Queue one outbox row per distinct chat on conn (a Connection or Session).
+
+    Nothing is committed here: the rows become visible to the dispatcher together
+    with the caller's write. Returns the number of rows queued. Each lane is
+    claimed by its own dispatcher workers (claim_outbox()).
+
+    A chat already queued a row with the same dedup_key (and bot) is skipped, for as
+    long as that row stays in the outbox (OUTBOX_RETENTION_DAYS once delivered), and
+    so is a chat that queued a row with any of skip_keys.
+
+    With digest_window (seconds) the rows are digest entries: each joins the chat's
+    open window, whose entries all fall due together, or opens one ending
+    digest_window from now. claim_outbox() then claims a chat's entries as a group.
+    """
+    chat_ids = list(dict.fromkeys(chat_id for chat_id in chat_ids if chat_id))
+    if not chat_ids:
+        return 0
+    params = {"bot": bot, "chat_ids": chat_ids, "kind": kind, "ticket_id": ticket_id,
+              "payload": json.dumps(payload), "dedup_key": dedup_key, "lane": lane, "skip_keys": list(skip_keys)}
+    # Served by uq_outbox_dedup, like the ON CONFLICT arbiter
+    skipped = """
+        WHERE NOT EXISTS (SELECT 1 FROM outbox s WHERE s.dedup_key = ANY(CAST(:skip_keys AS TEXT[]))
+                          AND s.bot = :bot AND s.chat_id = c.chat_id)""" if skip_keys else ""
+    on_conflict = skipped + """
+        ON CONFLICT (dedup_key, bot, chat_id) WHERE dedup_key IS NOT NULL DO NOTHING"""
+    if digest_window is None:
+        result = conn.execute(
+            text("""
+                INSERT INTO outbox (bot, chat_id, kind, lane, ticket_id, payload, dedup_key)
+                SELECT :bot, c.chat_id, :kind, :lane, :ticket_id, CAST(:payload AS JSONB), :dedup_key
+                FROM unnest(CAST(:chat_ids AS BIGINT[])) AS c(chat_id)
+            """ + on_conflict),
+            params
+        )
+    else:
+        # attempts = 0: a claimed entry's next_attempt_at is its lease, not its window
+        result = conn.execute(
+            text("""
+                INSERT INTO outbox (bot, chat_id, kind, lane, ticket_id, payload, dedup_key, next_attempt_at)
+                SELECT :bot, c.chat_id, :kind, :lane, :ticket_id, CAST(:payload AS JSONB), :dedup_key,
+                       COALESCE(
+                           (SELECT min(o.next_attempt_at) FROM outbox o
+                            WHERE o.bot = :bot AND o.chat_id = c.chat_id AND o.status = 'pending'
+                              AND o.payload->>'mode' = 'digest' AND o.attempts = 0),
+                           CURRENT_TIMESTAMP + make_interval(secs => :window))
+                FROM unnest(CAST(:chat_ids AS BIGINT[])) AS c(chat_id)
+            """ + on_conflict),
+            dict(params, window=digest_window)
+        )
+    if result.rowcount:
+        conn.execute(text("SELECT pg_notify(:channel, :lane)"), {"channel": OUTBOX_CHANNEL, "lane": lane})
+    return result.rowcount
+
+def claim_outbox(lane, limit, lease_seconds=60):
+    """Claim up to `limit` due notifications of one lane for sending, oldest first.
+
+    FOR UPDATE SKIP LOCKED lets any number of dispatchers claim concurrently
+    without blocking on, or double-claiming, each other's rows. A claimed row stays
+    pending with next_attempt_at pushed out by the lease, so if its dispatcher dies
+    before finish_outbox() the row is simply claimed again once the lease expires.
+
+    A due digest entry brings along every unclaimed digest entry for the same chat,
+    so the whole group goes out as one message (the batch may exceed `limit`).
+    """
+    with get_connection() as conn:
+        rows = conn.execute(
+            text(f"""
+                WITH due AS (
+                    SELECT id, bot, chat_id, payload->>'mode' AS mode FROM outbox
+                    WHERE status = 'pending' AND lane = :lane AND next_attempt_at <= CURRENT_TIMESTAMP
+                    ORDER BY next_attempt_at, id
+                    LIMIT :limit
+                    FOR UPDATE SKIP LOCKED
+                ), digest AS (
+                    SELECT o.id FROM outbox o
+                    WHERE o.status = 'pending' AND o.payload->>'mode' = 'digest' AND o.attempts = 0
+                      AND (o.bot, o.chat_id) IN (SELECT bot, chat_id FROM due WHERE mode = 'digest')
+                    FOR UPDATE SKIP LOCKED
+                )
+                UPDATE outbox o
+                SET attempts = o.attempts + 1,
+                    next_attempt_at = CURRENT_TIMESTAMP + make_interval(secs => :lease)
+                WHERE o.id IN (SELECT id FROM due UNION SELECT id FROM digest)
+                RETURNING {", ".join("o." + c for c in OUTBOX_COLUMNS.split(", "))}
+            """),
+            {"lane": lane, "limit": limit, "lease": lease_seconds}
+        ).fetchall()
+        conn.commit()
+    return sorted(rows, key=lambda row: row.id)
+
+def finish_outbox(results, cards=()):
+    """Record the outcome of claimed rows, and the messages they left to edit later.
+
+    results are dicts with id, status ('done', 'pending' to retry or 'dead'),
+    message_id, delivered_as, error and retry_in (seconds until the next attempt).
+    cards are dicts with the notification_messages columns, written in the same
+    transaction.
+    """
+    if not results:
+        return
+    with get_connection() as conn:
+        conn.execute(
+            text("""
+                UPDATE outbox
+                SET status = :status,
+                    message_id = :message_id,
+                    delivered_as = :delivered_as,
+                    last_error = :error,
+                    sent_at = CASE WHEN :status = 'done' THEN CURRENT_TIMESTAMP END,
+                    next_attempt_at = CURRENT_TIMESTAMP + make_interval(secs => :retry_in)
+                WHERE id = :id
+            """),
+            [dict({"message_id": None, "delivered_as": None, "error": None, "retry_in": 0}, **result)
+             for result in results]
+        )
+        if cards:
+            # ON CONFLICT cannot touch the same row twice in one statement, hence executemany
+            conn.execute(
+                text("""
+                    INSERT INTO notification_messages (ticket_id, bot, chat_id, message_id, has_photo, text)
+                    VALUES (:ticket_id, :bot, :chat_id, :message_id, :has_photo, :text)
+                    ON CONFLICT (ticket_id, bot, chat_id) DO UPDATE
+                    SET message_id = EXCLUDED.message_id, has_photo = EXCLUDED.has_photo,
+                        text = EXCLUDED.text, updated_at = CURRENT_TIMESTAMP
+                """),
+                list(cards)
+            )
+        conn.commit()
+
+NOTIFICATION_MESSAGE_COLUMNS = "ticket_id, bot, chat_id, message_id, has_photo, text"
+
+def get_notification_messages(keys):
+    """{(ticket_id, bot, chat_id): row} for the recorded messages among keys."""
+    keys = list(dict.fromkeys(keys))
+    if not keys:
+        return {}
+    ticket_ids, bots, chat_ids = (list(column) for column in zip(*keys))
+    with get_connection() as conn:
+        rows = conn.execute(
+            text(f"""
+                SELECT {NOTIFICATION_MESSAGE_COLUMNS} FROM notification_messages
+                WHERE (ticket_id, bot, chat_id) IN (
+                    SELECT * FROM unnest(CAST(:ticket_ids AS INTEGER[]), CAST(:bots AS TEXT[]),
+                                         CAST(:chat_ids AS BIGINT[]))
+                )
+            """),
+            {"ticket_ids": ticket_ids, "bots": bots, "chat_ids": chat_ids}
+        ).fetchall()
+    return {(row.ticket_id, row.bot, row.chat_id): row for row in rows}
+
+def list_notification_messages(conn, ticket_id):
+    """(bot, chat_id) of every recorded message about ticket_id, read on the caller's conn."""
+    return [tuple(row) for row in conn.execute(
+        text("SELECT bot, chat_id FROM notification_messages WHERE ticket_id = :ticket_id"),
+        {"ticket_id": ticket_id}
+    )]
+
+def purge_outbox(retention_days):
+    """Delete delivered notifications older than retention_days; returns the count."""
+    with get_connection() as conn:
+        result = conn.execute(
+            text("""
+                DELETE FROM outbox
+                WHERE status = 'done' AND sent_at < CURRENT_TIMESTAMP - make_interval(days => :days)
+            """),
+            {"days": retention_days}
+        )
+        conn.commit()
+    return result.rowcount
+
+def outbox_stats():
+    """{status: (count, oldest next_attempt_at)} for monitoring."""
+    with get_connection() as conn:
+        rows = conn.execute(
+            text("SELECT status, count(*), min(next_attempt_at) FROM outbox GROUP BY status")
+        ).fetchall()
+    return {status: (count, oldest) for status, count, oldest in rows}
+
+def lane_stats(hours=1):
+    """{lane: {...}} for monitoring the priority lanes.
+
+    pending and due count the undelivered rows and those of them due now;
+    oldest_due_s is how long the longest-waiting due row has been due; sent counts
+    the rows delivered in the last `hours`, and wait_p50_s / wait_p99_s how long
+    they took from queueing to delivery (for digest entries, including the window).
+    """
+    with get_connection() as conn:
+        rows = conn.execute(
+            text("""
+                SELECT lane,
+                       count(*) FILTER (WHERE status = 'pending') AS pending,
+                       count(*) FILTER (WHERE status = 'pending' AND next_attempt_at <= CURRENT_TIMESTAMP) AS due,
+                       CAST(EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - min(next_attempt_at)
+                                    FILTER (WHERE status = 'pending' AND next_attempt_at <= CURRENT_TIMESTAMP))
+                            AS FLOAT) AS oldest_due_s,
+                       count(*) FILTER (WHERE status = 'done' AND sent_at >= w.since) AS sent,
+                       percentile_cont(0.5) WITHIN GROUP (ORDER BY EXTRACT(EPOCH FROM sent_at - created_at))
+                           FILTER (WHERE status = 'done' AND sent_at >= w.since) AS wait_p50_s,
+                       percentile_cont(0.99) WITHIN GROUP (ORDER BY EXTRACT(EPOCH FROM sent_at - created_at))
+                           FILTER (WHERE status = 'done' AND sent_at >= w.since) AS wait_p99_s
+                FROM outbox, (SELECT CURRENT_TIMESTAMP - make_interval(hours => :hours) AS since) w
+                WHERE status = 'pending' OR sent_at >= w.since
+                GROUP BY lane
+            """),
+            {"hours": hours}
+        ).fetchall()
+    return {row.lane: {key: value for key, value in row._mapping.items() if key != 'lane'} for row in rows}
+
+def delivery_stats(hours=24):
+    """{delivered_as: count} of the notifications delivered in the last `hours`."""
+    with get_connection() as conn:
+        rows = conn.execute(
+            text("""
+                SELECT COALESCE(delivered_as, 'send'), count(*) FROM outbox
+                WHERE status = 'done' AND sent_at >= CURRENT_TIMESTAMP - make_interval(hours => :hours)
+                GROUP BY 1
+            """),
+            {"hours": hours}
+        ).fetchall()
+    return dict(rows)
+
+# -----------------------------------------------------------------------------
+# Broadcasts
+# -----------------------------------------------------------------------------
+BROADCAST_BOTS = ("DA", "Client")
+
+BROADCAST_COLUMNS = ("id, bot, client_id, text, status, last_subscription_id, total, queued, delivered, failed, "
+                     "created_by, created_at, finished_at")
+
+def _broadcast_audience(client_id):
+    """WHERE clause for a broadcast's recipients in subscriptions (:bot, :client_id)."""
+    where = "role = :bot AND bot = :bot"
+    return where + " AND client_id = :client_id" if client_id is not None else where
+
+def broadcast_key(broadcast_id):
+    """The dedup_key of a broadcast's outbox rows: one message per chat, and how its progress is counted."""
+    return f"broadcast:{broadcast_id}"
+
+def create_broadcast(bot, message, client=None, created_by=None):
+    """Start a broadcast of message to every `bot` subscriber (only the contacts of
+    client, if given); the dispatcher queues it (notifier.advance_broadcasts()).
+
+    Returns the new broadcast as a dict, or None if bot cannot broadcast or there
+    is no such client.
+    """
+    if bot not in BROADCAST_BOTS:
+        return None
+    with get_connection() as conn:
+        client_id = None
+        if client:
+            client_id = conn.execute(text(f"SELECT {CLIENT_ID_BY_NAME_SQL}"), {"client": client}).scalar()
+            if client_id is None:
+                return None
+        row = conn.execute(
+            text(f"""
+                INSERT INTO broadcasts (bot, client_id, text, created_by, total)
+                SELECT :bot, :client_id, :text, :created_by, count(*)
+                FROM subscriptions WHERE {_broadcast_audience(client_id)}
+                RETURNING {BROADCAST_COLUMNS}
+            """),
+            {"bot": bot, "client_id": client_id, "text": message, "created_by": created_by}
+        ).fetchone()
+        conn.commit()
+    return dict(row._mapping)
+
+def get_broadcasts(limit=20):
+    """The latest broadcasts, newest first, with their outbox progress so far
+    (pending, delivered, failed; the recorded counts once done)."""
+    with get_connection() as conn:
+        rows = conn.execute(
+            text(f"""
+                SELECT b.*, c.name AS client, progress.pending,
+                       COALESCE(b.delivered, progress.delivered) AS delivered,
+                       COALESCE(b.failed, progress.failed) AS failed
+                FROM (SELECT {BROADCAST_COLUMNS} FROM broadcasts ORDER BY id DESC LIMIT :limit) b
+                LEFT JOIN clients c ON c.client_id = b.client_id
+                CROSS JOIN LATERAL (
+                    SELECT count(*) FILTER (WHERE o.status = 'pending') AS pending,
+                           count(*) FILTER (WHERE o.status = 'done') AS delivered,
+                           count(*) FILTER (WHERE o.status = 'dead') AS failed
+                    FROM outbox o
+                    WHERE o.dedup_key = 'broadcast:' || b.id AND o.bot = b.bot AND b.status = 'running'
+                ) progress
+                ORDER BY b.id DESC
+            """),
+            {"limit": limit}
+        ).fetchall()
+    return [dict(row._mapping) for row in rows]
+
+def running_broadcasts():
+    """ids of the broadcasts still being sent."""
+    with get_connection() as conn:
+        return [row.id for row in conn.execute(text("SELECT id FROM broadcasts WHERE status = 'running' ORDER BY id"))]
+
+def claim_broadcast(conn, broadcast_id):
+    """Lock a running broadcast on conn, with the number of its rows still pending in
+    the outbox; None if it is done or another dispatcher has it (SKIP LOCKED)."""
+    row = conn.execute(
+        text(f"""
+            SELECT {BROADCAST_COLUMNS},
+                   (SELECT count(*) FROM outbox o
+                    WHERE o.dedup_key = :key AND o.bot = broadcasts.bot AND o.status = 'pending') AS pending
+            FROM broadcasts
+            WHERE id = :id AND status = 'running'
+            FOR UPDATE SKIP LOCKED
+        """),
+        {"id": broadcast_id, "key": broadcast_key(broadcast_id)}
+    ).fetchone()
+    return dict(row._mapping) if row else None
+
+def next_broadcast_recipients(conn, broadcast, limit):
+    """(subscription id, chat_id) of the next `limit` recipients after the broadcast's checkpoint."""
+    return [tuple(row) for row in conn.execute(
+        text(f"""
+            SELECT id, chat_id FROM subscriptions
+            WHERE {_broadcast_audience(broadcast['client_id'])} AND id > :after
+            ORDER BY id
+            LIMIT :limit
+        """),
+        {"bot": broadcast['bot'], "client_id": broadcast['client_id'],
+         "after": broadcast['last_subscription_id'], "limit": limit}
+    )]
+
+def checkpoint_broadcast(conn, broadcast_id, last_subscription_id, queued):
+    """Record the recipients queued on conn, in the transaction that queued them."""
+    conn.execute(
+        text("""
+            UPDATE broadcasts SET last_subscription_id = :last, queued = queued + :queued
+            WHERE id = :id
+        """),
+        {"id": broadcast_id, "last": last_subscription_id, "queued": queued}
+    )
+
+def finish_broadcast(conn, broadcast_id):
+    """Mark a broadcast done on conn, recording its delivered and failed counts from the outbox."""
+    conn.execute(
+        text("""
+            UPDATE broadcasts b
+            SET status = 'done', finished_at = CURRENT_TIMESTAMP,
+                delivered = (SELECT count(*) FROM outbox o
+                             WHERE o.dedup_key = :key AND o.bot = b.bot AND o.status = 'done'),
+                failed = (SELECT count(*) FROM outbox o
+                          WHERE o.dedup_key = :key AND o.bot = b.bot AND o.status = 'dead')
+            WHERE id = :id
+        """),
+        {"id": broadcast_id, "key": broadcast_key(broadcast_id)}
+    )
+
+# -----------------------------------------------------------------------------
+# Conversation state (persistence.py)
+# -----------------------------------------------------------------------------
+# Keys per NOTIFY message: payloads are limited to 8000 bytes
+BOT_STATE_NOTIFY_KEYS = 100
+
+def load_bot_state(bot, kind=None, keys=None):
+    """The stored (kind, key, data) of bot: all, those of one kind, or those named by keys [(kind, key)]."""
+    where, params = "bot = :bot", {"bot": bot}
+    if kind is not None:
+        where += " AND kind = :kind"
+        params["kind"] = kind
+    if keys is not None:
+        where += " AND (kind, key) IN (SELECT * FROM unnest(CAST(:kinds AS TEXT[]), CAST(:keys AS TEXT[])))"
+        params["kinds"] = [k for k, _ in keys]
+        params["keys"] = [key for _, key in keys]
+    with get_connection() as conn:
+        rows = conn.execute(text(f"SELECT kind, key, data FROM bot_state WHERE {where}"), params).fetchall()
+    return [tuple(row) for row in rows]
+
+def save_bot_state(bot, rows, origin):
+    """Store bot's [(kind, key, data)] in one transaction, deleting those whose data is None.
+
+    The other processes are told which keys changed (a "bot_state" invalidation
+    message naming origin, so the writer can skip its own). Returns False on error.
+    """
+    upserts = [{"bot": bot, "kind": kind, "key": key, "data": json.dumps(data)}
+               for kind, key, data in rows if data is not None]
+    deletes = [{"bot": bot, "kind": kind, "key": key} for kind, key, data in rows if data is None]
+    try:
+        with get_connection() as conn:
+            if upserts:
+                conn.execute(
+                    text("""
+                        INSERT INTO bot_state (bot, kind, key, data) VALUES (:bot, :kind, :key, CAST(:data AS JSONB))
+                        ON CONFLICT (bot, kind, key) DO UPDATE
+                        SET data = EXCLUDED.data, updated_at = CURRENT_TIMESTAMP
+                    """),
+                    upserts
+                )
+            if deletes:
+                conn.execute(text("DELETE FROM bot_state WHERE bot = :bot AND kind = :kind AND key = :key"), deletes)
+            changed = [[kind, key] for kind, key, _ in rows]
+            for start in range(0, len(changed), BOT_STATE_NOTIFY_KEYS):
+                _notify_invalidation(conn, "bot_state", bot=bot, origin=origin,
+                                     keys=changed[start:start + BOT_STATE_NOTIFY_KEYS])
+            conn.commit()
+    except Exception as e:
+        logger.error("Error storing %d conversation state(s) of bot %s: %s", len(rows), bot, e)
+        return False
+    return True
+
+def purge_bot_state(retention_days):
+    """Delete conversation states and user_data untouched for retention_days; returns the count."""
+    with get_connection() as conn:
+        result = conn.execute(
+            text("DELETE FROM bot_state WHERE updated_at < CURRENT_TIMESTAMP - make_interval(days => :days)"),
+            {"days": retention_days}
+        )
+        conn.commit()
+    return result.rowcount
 
 def migrate_data():
     # Migration logic (if needed)
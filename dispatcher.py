@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+# dispatcher.py
+"""
+Sends the notifications queued in the outbox table (see notifier.queue()).
+
+Handlers only commit their write and the outbox rows it produced; the workers
+here claim due rows in batches with FOR UPDATE SKIP LOCKED (db.claim_outbox),
+send them concurrently through notifier.deliver() and record the outcome: done,
+retried with exponential backoff, or dead after OUTBOX_MAX_ATTEMPTS attempts or
+an error that cannot succeed on retry. A fresh send about a ticket is recorded
+in notification_messages, so later status changes edit it in place (see the
+queue modes in notifier.py). A chat's digest entries are claimed together and
+sent as one summary message per notifier.DIGEST_MAX_ENTRIES. Between batches
+the first worker also purges old rows and, with SUPERVISOR_ASSIGNMENT, hands
+tickets their supervisor left waiting to another one, and the bulk lane's first
+worker queues the running broadcasts chunk by chunk. Idle workers sleep until a NOTIFY on
+db.OUTBOX_CHANNEL (sent when queued rows commit) or the poll interval.
+
+Each priority lane (notifier.LANES) has its own workers, so a batch of a bulk
+fan-out never holds up the claim of a new-ticket alert, and the lanes share each
+bot's rate budget by config.OUTBOX_LANE_SHARES (notifier.LaneBucket).
+
+Any number of workers, in any number of processes, can drain the queue together.
+Telegram's rate limits are enforced per process by notifier.FanOut, though, so
+run one dispatcher process per deployment (main.py starts it) and scale with
+--workers inside it.
+
+    python dispatcher.py               # DISPATCHER_WORKERS workers per lane
+    python dispatcher.py --workers 4
+    python dispatcher.py --stats       # print the outbox backlog, per-lane depth and wait times and the
+                                       # last day's sends/edits, and exit
+"""
+
+import argparse
+import asyncio
+import logging
+import select
+import threading
+import time
+from datetime import timedelta
+
+import psycopg2
+from telegram.error import BadRequest, Forbidden, RetryAfter
+
+import config
+import db
+import notifier
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 5.0
+# A claimed row is re-claimed by another worker if not settled within this time
+CLAIM_LEASE_SECONDS = 300
+RETRY_BASE_SECONDS = 5
+RETRY_MAX_SECONDS = 3600
+PURGE_INTERVAL = 3600
+# How often the first worker looks for tickets to reassign (notifier.reassign_overdue)
+REASSIGN_INTERVAL = 60
+# How often the last lane's first worker queues more of the running broadcasts
+# (notifier.advance_broadcasts)
+BROADCAST_INTERVAL = 5
+# Failures that fail again on retry: bad request (chat not found, bad markup) or
+# the user blocked the bot
+PERMANENT_ERRORS = (BadRequest, Forbidden)
+
+
+def _describe(error):
+    return f"{type(error).__name__}: {error}"
+
+
+class Dispatcher:
+    """A LISTEN thread plus `workers` threads per lane claiming and sending outbox batches."""
+
+    def __init__(self, workers=config.DISPATCHER_WORKERS, batch_size=config.OUTBOX_BATCH_SIZE,
+                 max_attempts=config.OUTBOX_MAX_ATTEMPTS, poll_interval=POLL_INTERVAL, dsn=config.DATABASE_URL,
+                 lanes=notifier.LANES):
+        self.workers = workers
+        self.lanes = lanes
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.dsn = dsn
+        # sent counts new messages, edited in-place edits, skipped refreshes with nothing to edit,
+        # digested the entries delivered in digest messages (each digest counts once in sent)
+        self.sent = self.edited = self.skipped = self.digested = self.retried = self.dead = 0
+        self._counts_lock = threading.Lock()
+        self._wake = {lane: threading.Event() for lane in lanes}
+        self._stopping = threading.Event()
+        self._threads = []
+
+    def start(self):
+        self._threads = [threading.Thread(target=self._listen_forever, name="outbox-listener", daemon=True)]
+        self._threads += [threading.Thread(target=self._work, args=(lane, index),
+                                           name=f"outbox-{lane}-{index}", daemon=True)
+                          for lane in self.lanes for index in range(self.workers)]
+        for thread in self._threads:
+            thread.start()
+        logger.info("Outbox dispatcher started with %d worker(s) per lane (%s)", self.workers, ", ".join(self.lanes))
+        return self
+
+    def stop(self, timeout=None):
+        """Stop after the batches in flight have been settled.
+
+        The listener thread exits on its own within poll_interval.
+        """
+        self._stopping.set()
+        self._wake_all()
+        for thread in self._threads[1:]:
+            thread.join(timeout)
+
+    # -- sending --------------------------------------------------------------
+    def dispatch_batch(self, lane="normal"):
+        """Claim, send and settle one batch of lane; returns the number of rows claimed."""
+        rows = db.claim_outbox(lane, self.batch_size, CLAIM_LEASE_SECONDS)
+        if not rows:
+            return 0
+        digests, singles = {}, []
+        for row in rows:
+            if row.payload.get("mode") == "digest":
+                digests.setdefault((row.bot, row.chat_id), []).append(row)
+            else:
+                singles.append(row)
+        groups = [group[i:i + notifier.DIGEST_MAX_ENTRIES] for group in digests.values()
+                  for i in range(0, len(group), notifier.DIGEST_MAX_ENTRIES)]
+        cards = db.get_notification_messages((row.ticket_id, row.bot, row.chat_id) for row in singles
+                                             if row.ticket_id is not None)
+        results = notifier.run(self._deliver_all(singles, groups, cards))
+        outcomes, new_cards = [], []
+        for row, result in zip(singles, results):
+            outcomes.append(self._outcome(row, result))
+            card = self._card(row, result, cards.get((row.ticket_id, row.bot, row.chat_id)))
+            if card:
+                new_cards.append(card)
+        for group, delivery in zip(groups, results[len(singles):]):
+            if isinstance(delivery, BaseException):
+                result = delivery
+            else:
+                result = (delivery, "digest")
+                if delivery.ok:
+                    self._count("sent")
+            outcomes += [self._outcome(row, result) for row in group]
+        db.finish_outbox(outcomes, new_cards)
+        return len(rows)
+
+    @staticmethod
+    async def _deliver_all(rows, groups, cards):
+        """deliver() each row, then deliver_digest() each group, concurrently."""
+        return await asyncio.gather(
+            *(notifier.deliver(row, cards.get((row.ticket_id, row.bot, row.chat_id))) for row in rows),
+            *(notifier.deliver_digest(group) for group in groups),
+            return_exceptions=True)
+
+    @staticmethod
+    def _card(row, result, card):
+        """The notification_messages row a delivered send or edit leaves behind, or None."""
+        if row.ticket_id is None or isinstance(result, BaseException):
+            return None
+        delivery, action = result
+        # A refresh keeps the recorded text as the base the next refresh appends to
+        if delivery is None or not delivery.ok or row.payload.get("mode") == "refresh":
+            return None
+        if action == "edit":
+            message_id, has_photo = card.message_id, card.has_photo
+        else:
+            message_id, has_photo = delivery.message.message_id, bool(delivery.message.photo)
+        return {"ticket_id": row.ticket_id, "bot": row.bot, "chat_id": row.chat_id,
+                "message_id": message_id, "has_photo": has_photo, "text": row.payload["text"]}
+
+    def _outcome(self, row, result):
+        if isinstance(result, BaseException):
+            # deliver() itself failed (unknown bot, malformed payload): retrying cannot help
+            error, permanent = result, True
+        else:
+            delivery, action = result
+            if delivery is None:
+                self._count("skipped")
+                return {"id": row.id, "status": "done", "delivered_as": "skip"}
+            if delivery.ok:
+                self._count({"edit": "edited", "digest": "digested"}.get(action, "sent"))
+                # An edit that changed nothing returns no message
+                return {"id": row.id, "status": "done", "delivered_as": action,
+                        "message_id": getattr(delivery.message, "message_id", None)}
+            error, permanent = delivery.error, isinstance(delivery.error, PERMANENT_ERRORS)
+
+        if permanent or row.attempts >= self.max_attempts:
+            self._count("dead")
+            logger.error("%s to %s chat %s (outbox %s) is dead after %d attempt(s): %s",
+                         row.kind, row.bot, row.chat_id, row.id, row.attempts, _describe(error))
+            return {"id": row.id, "status": "dead", "error": _describe(error)}
+        if isinstance(error, RetryAfter):
+            retry_after = error.retry_after
+            retry_in = retry_after.total_seconds() if isinstance(retry_after, timedelta) else retry_after
+        else:
+            retry_in = min(RETRY_BASE_SECONDS * 2 ** (row.attempts - 1), RETRY_MAX_SECONDS)
+        self._count("retried")
+        logger.warning("%s to %s chat %s (outbox %s) failed, retrying in %ss: %s",
+                       row.kind, row.bot, row.chat_id, row.id, retry_in, _describe(error))
+        return {"id": row.id, "status": "pending", "error": _describe(error), "retry_in": retry_in}
+
+    def _count(self, name):
+        with self._counts_lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def _work(self, lane, index):
+        first = lane == self.lanes[0] and index == 0
+        next_purge = next_reassign = time.monotonic() if first else float("inf")
+        next_broadcast = time.monotonic() if lane == self.lanes[-1] and index == 0 else float("inf")
+        wake = self._wake[lane]
+        while not self._stopping.is_set():
+            try:
+                claimed = self.dispatch_batch(lane)
+            except Exception as e:
+                logger.error("Outbox dispatch (%s lane) failed: %s", lane, e)
+                claimed = 0
+            if time.monotonic() >= next_broadcast:
+                # Also while the lane is busy: the next chunk is queued before this one runs out
+                self._broadcast()
+                next_broadcast = time.monotonic() + BROADCAST_INTERVAL
+            if claimed >= self.batch_size:
+                # There is probably more: wake the lane's idle workers to help
+                wake.set()
+                continue
+            if time.monotonic() >= next_purge:
+                self._purge()
+                logger.info("Bot API requests and connections opened: %s", notifier.connection_stats())
+                logger.info("Notifications sent: %d new (%d entries in digests), %d edited in place, "
+                            "%d refreshes skipped", self.sent, self.digested, self.edited, self.skipped)
+                self._log_lanes()
+                next_purge = time.monotonic() + PURGE_INTERVAL
+            if config.SUPERVISOR_ASSIGNMENT and time.monotonic() >= next_reassign:
+                self._reassign()
+                next_reassign = time.monotonic() + REASSIGN_INTERVAL
+            if wake.wait(self.poll_interval):
+                wake.clear()
+
+    def _purge(self):
+        try:
+            purged = db.purge_outbox(config.OUTBOX_RETENTION_DAYS)
+            if purged:
+                logger.info("Purged %d delivered notification(s) from the outbox", purged)
+        except Exception as e:
+            logger.error("Outbox purge failed: %s", e)
+        try:
+            purged = db.purge_bot_state(config.PERSISTENCE_RETENTION_DAYS)
+            if purged:
+                logger.info("Purged %d stale conversation state(s)", purged)
+        except Exception as e:
+            logger.error("Conversation state purge failed: %s", e)
+
+    def _log_lanes(self):
+        try:
+            for lane, stats in sorted(db.lane_stats().items()):
+                logger.info("Lane %s: %d pending (%d due, oldest %.1fs), %d sent in the last hour, "
+                            "wait p50 %.1fs p99 %.1fs", lane, stats["pending"], stats["due"],
+                            stats["oldest_due_s"] or 0, stats["sent"], stats["wait_p50_s"] or 0,
+                            stats["wait_p99_s"] or 0)
+        except Exception as e:
+            logger.error("Outbox lane stats failed: %s", e)
+
+    def _reassign(self):
+        try:
+            moved = notifier.reassign_overdue()
+            if moved:
+                logger.info("Reassigned %d ticket(s) waiting on their supervisor", moved)
+        except Exception as e:
+            logger.error("Ticket reassignment failed: %s", e)
+
+    def _broadcast(self):
+        try:
+            queued = notifier.advance_broadcasts()
+            if queued:
+                logger.info("Queued %d broadcast message(s)", queued)
+        except Exception as e:
+            logger.error("Broadcast failed: %s", e)
+
+    # -- wake-ups -------------------------------------------------------------
+    def _wake_all(self):
+        for wake in self._wake.values():
+            wake.set()
+
+    def _listen_forever(self):
+        backoff = 1
+        while not self._stopping.is_set():
+            try:
+                self._listen()
+                backoff = 1
+            except Exception as e:
+                logger.error("Outbox listener disconnected, polling every %ss: %s", self.poll_interval, e)
+            if not self._stopping.wait(backoff):
+                backoff = min(backoff * 2, 60)
+
+    def _listen(self):
+        conn = psycopg2.connect(self.dsn)
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute(f"LISTEN {db.OUTBOX_CHANNEL}")
+            # Rows may have been queued before LISTEN took effect
+            self._wake_all()
+            while not self._stopping.is_set():
+                if select.select([conn], [], [], self.poll_interval) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    # The payload is the lane queued in
+                    wake = self._wake.get(conn.notifies.pop().payload)
+                    if wake is None:
+                        self._wake_all()
+                    else:
+                        wake.set()
+        finally:
+            conn.close()
+
+
+def serve(workers=config.DISPATCHER_WORKERS):
+    """Run a dispatcher in this process until interrupted (the main.py entry point)."""
+    dispatcher = Dispatcher(workers=workers).start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        dispatcher.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=config.DISPATCHER_WORKERS, help="workers per lane")
+    parser.add_argument("--stats", action="store_true", help="print the outbox backlog and exit")
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    db.init_db()
+    if args.stats:
+        for status, (count, oldest) in sorted(db.outbox_stats().items()):
+            print(f"{status:<8} {count:>8}  oldest due {oldest}")
+        for delivered_as, count in sorted(db.delivery_stats().items()):
+            print(f"{delivered_as:<8} {count:>8}  in the last 24h")
+        lanes = db.lane_stats()
+        print(f"\n{'lane':<8} {'pending':>8} {'due':>6} {'oldest s':>9} {'sent 1h':>8} {'wait p50 s':>11} "
+              f"{'p99 s':>7}")
+        for lane in notifier.LANES:
+            stats = lanes.get(lane)
+            if stats:
+                print(f"{lane:<8} {stats['pending']:>8} {stats['due']:>6} {stats['oldest_due_s'] or 0:>9.1f} "
+                      f"{stats['sent']:>8} {stats['wait_p50_s'] or 0:>11.1f} {stats['wait_p99_s'] or 0:>7.1f}")
+        return
+    serve(args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# explain_check.py
+"""
+EXPLAIN every query issued by the db.* helpers and fail on sequential scans of
+large tables.
+
+Each check calls a real db.py function. While it runs, the SQL it sends is
+rewritten to ``EXPLAIN (FORMAT JSON) ...``, so nothing is executed (writes
+included) and the query text and parameters are exactly what production sends.
+
+Usage (point DB_NAME at a scratch database, --seed inserts synthetic rows):
+
+    python explain_check.py --seed 50000
+    EXPLAIN_CHECK_MAX_ROWS=5000 python explain_check.py
+"""
+
+import argparse
+import json
+import os
+import sys
+
+from sqlalchemy import event, text
+
+import db
+
+# Checks that list a whole table on purpose; reported but never fatal
+FULL_SCAN_OK = {"get_all_tickets", "get_all_subscriptions"}
+
+
+def seed(conn, tickets):
+    """Insert synthetic subscriptions, tickets and events, then ANALYZE."""
+    subscriptions = max(tickets // 10, 100)
+    conn.execute(text("""
+        INSERT INTO clients (name) SELECT 'client-' || n FROM generate_series(0, 199) AS n
+        ON CONFLICT DO NOTHING
+    """))
+    conn.execute(text("""
+        INSERT INTO subscriptions (user_id, chat_id, phone, role, bot, client, client_id, username)
+        SELECT 9000000 + n, 9000000 + n, 'seed', r.role, r.role,
+               CASE WHEN r.role = 'Client' THEN 'client-' || (n % 200) END,
+               CASE WHEN r.role = 'Client' THEN (SELECT client_id FROM clients WHERE name = 'client-' || (n % 200)) END,
+               'seed_' || n
+        FROM generate_series(1, :n) AS n
+        CROSS JOIN LATERAL (
+            SELECT CASE WHEN n % 100 = 0 THEN 'Supervisor'
+                        WHEN n % 2 = 0 THEN 'Client' ELSE 'DA' END AS role
+        ) r
+        ON CONFLICT DO NOTHING
+    """), {"n": subscriptions})
+    conn.execute(text("""
+        INSERT INTO tickets (order_id, issue_description, issue_reason, issue_type, client, client_id,
+                             status, da_id, event_seq, created_at)
+        SELECT 'ORD-' || lpad(n::text, 9, '0'), 'seeded ticket ' || n, 'المخزن', 'تالف',
+               'client-' || (n % 200), (SELECT client_id FROM clients WHERE name = 'client-' || (n % 200)),
+               CASE WHEN n % 20 = 0 THEN 'Opened' ELSE 'Closed' END,
+               9000001 + 2 * (n % (:subs / 2)), 2,
+               now() - (n || ' minutes')::interval
+        FROM generate_series(1, :n) AS n
+    """), {"n": tickets, "subs": subscriptions})
+    conn.execute(text("""
+        INSERT INTO ticket_events (ticket_id, seq, action, message)
+        SELECT t.ticket_id, s.seq, CASE s.seq WHEN 1 THEN 'client_solution' ELSE 'da_closed' END, 'seeded'
+        FROM tickets t CROSS JOIN generate_series(1, 2) AS s(seq)
+        WHERE t.order_id LIKE 'ORD-%'
+        ON CONFLICT DO NOTHING
+    """))
+    conn.commit()
+    for table in ("clients", "subscriptions", "tickets", "ticket_events"):
+        conn.execute(text(f"ANALYZE {table}"))
+    conn.commit()
+
+
+def sample_args(conn):
+    """Pick existing keys so every check exercises a realistic lookup."""
+    row = conn.execute(text("""
+        SELECT t.ticket_id, t.order_id, t.da_id, t.client,
+               (SELECT user_id FROM subscriptions WHERE bot = 'Client' LIMIT 1) AS client_user_id
+        FROM tickets t ORDER BY t.ticket_id DESC LIMIT 1
+    """)).fetchone()
+    if not row:
+        sys.exit("No tickets found; run with --seed first.")
+    return row._mapping
+
+
+def on_connection(call):
+    """Run a helper that takes the caller's connection; nothing is committed."""
+    with db.get_connection() as conn:
+        return call(conn)
+
+
+def build_checks(sample):
+    ticket_id = sample["ticket_id"]
+    return [
+        ("get_all_tickets", lambda: db.get_all_tickets()),
+        ("get_all_subscriptions", lambda: db.get_all_subscriptions()),
+        ("get_subscription", lambda: db.get_subscription(sample["da_id"], "DA")),
+        ("get_users_by_role", lambda: db.get_users_by_role("client", client=sample["client"])),
+        ("get_supervisors", lambda: db.get_supervisors()),
+        ("get_clients_by_name", lambda: db.get_clients_by_name(sample["client"])),
+        ("get_all_open_tickets", lambda: db.get_all_open_tickets()),
+        ("get_tickets_by_user", lambda: db.get_tickets_by_user(sample["da_id"])),
+        ("get_tickets_by_client", lambda: db.get_tickets_by_client(sample["client_user_id"])),
+        ("get_open_tickets_page", lambda: db.get_open_tickets_page(page_size=10)),
+        ("get_tickets_by_user_page", lambda: db.get_tickets_by_user_page(sample["da_id"], page_size=10)),
+        ("get_tickets_by_client_page",
+         lambda: db.get_tickets_by_client_page(sample["client_user_id"], page_size=10)),
+        ("get_tickets_page[client+status]",
+         lambda: db.get_tickets_page(page_size=10, client=sample["client"], status="Awaiting Client Response")),
+        ("get_ticket", lambda: db.get_ticket(ticket_id)),
+        ("get_ticket_events", lambda: db.get_ticket_events(ticket_id)),
+        ("get_latest_ticket_event", lambda: db.get_latest_ticket_event(ticket_id, "client_solution")),
+        ("search_tickets_by_order[exact]", lambda: db.search_tickets_by_order(sample["order_id"], mode="exact")),
+        ("search_tickets_by_order[prefix]", lambda: db.search_tickets_by_order(sample["order_id"][:8], mode="prefix")),
+        ("search_tickets_by_order[substring]",
+         lambda: db.search_tickets_by_order(sample["order_id"][-6:], mode="substring")),
+        ("search_tickets_by_order[short substring]",
+         lambda: db.search_tickets_by_order(sample["order_id"][-2:], mode="substring")),
+        ("apply_transition", lambda: db.apply_transition(ticket_id, "da_closed")),
+        # LIMIT 0: plans the claim without taking any rows from a live outbox
+        ("claim_outbox", lambda: db.claim_outbox("urgent", 0)),
+        ("assign_supervisor", lambda: on_connection(lambda conn: db.assign_supervisor(conn, ticket_id))),
+        ("claim_overdue_assignment", lambda: on_connection(lambda conn: db.claim_overdue_assignment(conn, 900))),
+    ]
+
+
+class PlanCapture:
+    """Rewrites statements on db.engine to EXPLAIN and collects the plans."""
+
+    def __init__(self):
+        self.plans = []
+
+    def before(self, conn, cursor, statement, parameters, context, executemany):
+        if not statement.lstrip().upper().startswith(("SELECT", "WITH", "UPDATE", "INSERT", "DELETE")):
+            return statement, parameters
+        return "EXPLAIN (FORMAT JSON) " + statement, parameters
+
+    def after(self, conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith("EXPLAIN (FORMAT JSON) "):
+            plan = cursor.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            self.plans.append((statement[len("EXPLAIN (FORMAT JSON) "):], plan[0]["Plan"]))
+
+    def __enter__(self):
+        event.listen(db.engine, "before_cursor_execute", self.before, retval=True)
+        event.listen(db.engine, "after_cursor_execute", self.after)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(db.engine, "before_cursor_execute", self.before)
+        event.remove(db.engine, "after_cursor_execute", self.after)
+
+
+def seq_scans(plan):
+    if plan.get("Node Type") == "Seq Scan":
+        yield plan["Relation Name"]
+    for child in plan.get("Plans", []):
+        yield from seq_scans(child)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seed", type=int, default=0, help="insert this many synthetic tickets first")
+    parser.add_argument("--max-rows", type=int, default=int(os.getenv("EXPLAIN_CHECK_MAX_ROWS", "1000")),
+                        help="fail on a sequential scan of any table with more rows than this")
+    args = parser.parse_args()
+
+    db.init_db()
+    with db.get_connection() as conn:
+        if args.seed:
+            seed(conn, args.seed)
+        sample = sample_args(conn)
+        table_rows = {
+            row.relname: int(row.reltuples)
+            for row in conn.execute(text(
+                "SELECT relname, reltuples FROM pg_class WHERE relkind = 'r' AND relnamespace = 'public'::regnamespace"
+            ))
+        }
+
+    failures = 0
+    for name, call in build_checks(sample):
+        # Cached lookups would otherwise skip the query entirely
+        db.clear_caches()
+        with PlanCapture() as capture:
+            try:
+                call()
+            except Exception:
+                # The helper saw EXPLAIN output instead of its rows; the plan is already captured
+                pass
+        if not capture.plans:
+            print(f"?    {name}: issued no query")
+            continue
+        for statement, plan in capture.plans:
+            large = [rel for rel in seq_scans(plan) if table_rows.get(rel, 0) > args.max_rows]
+            if not large:
+                status = "ok"
+            elif name in FULL_SCAN_OK:
+                status = "full"
+            else:
+                status = "FAIL"
+                failures += 1
+            detail = ", ".join(f"Seq Scan on {rel} (~{table_rows[rel]} rows)" for rel in large)
+            print(f"{status:<4} {name}: {plan['Node Type']} cost={plan['Total Cost']}{' - ' + detail if detail else ''}")
+            if status == "FAIL":
+                print("       " + " ".join(statement.split()))
+
+    if failures:
+        print(f"\n{failures} quer{'y scans' if failures == 1 else 'ies scan'} tables above {args.max_rows} rows sequentially.")
+        sys.exit(1)
+    print(f"\nNo sequential scans above {args.max_rows} rows.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# invalidation.py
+"""
+Cross-process cache invalidation over Postgres LISTEN/NOTIFY.
+
+The bots may run as separate processes (main.py --mode processes) or replicas,
+each with its own caches in db.py. Writers in db.py NOTIFY db.INVALIDATION_CHANNEL in the same transaction
+as the write; the listener thread started here evicts the matching keys in this
+process. While the listener is connected the caches use the long
+CACHE_TTL_WITH_INVALIDATION; while it is not they fall back to the short TTLs
+and are cleared, since notifications may have been missed.
+
+    python invalidation.py           # print notifications as they arrive
+    python invalidation.py --check   # verify eviction across two processes
+"""
+
+import argparse
+import logging
+import multiprocessing
+import select
+import sys
+import threading
+import time
+
+import psycopg2
+
+import config
+import db
+
+logger = logging.getLogger(__name__)
+
+_listener = None
+_listener_lock = threading.Lock()
+
+
+class InvalidationListener(threading.Thread):
+    """Background thread holding a dedicated LISTEN connection."""
+
+    def __init__(self, dsn=config.DATABASE_URL, on_message=db.apply_invalidation, poll_timeout=5.0):
+        super().__init__(name="cache-invalidation", daemon=True)
+        self.dsn = dsn
+        self.on_message = on_message
+        self.poll_timeout = poll_timeout
+        self.connected = threading.Event()
+        self.received = 0
+        self._stopping = threading.Event()
+
+    def stop(self):
+        self._stopping.set()
+
+    def run(self):
+        backoff = 1
+        while not self._stopping.is_set():
+            try:
+                self._listen()
+                backoff = 1
+            except Exception as e:
+                logger.error("Cache invalidation listener disconnected: %s", e)
+            finally:
+                self._disconnected()
+            if not self._stopping.wait(backoff):
+                backoff = min(backoff * 2, 60)
+
+    def _listen(self):
+        conn = psycopg2.connect(self.dsn)
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute(f"LISTEN {db.INVALIDATION_CHANNEL}")
+            # Anything cached before LISTEN took effect may already be stale
+            db.clear_caches()
+            db.set_cache_ttl(config.CACHE_TTL_WITH_INVALIDATION, config.CACHE_TTL_WITH_INVALIDATION)
+            self.connected.set()
+            logger.info("Listening for cache invalidations on %s", db.INVALIDATION_CHANNEL)
+            while not self._stopping.is_set():
+                if select.select([conn], [], [], self.poll_timeout) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    self.received += 1
+                    try:
+                        self.on_message(notify.payload)
+                    except Exception as e:
+                        logger.error("Bad cache invalidation message %r: %s", notify.payload, e)
+        finally:
+            conn.close()
+
+    def _disconnected(self):
+        if self.connected.is_set():
+            self.connected.clear()
+            db.set_cache_ttl(config.SUBSCRIPTION_CACHE_TTL, config.TICKET_CACHE_TTL)
+            db.clear_caches()
+
+
+def start_listener():
+    """Start this process's invalidation listener (once) and return it."""
+    global _listener
+    with _listener_lock:
+        if _listener is None:
+            _listener = InvalidationListener()
+            _listener.start()
+        return _listener
+
+
+def _write_from_other_process(user_id, ticket_id):
+    db.add_subscription(user_id, "changed", "DA", "DA", None, "invalidation_check", None, None, user_id)
+    db.transition_ticket(ticket_id, "Pending DA Action", "invalidation_check", "check", None)
+
+
+def check(timeout=5.0):
+    """Cache a subscription and a ticket, change both from another process and wait for eviction."""
+    user_id = 8999999
+    db.init_db()
+    listener = start_listener()
+    if not listener.connected.wait(timeout):
+        print("FAIL listener did not connect")
+        return False
+
+    db.add_subscription(user_id, "original", "DA", "DA", None, "invalidation_check", None, None, user_id)
+    ticket_id = db.add_ticket("INVALIDATION-CHECK", "check", "check", "check", "check", None, "Opened", user_id)
+    deadline = time.monotonic() + timeout
+    while listener.received < 2 and time.monotonic() < deadline:
+        time.sleep(0.05)  # let our own notifications arrive before caching
+    try:
+        before = (db.get_subscription(user_id, "DA")["phone"], db.get_ticket(ticket_id)["status"])
+        received = listener.received
+        child = multiprocessing.get_context("spawn").Process(
+            target=_write_from_other_process, args=(user_id, ticket_id))
+        child.start()
+        child.join()
+        deadline = time.monotonic() + timeout
+        while listener.received < received + 2 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        after = (db.get_subscription(user_id, "DA")["phone"], db.get_ticket(ticket_id)["status"])
+    finally:
+        with db.get_connection() as conn:
+            conn.execute(db.text("DELETE FROM tickets WHERE ticket_id = :id"), {"id": ticket_id})
+            conn.execute(db.text("DELETE FROM subscriptions WHERE user_id = :id"), {"id": user_id})
+            conn.commit()
+
+    expected = ("changed", "Pending DA Action")
+    print(f"cached before: {before}, after other process wrote: {after}")
+    print(db.cache_stats())
+    if after != expected:
+        print("FAIL cache entries were not invalidated")
+        return False
+    print("ok")
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--check", action="store_true", help="verify cross-process eviction and exit")
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    if args.check:
+        sys.exit(0 if check() else 1)
+    listener = InvalidationListener(on_message=print)
+    listener.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,33 +1,132 @@
 # main.py
+"""
+Runs the three bots and the notification dispatcher.
+
+  --mode processes   one process each (the default, RUN_MODE)
+  --mode single      all in this process: the bots' applications on one event
+                     loop, which the dispatcher's sends share, with one DB pool,
+                     one set of caches and one Bot (connection pool) per token
+  --mode webhook     as single, but Telegram POSTs the updates to WEBHOOK_URL
+                     instead of the bots polling for them (see webhook.py);
+                     one replica serves them, others may stand by behind a
+                     load balancer
+
+    python main.py
+    python main.py --mode single
+    WEBHOOK_URL=https://bots.example.com/telegram WEBHOOK_SECRET=... python main.py --mode webhook
+"""
+import argparse
+import asyncio
 import logging
 import multiprocessing
+import signal
+import config
 import db
+import invalidation
+import notifier
+import webhook
+import da_bot
+import supervisor_bot
+import client_bot
 from da_bot import main as da_main
 from supervisor_bot import main as supervisor_main
 from client_bot import main as client_main
+from dispatcher import Dispatcher, serve as dispatcher_main
 
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
                    level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-if __name__ == '__main__':
+BOTS = ((da_bot, config.DA_BOT_TOKEN), (supervisor_bot, config.SUPERVISOR_BOT_TOKEN),
+        (client_bot, config.CLIENT_BOT_TOKEN))
+
+
+def run_processes():
+    # The children must not share the connections init_db() left in the pool
+    db.engine.dispose()
+    p1 = multiprocessing.Process(target=da_main)
+    p2 = multiprocessing.Process(target=supervisor_main)
+    p3 = multiprocessing.Process(target=client_main)
+    # Sends the notifications the bots queue in the outbox
+    p4 = multiprocessing.Process(target=dispatcher_main)
+
+    p1.start()
+    p2.start()
+    p3.start()
+    p4.start()
+
+    p1.join()
+    p2.join()
+    p3.join()
+    p4.join()
+
+
+async def run_single(use_webhook=False):
+    """Run every bot and the dispatcher on this event loop until SIGINT or SIGTERM.
+
+    The bots poll for their updates, or with use_webhook take them from a
+    webhook.WebhookServer.
+    """
+    loop = asyncio.get_running_loop()
+    stopping = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+    notifier.use_loop(loop)
+    invalidation.start_listener()
+    builders = [notifier.application_builder(token, shared=True) for _, token in BOTS]
+    if use_webhook:
+        builders = [builder.updater(None) for builder in builders]
+    applications = [module.build_application(builder) for (module, _), builder in zip(BOTS, builders)]
+    server = webhook.WebhookServer(dict(zip(webhook.BOT_PATHS, applications))) if use_webhook else None
+    dispatcher = Dispatcher().start()
+    started = []
+    try:
+        if server:
+            # Up first, so /healthz answers 503 until the bots are started
+            await server.start()
+        for application in applications:
+            await application.initialize()
+            started.append(application)
+            if application.post_init:
+                await application.post_init(application)
+            if application.updater:
+                await application.updater.start_polling()
+            await application.start()
+        if server and config.WEBHOOK_URL:
+            await webhook.set_webhooks({name: app.bot for name, app in zip(webhook.BOT_PATHS, applications)})
+        logger.info("All bots started in one process.")
+        await stopping.wait()
+    finally:
+        if server:
+            await server.stop()
+        # Its workers wait on this loop for their sends
+        await asyncio.to_thread(dispatcher.stop)
+        for application in reversed(started):
+            if application.updater and application.updater.running:
+                await application.updater.stop()
+            if application.running:
+                await application.stop()
+            await application.shutdown()
+            if application.post_shutdown:
+                await application.post_shutdown(application)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=("processes", "single", "webhook"), default=config.RUN_MODE)
+    args = parser.parse_args()
     try:
         logger.info("Initializing database...")
         db.init_db()
-        logger.info("Starting all bots...")
-        
-        p1 = multiprocessing.Process(target=da_main)
-        p2 = multiprocessing.Process(target=supervisor_main)
-        p3 = multiprocessing.Process(target=client_main)
-        
-        p1.start()
-        p2.start()
-        p3.start()
-        
-        p1.join()
-        p2.join()
-        p3.join()
-        
+        logger.info("Starting all bots (%s)...", args.mode)
+        if args.mode in ("single", "webhook"):
+            asyncio.run(run_single(use_webhook=args.mode == "webhook"))
+        else:
+            run_processes()
     except Exception as e:
         logger.error(f"Error in main: {e}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,649 @@
 # notifier.py
+import asyncio
+import hashlib
+import html
+import logging
+import threading
+import time
+from collections import Counter, OrderedDict, deque, namedtuple
+from datetime import timedelta
+
+import httpx
 from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
+from telegram.ext import ApplicationBuilder
+from telegram.request import HTTPXRequest
 import db
 import config
-import logging
 from config import DA_BOT_TOKEN, SUPERVISOR_BOT_TOKEN, CLIENT_BOT_TOKEN
+from persistence import PostgresPersistence
+from update_processor import ChatOrderedUpdateProcessor
 
 logger = logging.getLogger(__name__)
 
-# Create standalone Bot objects (used only for sending notifications)
-da_bot = Bot(token=DA_BOT_TOKEN)
-supervisor_bot = Bot(token=SUPERVISOR_BOT_TOKEN)
-client_bot = Bot(token=CLIENT_BOT_TOKEN)
+# -----------------------------------------------------------------------------
+# Fan-out engine
+# -----------------------------------------------------------------------------
+# Telegram allows a bot about 30 messages per second overall and about one per
+# second to the same chat; going over gets 429 RetryAfter responses.
+GLOBAL_RATE = 30
+# Sends that may go out at once after an idle period. The bucket refills at
+# GLOBAL_RATE - GLOBAL_BURST per second, so no one-second window exceeds GLOBAL_RATE.
+GLOBAL_BURST = 5
+PER_CHAT_RATE = 1
+MAX_CONCURRENT_SENDS = 16
+MAX_ATTEMPTS = 3
+MAX_CHAT_BUCKETS = 10000
+# Priority lanes, most urgent first. Each has its own dispatcher workers, and its
+# config.OUTBOX_LANE_SHARES share of a bot's rate budget whenever lanes compete.
+LANES = ("urgent", "normal", "bulk")
 
-def notify_supervisors(ticket):
-    bot = Bot(token=config.SUPERVISOR_BOT_TOKEN)
-    
-    text = (
+# Outcome of one send: message is the sent telegram.Message, error the last exception
+Delivery = namedtuple("Delivery", "chat_id ok message error attempts")
+
+
+class TokenBucket:
+    """Async token bucket: `rate` tokens per second, bursts of up to `capacity`."""
+
+    def __init__(self, rate, capacity=1, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self._clock = clock
+        self._tokens = capacity
+        self._updated = clock()
+        self._paused_until = 0.0
+
+    async def acquire(self):
+        while True:
+            now = self._clock()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds):
+        """Hand out no tokens for the next `seconds` (after a RetryAfter)."""
+        self._paused_until = max(self._paused_until, self._clock() + seconds)
+
+
+class LaneBucket:
+    """A TokenBucket shared by the priority lanes in proportion to their shares.
+
+    Tokens go to the waiting lane that has been granted the least relative to its
+    share (stride scheduling), so while lanes compete each gets its share of the
+    rate, and a lone waiter gets every token. A new-ticket alert queued behind a
+    bulk fan-out therefore waits for at most a token or two, not for the fan-out.
+    """
+
+    def __init__(self, rate, capacity=1, shares=None, clock=time.monotonic):
+        self.bucket = TokenBucket(rate, capacity, clock)
+        shares = shares or {}
+        self.shares = {lane: shares.get(lane) or 1.0 for lane in LANES}
+        self._waiters = {lane: deque() for lane in LANES}
+        self._pass = dict.fromkeys(LANES, 0.0)
+        self._granted = 0.0  # pass of the lane granted last: where a lane that was idle resumes
+        self._granter = None
+
+    async def acquire(self, lane="normal"):
+        waiters = self._waiters[lane]
+        if not waiters:
+            # An idle lane does not bank the tokens it did not use
+            self._pass[lane] = max(self._pass[lane], self._granted)
+        waiter = asyncio.get_running_loop().create_future()
+        waiters.append(waiter)
+        if self._granter is None or self._granter.done():
+            self._granter = asyncio.ensure_future(self._grant())
+        await waiter
+
+    async def _grant(self):
+        while True:
+            for waiters in self._waiters.values():
+                while waiters and waiters[0].done():  # cancelled while waiting
+                    waiters.popleft()
+            lanes = [lane for lane in LANES if self._waiters[lane]]
+            if not lanes:
+                return
+            await self.bucket.acquire()
+            lanes = [lane for lane in LANES if self._waiters[lane] and not self._waiters[lane][0].done()]
+            if not lanes:
+                continue  # everyone waiting gave up while the token refilled
+            lane = min(lanes, key=lambda lane: self._pass[lane])
+            self._granted = self._pass[lane]
+            self._pass[lane] += 1 / self.shares[lane]
+            self._waiters[lane].popleft().set_result(None)
+
+
+def _bot_key(bot):
+    # file_ids are only valid for the bot that received them
+    return bot.token.split(":")[0]
+
+
+_photo_uploads = {}  # (bot key, image URL) -> asyncio.Lock held while the first send uploads it
+
+
+async def send_photo(bot, chat_id, photo, caption=None, reply_markup=None, parse_mode="HTML"):
+    """bot.send_photo(), reusing the file_id from this bot's earlier send of the same image URL.
+
+    Sent by URL, Telegram downloads the image again for every recipient; sent by
+    file_id it reuses its stored copy. Concurrent sends of a new image wait for
+    the first one's file_id. If Telegram rejects a stored file_id the URL is sent
+    instead and the new file_id stored.
+    """
+    if not (isinstance(photo, str) and photo.startswith(("http://", "https://"))):
+        return await bot.send_photo(chat_id=chat_id, photo=photo, caption=caption,
+                                    reply_markup=reply_markup, parse_mode=parse_mode)
+    key = _bot_key(bot)
+    file_id = await asyncio.to_thread(db.get_photo_file_id, photo, key)
+    if not file_id:
+        upload = _photo_uploads.setdefault((key, photo), asyncio.Lock())
+        try:
+            async with upload:
+                file_id = await asyncio.to_thread(db.get_photo_file_id, photo, key)
+                if not file_id:
+                    return await _send_photo_url(bot, key, chat_id, photo, caption, reply_markup, parse_mode)
+        finally:
+            if not upload.locked():
+                _photo_uploads.pop((key, photo), None)
+    try:
+        return await bot.send_photo(chat_id=chat_id, photo=file_id, caption=caption,
+                                    reply_markup=reply_markup, parse_mode=parse_mode)
+    except BadRequest as e:
+        if "file" not in str(e).lower():
+            raise
+        logger.warning("Stored file_id for %s rejected, sending the URL: %s", photo, e)
+        await asyncio.to_thread(db.forget_photo_file_id, photo, key, file_id)
+    return await _send_photo_url(bot, key, chat_id, photo, caption, reply_markup, parse_mode)
+
+
+async def _send_photo_url(bot, key, chat_id, photo, caption, reply_markup, parse_mode):
+    message = await bot.send_photo(chat_id=chat_id, photo=photo, caption=caption,
+                                   reply_markup=reply_markup, parse_mode=parse_mode)
+    if message.photo:
+        await asyncio.to_thread(db.set_photo_file_id, photo, key, message.photo[-1].file_id)
+    return message
+
+
+def _seconds(retry_after):
+    return retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+
+
+class FanOut:
+    """Sends one bot's messages concurrently within Telegram's rate limits.
+
+    All methods are coroutines and must run on the notifier event loop (see run()).
+    """
+
+    def __init__(self, bot, global_rate=GLOBAL_RATE, global_burst=GLOBAL_BURST, per_chat_rate=PER_CHAT_RATE,
+                 max_concurrency=MAX_CONCURRENT_SENDS, lane_shares=None):
+        self.bot = bot
+        self.per_chat_rate = per_chat_rate
+        self.global_bucket = LaneBucket(global_rate - global_burst, capacity=global_burst,
+                                        shares=config.OUTBOX_LANE_SHARES if lane_shares is None else lane_shares)
+        self._chat_buckets = OrderedDict()
+        self._max_concurrency = max_concurrency
+        self._semaphore = None
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.pop(chat_id, None) or TokenBucket(self.per_chat_rate)
+        self._chat_buckets[chat_id] = bucket
+        if len(self._chat_buckets) > MAX_CHAT_BUCKETS:
+            self._chat_buckets.popitem(last=False)
+        return bucket
+
+    async def send(self, chat_id, text, reply_markup=None, photo=None, parse_mode="HTML", lane="normal"):
+        """Send a message (or a photo with `text` as its caption) and return its Delivery."""
+        if photo:
+            return await self._call(chat_id, lambda: send_photo(self.bot, chat_id, photo, text, reply_markup,
+                                                                parse_mode), lane)
+        return await self._call(chat_id, lambda: self.bot.send_message(chat_id=chat_id, text=text,
+                                                                       reply_markup=reply_markup,
+                                                                       parse_mode=parse_mode), lane)
+
+    async def edit(self, chat_id, message_id, text, reply_markup=None, caption=False, parse_mode="HTML",
+                   lane="normal"):
+        """Replace a sent message's text (its caption, for a photo) and keyboard; returns its Delivery.
+
+        reply_markup=None removes the keyboard.
+        """
+        if caption:
+            return await self._call(chat_id, lambda: self.bot.edit_message_caption(
+                chat_id=chat_id, message_id=message_id, caption=text, reply_markup=reply_markup,
+                parse_mode=parse_mode), lane)
+        return await self._call(chat_id, lambda: self.bot.edit_message_text(
+            chat_id=chat_id, message_id=message_id, text=text, reply_markup=reply_markup, parse_mode=parse_mode),
+            lane)
+
+    async def _call(self, chat_id, request, lane="normal"):
+        """Await request() within the rate limits (lane's share of the global one), retrying
+        flood waits and network errors."""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._max_concurrency)
+        bucket = self._chat_bucket(chat_id)
+        error = None
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            await bucket.acquire()
+            await self.global_bucket.acquire(lane)
+            try:
+                async with self._semaphore:
+                    message = await request()
+                return Delivery(chat_id, True, message, None, attempt)
+            except RetryAfter as e:
+                error = e
+                bucket.pause(_seconds(e.retry_after))
+            except (BadRequest, TimedOut) as e:
+                # Not retried: a bad request fails again, and a timed out one may have been delivered
+                return Delivery(chat_id, False, None, e, attempt)
+            except NetworkError as e:
+                error = e
+                await asyncio.sleep(0.5 * 2 ** (attempt - 1))
+            except Exception as e:
+                return Delivery(chat_id, False, None, e, attempt)
+        return Delivery(chat_id, False, None, error, MAX_ATTEMPTS)
+
+    async def send_many(self, chat_ids, text, reply_markup=None, photo=None, parse_mode="HTML", lane="normal"):
+        """Send the same message to every chat at once; returns one Delivery per distinct chat."""
+        return await asyncio.gather(*(
+            self.send(chat_id, text, reply_markup, photo, parse_mode, lane) for chat_id in dict.fromkeys(chat_ids)
+        ))
+
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def _event_loop():
+    """The notifier's event loop, running in a daemon thread started on first use."""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="notifier", daemon=True).start()
+            _loop = loop
+        return _loop
+
+
+def run(coro, timeout=None):
+    """Run a coroutine on the notifier loop from synchronous code and return its result."""
+    return asyncio.run_coroutine_threadsafe(coro, _event_loop()).result(timeout)
+
+
+def use_loop(loop):
+    """Use loop, which the caller runs, as the notifier loop instead of starting a thread for one.
+
+    For a process that runs the bots' applications on loop (main.py --mode single):
+    the dispatcher's sends then share it and the Bots from get_bot(). Call it
+    before anything uses the notifier loop. run() must then not be called from
+    loop's own thread, which it would block.
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is not None and _loop is not loop:
+            raise RuntimeError("the notifier loop is already running")
+        _loop = loop
+
+
+# -----------------------------------------------------------------------------
+# Bot registry
+# -----------------------------------------------------------------------------
+class ConnectionCounter:
+    """Counts one Bot's HTTP requests and the connections its pool had to open.
+
+    Fed by httpcore trace events; requests - connections were sent over a reused
+    keep-alive connection.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.connections = 0
+        self.tls_handshakes = 0
+
+    async def on_request(self, request):
+        request.extensions["trace"] = self._trace
+
+    async def _trace(self, event, info):
+        if event == "connection.connect_tcp.complete":
+            self.connections += 1
+        elif event == "connection.start_tls.complete":
+            self.tls_handshakes += 1
+        elif event.endswith(".send_request_headers.started"):
+            self.requests += 1
+
+    def stats(self):
+        return {"requests": self.requests, "connections": self.connections,
+                "tls_handshakes": self.tls_handshakes, "reused": max(0, self.requests - self.connections)}
+
+
+def make_bot(token, counter=None, base_url=None, pool_size=config.TELEGRAM_POOL_SIZE,
+             keepalive_expiry=config.TELEGRAM_KEEPALIVE_EXPIRY):
+    """A Bot whose connection pool keeps up to pool_size connections alive for keepalive_expiry seconds.
+
+    Prefer get_bot(), which shares one Bot per token; this is for tests and benchmarks.
+    """
+    limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size,
+                          keepalive_expiry=keepalive_expiry)
+    httpx_kwargs = {"limits": limits}
+    if counter is not None:
+        httpx_kwargs["event_hooks"] = {"request": [counter.on_request]}
+    request = HTTPXRequest(connection_pool_size=pool_size, httpx_kwargs=httpx_kwargs)
+    return Bot(token=token, base_url=base_url or config.TELEGRAM_BASE_URL,
+               base_file_url=config.TELEGRAM_BASE_FILE_URL, request=request)
+
+
+_bots = {}  # token -> (Bot, ConnectionCounter)
+_bots_lock = threading.Lock()
+
+
+def get_bot(token):
+    """This process's Bot for token, created on first use. Use it for every send.
+
+    Its requests must run on the notifier loop (see run()): the connection pool
+    belongs to the event loop that opened it.
+    """
+    with _bots_lock:
+        if token not in _bots:
+            counter = ConnectionCounter()
+            _bots[token] = (make_bot(token, counter), counter)
+        return _bots[token][0]
+
+
+def connection_stats():
+    """{bot id: ConnectionCounter.stats()} for every Bot get_bot() created."""
+    with _bots_lock:
+        return {token.split(":")[0]: counter.stats() for token, (_, counter) in _bots.items()}
+
+
+def application_builder(token, shared=False):
+    """An ApplicationBuilder for one of the bots (da_bot.build_application(), ...).
+
+    The application talks to TELEGRAM_BASE_URL, handles up to
+    BOT_CONCURRENT_UPDATES updates at once, each chat's in order
+    (update_processor.ChatOrderedUpdateProcessor), and keeps its conversations
+    and user_data in Postgres (persistence.PostgresPersistence). shared=True gives it get_bot(token), the notifier's own Bot,
+    so its handlers and the dispatcher use one connection pool; the application
+    must then run on the notifier loop (see use_loop()).
+    """
+    bot_id = token.split(":")[0]
+    builder = (ApplicationBuilder().concurrent_updates(ChatOrderedUpdateProcessor(name=bot_id))
+               .persistence(PostgresPersistence(bot_id)))
+    if shared:
+        return builder.bot(get_bot(token))
+    return builder.token(token).base_url(config.TELEGRAM_BASE_URL).base_file_url(config.TELEGRAM_BASE_FILE_URL)
+
+
+def make_sender(token):
+    return FanOut(get_bot(token))
+
+
+# Senders used by the dispatcher, keyed by outbox.bot
+senders = {
+    "DA": make_sender(DA_BOT_TOKEN),
+    "Supervisor": make_sender(SUPERVISOR_BOT_TOKEN),
+    "Client": make_sender(CLIENT_BOT_TOKEN),
+}
+
+
+# -----------------------------------------------------------------------------
+# Notifications
+# -----------------------------------------------------------------------------
+# Nothing below talks to Telegram: each function renders its message and queues
+# one outbox row per recipient, and dispatcher.py sends them. Pass the caller's
+# transaction as conn (db.add_ticket(notify=...), db.apply_transition(notify=...))
+# so the notification commits with the write that caused it.
+#
+# Every message sent about a ticket is recorded in notification_messages (one per
+# ticket, bot and chat: the latest). A row's mode says what to do with it:
+#   send     a new message, for events the recipient has to act on
+#   edit     replace the recorded message's text and keyboard; sent new if there is none
+#   refresh  append the current status (the row's text) to the recorded message and
+#            swap its keyboard for card_markup(); nothing if there is none
+#   digest   one line (the row's text) of a summary message: see queue_for_supervisors()
+QUEUE_MODES = ("send", "edit", "refresh", "digest")
+
+# The priority lane (LANES) of each kind of notification; other kinds, and digest
+# entries of any kind, go in "normal". queue(lane=...) overrides it.
+KIND_LANES = {
+    "notify_supervisors": "urgent",  # new and reassigned tickets
+    "notify_da_moreinfo": "urgent",  # a supervisor needs more info from the DA
+    "send_to_client": "bulk",  # one message per contact of the client
+    "notify_client": "bulk",
+    "refresh": "bulk",  # status updates of messages already sent
+    "broadcast": "bulk",
+}
+
+# Entries per digest message; a longer digest is split
+DIGEST_MAX_ENTRIES = 20
+DIGEST_BUTTONS_PER_ROW = 4
+
+
+def event_key(kind, ticket, *parts):
+    """A dedup_key for queue(): one notification of `kind` per recipient per ticket event.
+
+    Transitions bump event_seq, so a double-tapped button that re-runs the same
+    notification for the same event finds its key already queued.
+    """
+    return ":".join(map(str, (kind, ticket['ticket_id'], ticket.get('event_seq')) + parts))
+
+
+def content_key(text):
+    """Short digest of a message, for dedup keys of sends that do not change the ticket."""
+    return hashlib.sha1(text.encode()).hexdigest()[:12]
+
+
+# The same message sent again about a ticket within this many seconds is a double tap
+DOUBLE_TAP_WINDOW = 10
+
+
+def double_tap_keys(kind, ticket_id, text, window=DOUBLE_TAP_WINDOW):
+    """The dedup_key and skip_keys for queue() of a send that does not change the ticket
+    (no new event_seq).
+
+    The key names the `window`-second bucket it falls in, and the previous
+    bucket's key is skipped too. So the same text queued again within `window`
+    seconds (a double-tapped button) is dropped, even across a bucket boundary,
+    and a deliberate resend goes through once it is at least 2 x `window` later.
+    """
+    bucket = int(time.time() // window)
+    key, previous = (":".join(map(str, (kind, ticket_id, content_key(text), b))) for b in (bucket, bucket - 1))
+    return key, (previous,)
+
+
+# Notifications queue() skipped because their dedup_key was already queued, by kind
+suppressed_duplicates = Counter()
+
+
+def queue(conn, bot, chat_ids, text, reply_markup=None, photo=None, kind="message", ticket_id=None,
+          mode="send", dedup_key=None, lane=None, skip_keys=()):
+    """Queue a message from `bot` to every chat in chat_ids; returns the number queued.
+
+    With conn=None the rows are committed in a transaction of their own. With a
+    dedup_key (event_key()), chats that already have it, or any of skip_keys,
+    queued are skipped and counted in suppressed_duplicates. lane defaults to the
+    kind's KIND_LANES entry.
+    """
+    if mode not in QUEUE_MODES:
+        raise ValueError(f"Unknown notification mode {mode!r}")
+    lane = "normal" if mode == "digest" else lane or KIND_LANES.get(kind, "normal")
+    if lane not in LANES:
+        raise ValueError(f"Unknown notification lane {lane!r}")
+    payload = {"text": text, "reply_markup": reply_markup.to_dict() if reply_markup else None, "photo": photo,
+               "mode": mode}
+    digest_window = config.SUPERVISOR_DIGEST_WINDOW if mode == "digest" else None
+    if conn is not None:
+        count = db.enqueue_notifications(conn, bot, chat_ids, kind, payload, ticket_id, digest_window, dedup_key,
+                                         lane, skip_keys)
+    else:
+        with db.get_connection() as conn:
+            count = db.enqueue_notifications(conn, bot, chat_ids, kind, payload, ticket_id, digest_window,
+                                             dedup_key, lane, skip_keys)
+            conn.commit()
+    duplicates = len({chat_id for chat_id in chat_ids if chat_id}) - count
+    if duplicates:
+        suppressed_duplicates[kind] += duplicates
+        logger.info("Suppressed %d duplicate %s notification(s) (%s)", duplicates, kind, dedup_key)
+    return count
+
+
+def is_urgent(ticket):
+    return ticket['issue_type'] in config.URGENT_ISSUE_TYPES
+
+
+def supervisor_chat_ids(conn, ticket):
+    """The chats a ticket's supervisor notifications go to: its assignee's, or every supervisor's.
+
+    With SUPERVISOR_ASSIGNMENT an assignee who is away hands the ticket to another
+    supervisor first. Either way the assignee's reassignment timeout restarts.
+    """
+    assignee = ticket.get('assigned_supervisor_id') if config.SUPERVISOR_ASSIGNMENT else None
+    if assignee and conn is not None:
+        supervisor = db.get_user(assignee, "Supervisor")
+        if supervisor and supervisor.get('available', True):
+            db.touch_assignment(conn, ticket['ticket_id'])
+            return [supervisor['chat_id']]
+        assigned = db.assign_supervisor(conn, ticket['ticket_id'], [assignee], config.ASSIGNMENT_AFFINITY_SLACK)
+        if assigned:
+            logger.info("Ticket %s moved from unavailable supervisor %s to %s",
+                        ticket['ticket_id'], assignee, assigned.user_id)
+            return [assigned.chat_id]
+    return [sup['chat_id'] for sup in db.get_supervisors()]
+
+
+def queue_for_supervisors(conn, ticket, text, reply_markup, digest_line, kind, photo=None, urgent=False,
+                          chat_ids=None, dedup_key=None):
+    """Queue a ticket event for its supervisors (supervisor_chat_ids() unless chat_ids is
+    given): the full message, or in digest mode (SUPERVISOR_DIGEST_WINDOW) just
+    digest_line, unless the event is urgent."""
+    if chat_ids is None:
+        chat_ids = supervisor_chat_ids(conn, ticket)
+    if config.SUPERVISOR_DIGEST_WINDOW > 0 and not (urgent or is_urgent(ticket)):
+        return queue(conn, "Supervisor", chat_ids, digest_line, kind=kind, ticket_id=ticket['ticket_id'],
+                     mode="digest", dedup_key=dedup_key)
+    return queue(conn, "Supervisor", chat_ids, text, reply_markup, photo=photo, kind=kind,
+                 ticket_id=ticket['ticket_id'], dedup_key=dedup_key)
+
+
+def render_digest(rows):
+    """The text and keyboard of one summary message for digest rows (at most DIGEST_MAX_ENTRIES)."""
+    text = f"📋 <b>ملخص التذاكر ({len(rows)})</b>\n\n" + "\n".join(row.payload["text"] for row in rows)
+    ticket_ids = list(dict.fromkeys(row.ticket_id for row in rows if row.ticket_id is not None))
+    buttons = [InlineKeyboardButton(f"#{ticket_id}", callback_data=f"view|{ticket_id}|digest")
+               for ticket_id in ticket_ids]
+    keyboard = [buttons[i:i + DIGEST_BUTTONS_PER_ROW] for i in range(0, len(buttons), DIGEST_BUTTONS_PER_ROW)]
+    return text, InlineKeyboardMarkup(keyboard) if keyboard else None
+
+
+def card_markup(bot, ticket):
+    """The keyboard a message from `bot` about ticket should show in its current status, or None."""
+    ticket_id, status = ticket['ticket_id'], ticket['status']
+    if status == "Closed":
+        return None
+    if bot == "Supervisor":
+        keyboard = [
+            [InlineKeyboardButton("حل المشكلة", callback_data=f"solve|{ticket_id}")],
+            [InlineKeyboardButton("طلب معلومات إضافية", callback_data=f"moreinfo|{ticket_id}")],
+            [InlineKeyboardButton("إرسال إلى العميل", callback_data=f"sendclient|{ticket_id}")]
+        ]
+        if status == "Client Responded":
+            keyboard.insert(0, [InlineKeyboardButton("إرسال للحالة إلى الوكيل", callback_data=f"sendto_da|{ticket_id}")])
+    elif bot == "DA" and status == "Pending DA Action":
+        keyboard = [[InlineKeyboardButton("إغلاق التذكرة", callback_data=f"close|{ticket_id}")]]
+    elif bot == "DA" and status == "Pending DA Response":
+        keyboard = [[InlineKeyboardButton("تطبيق المعلومات", callback_data=f"da_moreinfo|{ticket_id}")]]
+    elif bot == "Client" and status in db.CLIENT_PENDING_STATUSES:
+        keyboard = [[InlineKeyboardButton("ارسال حل المشكلة", callback_data=f"solve|{ticket_id}|now")]]
+    else:
+        return None
+    return InlineKeyboardMarkup(keyboard)
+
+
+def refresh_cards(conn, ticket, skip_bots=()):
+    """Queue an in-place status update of every recorded message about ticket.
+
+    skip_bots are the bots whose chats get a new message about the same change.
+    Returns the number queued.
+    """
+    if conn is None:
+        with db.get_connection() as conn:
+            count = refresh_cards(conn, ticket, skip_bots)
+            conn.commit()
+        return count
+    chats_by_bot = {}
+    for bot, chat_id in db.list_notification_messages(conn, ticket['ticket_id']):
+        if bot not in skip_bots:
+            chats_by_bot.setdefault(bot, []).append(chat_id)
+    status_line = f"\n\n🔄 <b>الحالة الحالية:</b> {ticket['status']}"
+    return sum(
+        queue(conn, bot, chat_ids, status_line, card_markup(bot, ticket), kind="refresh",
+              dedup_key=event_key("refresh", ticket),
+              ticket_id=ticket['ticket_id'], mode="refresh")
+        for bot, chat_ids in chats_by_bot.items()
+    )
+
+
+def _not_modified(error):
+    return isinstance(error, BadRequest) and "not modified" in str(error).lower()
+
+
+async def deliver_digest(rows):
+    """Send digest rows for one chat (all from the same bot) as one summary message; returns its Delivery."""
+    text, reply_markup = render_digest(rows)
+    return await senders[rows[0].bot].send(rows[0].chat_id, text, reply_markup, lane=rows[0].lane)
+
+
+async def deliver(row, card=None):
+    """Carry out one claimed outbox row on the notifier loop.
+
+    card is the row's notification_messages record, if any. Returns (delivery,
+    action): action is 'send' or 'edit' for the call made, or 'skip' (delivery
+    None) when there was nothing to do.
+    """
+    sender = senders[row.bot]
+    payload = row.payload
+    mode = payload.get("mode", "send")
+    reply_markup = InlineKeyboardMarkup.de_json(payload.get("reply_markup"), sender.bot)
+    if mode == "refresh":
+        if card is None:
+            return None, "skip"
+        delivery = await sender.edit(row.chat_id, card.message_id, card.text + payload["text"], reply_markup,
+                                     caption=card.has_photo, lane=row.lane)
+        if not delivery.ok and isinstance(delivery.error, BadRequest):
+            # Unchanged, deleted, or too old to edit: a status refresh is not worth a new message
+            return None, "skip"
+        return delivery, "edit"
+    if mode == "edit" and card is not None:
+        delivery = await sender.edit(row.chat_id, card.message_id, payload["text"], reply_markup,
+                                     caption=card.has_photo, lane=row.lane)
+        if delivery.ok or _not_modified(delivery.error):
+            return delivery._replace(ok=True, error=None), "edit"
+        if not isinstance(delivery.error, BadRequest):
+            return delivery, "edit"
+        # The message is gone or can no longer be edited: send a new one
+    return await sender.send(row.chat_id, payload["text"], reply_markup, payload.get("photo"), lane=row.lane), "send"
+
+
+def notify_supervisors(ticket, conn=None, reassigned=False):
+    """Route a new ticket to a supervisor (SUPERVISOR_ASSIGNMENT) and queue it for them.
+
+    Without an available supervisor, or with assignment off, every supervisor gets
+    it. reassigned marks a ticket handed on by reassign_overdue().
+    """
+    chat_ids = None
+    if config.SUPERVISOR_ASSIGNMENT and conn is not None:
+        exclude = [ticket['assigned_supervisor_id']] if reassigned else []
+        assigned = db.assign_supervisor(conn, ticket['ticket_id'], exclude, config.ASSIGNMENT_AFFINITY_SLACK)
+        if assigned:
+            ticket = dict(ticket, assigned_supervisor_id=assigned.user_id)
+            chat_ids = [assigned.chat_id]
+        elif reassigned:
+            return 0
+        else:
+            logger.warning("No available supervisor for ticket %s, notifying all", ticket['ticket_id'])
+    header = "🔁 <b>تم تحويل التذكرة إليك</b>\n" if reassigned else ""
+    text = header + (
         f"🚨 <b>تذكرة جديدة #{ticket['ticket_id']}</b> تم إنشاؤها.\n"
         f"🔹 <b>رقم الطلب:</b> {ticket['order_id']}\n"
         f"🔹 <b>الوصف:</b> {ticket['issue_description']}\n"
@@ -24,62 +652,90 @@ def notify_supervisors(ticket):
         f"🔹 <b>العميل:</b> {ticket['client']}\n"
         f"🔹 <b>الحالة:</b> {ticket['status']}"
     )
-    
-    keyboard = [
-        [InlineKeyboardButton("حل المشكلة", callback_data=f"solve|{ticket['ticket_id']}")],
-        [InlineKeyboardButton("طلب معلومات إضافية", callback_data=f"moreinfo|{ticket['ticket_id']}")],
-        [InlineKeyboardButton("إرسال إلى العميل", callback_data=f"sendclient|{ticket['ticket_id']}")]
-    ]
-    if ticket['status'] == "Client Responded":
-        keyboard.insert(0, [InlineKeyboardButton("إرسال للحالة إلى الوكيل", callback_data=f"sendto_da|{ticket['ticket_id']}")])
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    supervisors = db.get_supervisors()
-    for sup in supervisors:
-        try:
-            if ticket.get("image_url"):
-                supervisor_bot.send_photo(chat_id=sup['chat_id'],
-                                          photo=ticket.get("image_url"),
-                                          caption=text,
-                                          reply_markup=reply_markup,
-                                          parse_mode="HTML")
+
+    reply_markup = card_markup("Supervisor", ticket)
+    digest_line = f"🆕 #{ticket['ticket_id']} · {ticket['order_id']} · {ticket['issue_type']} · {ticket['client']}"
+
+    # A reassigned ticket may come back to a supervisor who had it before: no key
+    return queue_for_supervisors(conn, ticket, text, reply_markup, digest_line, "notify_supervisors",
+                                 photo=ticket.get("image_url"), urgent=reassigned, chat_ids=chat_ids,
+                                 dedup_key=None if reassigned else event_key("notify_supervisors", ticket))
+
+
+def reassign_overdue(timeout=None):
+    """Hand each ticket that waited longer than timeout (ASSIGNMENT_TIMEOUT) for its
+    assignee to another available supervisor and notify them; returns the number moved.
+
+    A ticket nobody else can take stays with its assignee for another timeout.
+    """
+    timeout = config.ASSIGNMENT_TIMEOUT if timeout is None else timeout
+    moved = 0
+    while True:
+        with db.get_connection() as conn:
+            ticket = db.claim_overdue_assignment(conn, timeout)
+            if ticket is None:
+                return moved
+            if notify_supervisors(ticket, conn=conn, reassigned=True):
+                moved += 1
+                logger.info("Ticket %s reassigned from supervisor %s after %ss",
+                            ticket['ticket_id'], ticket['assigned_supervisor_id'], timeout)
             else:
-                supervisor_bot.send_message(chat_id=sup['chat_id'],
-                                            text=text,
-                                            reply_markup=reply_markup,
-                                            parse_mode="HTML")
-        except Exception as e:
-            logger.error(f"Error notifying supervisor {sup['chat_id']}: {e}")
-
-def notify_client(ticket):
+                db.touch_assignment(conn, ticket['ticket_id'])
+            conn.commit()
+        db.invalidate_ticket(ticket['ticket_id'])
+
+
+def advance_broadcasts(chunk=None):
+    """Queue the next chunk (BROADCAST_CHUNK_SIZE) of every running broadcast whose
+    previous chunks are mostly sent, and finish the ones fully sent; returns the
+    number of recipients queued.
+
+    Each chunk commits with the broadcast's checkpoint, so after a crash the
+    broadcast carries on after the last recipient queued, and the rows already
+    queued are sent by the outbox as usual. The dedup key sends each chat one copy.
+    """
+    chunk = chunk or config.BROADCAST_CHUNK_SIZE
+    queued = 0
+    for broadcast_id in db.running_broadcasts():
+        with db.get_connection() as conn:
+            broadcast = db.claim_broadcast(conn, broadcast_id)
+            if broadcast is None or broadcast['pending'] >= chunk:
+                continue
+            recipients = db.next_broadcast_recipients(conn, broadcast, chunk)
+            if recipients:
+                text = f"📢 <b>إعلان</b>\n\n{html.escape(broadcast['text'])}"
+                count = queue(conn, broadcast['bot'], [chat_id for _, chat_id in recipients], text,
+                              kind="broadcast", dedup_key=db.broadcast_key(broadcast_id))
+                db.checkpoint_broadcast(conn, broadcast_id, recipients[-1][0], count)
+                queued += count
+            elif broadcast['pending'] == 0:
+                db.finish_broadcast(conn, broadcast_id)
+                logger.info("Broadcast %s finished", broadcast_id)
+            conn.commit()
+    return queued
+
+
+def notify_client(ticket, conn=None):
     clients = db.get_users_by_role("client", client=ticket["client"])
-    for client in clients:
-        message = (
-            f"تم رفع بلاغ يتعلق بطلب {ticket['order_id']}.\n"
-            f"الوصف: {ticket['issue_description']}\n"
-            f"النوع: {ticket['issue_type']}"
-        )
-        buttons = [
-            [InlineKeyboardButton("عرض التفاصيل", callback_data=f"client_view|{ticket['ticket_id']}")]
-        ]
-        markup = InlineKeyboardMarkup(buttons)
-        try:
-            if ticket.get('image_url'):
-                client_bot.send_photo(chat_id=client["chat_id"], photo=ticket['image_url'],
-                                        caption=message, reply_markup=markup, parse_mode="HTML")
-            else:
-                client_bot.send_message(chat_id=client["chat_id"], text=message,
-                                        reply_markup=markup, parse_mode="HTML")
-        except Exception as e:
-            logger.error("Error notifying client: %s", e)
+    message = (
+        f"تم رفع بلاغ يتعلق بطلب {ticket['order_id']}.\n"
+        f"الوصف: {ticket['issue_description']}\n"
+        f"النوع: {ticket['issue_type']}"
+    )
+    buttons = [
+        [InlineKeyboardButton("عرض التفاصيل", callback_data=f"client_view|{ticket['ticket_id']}")]
+    ]
+    markup = InlineKeyboardMarkup(buttons)
+    return queue(conn, "Client", [client["chat_id"] for client in clients], message, markup,
+                 photo=ticket.get('image_url'), kind="notify_client", ticket_id=ticket['ticket_id'],
+                 dedup_key=event_key("notify_client", ticket))
 
-def notify_supervisors_da_moreinfo(ticket_id: int, additional_info: str):
-    ticket = db.get_ticket(ticket_id)
+def notify_supervisors_da_moreinfo(ticket_id: int, additional_info: str, ticket=None, conn=None):
+    if ticket is None:
+        ticket = db.get_ticket(ticket_id)
     if not ticket:
         logger.error("notify_supervisors_da_moreinfo: Ticket %s not found", ticket_id)
         return
-    bot = Bot(token=config.SUPERVISOR_BOT_TOKEN)
     text = (
         f"<b>معلومات إضافية من الوكيل للتذكرة #{ticket_id}</b>\n"
         f"🔹 رقم الطلب: {ticket['order_id']}\n"
@@ -89,24 +745,23 @@ def notify_supervisors_da_moreinfo(ticket_id: int, additional_info: str):
     )
     keyboard = [[InlineKeyboardButton("عرض التفاصيل", callback_data=f"view|{ticket_id}")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    supervisors = db.get_supervisors()
-    logger.info("notify_supervisors_da_moreinfo: Found %d supervisor(s).", len(supervisors))
-    if not supervisors:
+
+    chat_ids = supervisor_chat_ids(conn, ticket)
+    logger.info("notify_supervisors_da_moreinfo: Notifying %d supervisor(s).", len(chat_ids))
+    if not chat_ids:
         logger.error("notify_supervisors_da_moreinfo: No supervisors found in DB.")
         return
-    for sup in supervisors:
-        try:
-            bot.send_message(chat_id=sup['chat_id'], text=text, reply_markup=reply_markup, parse_mode="HTML")
-            logger.info("Notified supervisor %s for ticket %s", sup['chat_id'], ticket_id)
-        except Exception as e:
-            logger.error("notify_supervisors_da_moreinfo: Error notifying supervisor %s: %s", sup.get('chat_id'), e)
-def notify_da_moreinfo(ticket_id: int, additional_info: str):
-    ticket = db.get_ticket(ticket_id)
+    queued = queue(conn, "Supervisor", chat_ids, text, reply_markup,
+                   kind="notify_supervisors_da_moreinfo", ticket_id=ticket_id,
+                   dedup_key=event_key("notify_supervisors_da_moreinfo", ticket))
+    refresh_cards(conn, ticket, skip_bots=("Supervisor",))
+    return queued
+def notify_da_moreinfo(ticket_id: int, additional_info: str, ticket=None, conn=None):
+    if ticket is None:
+        ticket = db.get_ticket(ticket_id)
     if not ticket:
         logger.error("notify_da_moreinfo: Ticket %s not found", ticket_id)
         return
-    bot = Bot(token=config.DA_BOT_TOKEN)
     text = (
         f"<b>طلب معلومات إضافية للتذكرة #{ticket_id}</b>\n"
         f"رقم الطلب: {ticket['order_id']}\n"
@@ -121,12 +776,13 @@ def notify_da_moreinfo(ticket_id: int, additional_info: str):
     if not da_user:
         logger.error("notify_da_moreinfo: No DA subscription found for ticket %s", ticket_id)
         return
-    try:
-        bot.send_message(chat_id=da_user["chat_id"], text=text, reply_markup=reply_markup, parse_mode="HTML")
-        logger.info(f"Ticket {ticket_id} additional info sent to DA (Chat ID: {da_user['chat_id']}).")
-    except Exception as e:
-        logger.error("notify_da_moreinfo: Error notifying DA: %s", e)
-def notify_da(ticket, client_solution=None, info_request=False):
+    queued = queue(conn, "DA", [da_user["chat_id"]], text, reply_markup,
+                   kind="notify_da_moreinfo", ticket_id=ticket_id,
+                   dedup_key=event_key("notify_da_moreinfo", ticket))
+    refresh_cards(conn, ticket, skip_bots=("DA",))
+    logger.info(f"Ticket {ticket_id} additional info queued for DA (Chat ID: {da_user['chat_id']}).")
+    return queued
+def notify_da(ticket, client_solution=None, info_request=False, conn=None):
     logger.debug("notify_da called with info_request=%s", info_request)
     # Use db.get_user to retrieve the DA subscription.
     da_user = db.get_user(ticket["da_id"], "DA")
@@ -152,16 +808,12 @@ def notify_da(ticket, client_solution=None, info_request=False):
         )
         buttons = [[InlineKeyboardButton("إغلاق التذكرة", callback_data=f"close|{ticket['ticket_id']}")]]
     reply_markup = InlineKeyboardMarkup(buttons)
-    try:
-        da_sub = db.get_subscription(ticket["da_id"], "DA")
-        if da_sub:
-            chat_id = da_sub.get('chat_id')
-            if not chat_id:
-                logger.error(f"notify_da: No chat_id found for DA {ticket['da_id']}")
-                return
-            da_bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup, parse_mode="HTML")
-            logger.info(f"Ticket {ticket['ticket_id']} sent to DA (Chat ID: {chat_id}) with info_request={info_request}.")
-        else:
-            logger.error(f"notify_da: No subscription found for DA {ticket['da_id']}")
-    except Exception as e:
-        logger.error("Error notifying DA: %s", e)
\ No newline at end of file
+    chat_id = da_user.get('chat_id')
+    if not chat_id:
+        logger.error(f"notify_da: No chat_id found for DA {ticket['da_id']}")
+        return
+    queued = queue(conn, "DA", [chat_id], text, reply_markup, kind="notify_da", ticket_id=ticket['ticket_id'],
+                   dedup_key=event_key("notify_da", ticket), lane="urgent" if info_request else None)
+    refresh_cards(conn, ticket, skip_bots=("DA",))
+    logger.info(f"Ticket {ticket['ticket_id']} queued for DA (Chat ID: {chat_id}) with info_request={info_request}.")
+    return queued
@@ -0,0 +1,215 @@
+# persistence.py
+"""
+The bots' conversation states and user_data in Postgres (bot_state), so a restart
+doesn't drop a DA's ticket draft and any replica can carry on a conversation
+another one started.
+
+PTB keeps the hot copy: the ConversationHandlers' states and application.user_data
+stay in memory, and every PERSISTENCE_FLUSH_INTERVAL seconds the application hands
+PostgresPersistence the entries its updates touched. Those that differ from what
+is stored are written in one transaction, so handling an update adds no database
+round trip. A bot loads what is stored when it starts.
+
+Across replicas: each write NOTIFYs the keys it changed (db.save_bot_state), and
+every other process running invalidation.start_listener() reads those rows in
+its listener thread and puts them into its hot copy, conversation states at once
+and user_data before the user's next update is handled. A conversation can move
+to another replica only once the one that handled its last update has flushed
+(up to PERSISTENCE_FLUSH_INTERVAL later) and the NOTIFY has arrived. Nothing
+orders a chat's updates across processes, so an update handled elsewhere before
+then sees the previous state. That is enough for a restart or a standby taking
+over, but not for spreading one bot's updates over replicas (see webhook.py).
+
+Only user_data and conversations are stored: the bots keep nothing in chat_data
+or bot_data (da_bot's locus client is a module global).
+"""
+import asyncio
+import json
+import logging
+import uuid
+
+from telegram.ext import BasePersistence, ConversationHandler, PersistenceInput
+
+import config
+import db
+
+logger = logging.getLogger(__name__)
+
+USER_DATA = "user_data"
+CONVERSATION = "conversation:"  # + the handler's name
+# Tells this process's own writes apart from other replicas' in the NOTIFYs
+ORIGIN = uuid.uuid4().hex
+
+
+def _dump(data):
+    return None if data is None else json.dumps(data, sort_keys=True)
+
+
+class PostgresPersistence(BasePersistence):
+    """BasePersistence storing user_data and conversation states of bot (its id) in bot_state.
+
+    origin tells its writes apart from other replicas'; two in one process (a
+    benchmark) need different ones.
+    """
+
+    def __init__(self, bot, flush_interval=config.PERSISTENCE_FLUSH_INTERVAL, origin=ORIGIN):
+        super().__init__(store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True,
+                                                     callback_data=False),
+                         update_interval=flush_interval)
+        self.bot_id = bot
+        self.origin = origin
+        self._stored = {}  # (kind, key) -> data as stored, JSON
+        self._dirty = {}  # (kind, key) -> (data or None to delete, its JSON) waiting to be written
+        self._flushing = None  # task writing _dirty
+        self._remote_user_data = {}  # user_id -> user_data another replica stored
+        self._handlers = {}  # name -> persistent ConversationHandler, from attach()
+        self._loop = None
+        self.flushes = 0
+        self.written = 0
+        db.bot_state_listeners.append(self._on_remote_change)
+
+    # -- Loading ----------------------------------------------------------------
+    async def _load(self, kind):
+        self._loop = asyncio.get_running_loop()
+        rows = await db.run_async(db.load_bot_state, self.bot_id, kind)
+        for _, key, data in rows:
+            self._stored[(kind, key)] = _dump(data)
+        return [(key, data) for _, key, data in rows]
+
+    async def get_user_data(self):
+        return {int(key): data for key, data in await self._load(USER_DATA)}
+
+    async def get_conversations(self, name):
+        return {tuple(json.loads(key)): state for key, state in await self._load(CONVERSATION + name)}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    # -- Write-behind -----------------------------------------------------------
+    async def update_user_data(self, user_id, data):
+        self._stage(USER_DATA, str(user_id), data or None)
+
+    async def drop_user_data(self, user_id):
+        self._stage(USER_DATA, str(user_id), None)
+
+    async def update_conversation(self, name, key, new_state):
+        self._stage(CONVERSATION + name, json.dumps(list(key)), new_state)
+
+    def _stage(self, kind, key, data):
+        dumped = _dump(data)
+        if (kind, key) not in self._dirty and self._stored.get((kind, key)) == dumped:
+            return
+        self._dirty[(kind, key)] = (data, dumped)
+        self._schedule()
+
+    def _schedule(self):
+        if self._flushing is None or self._flushing.done():
+            self._flushing = asyncio.ensure_future(self._flush_soon())
+
+    async def _flush_soon(self):
+        # The application stages a whole run's entries at once: let it finish
+        await asyncio.sleep(0)
+        await self._flush()
+
+    async def _flush(self):
+        while self._dirty:
+            batch, self._dirty = self._dirty, {}
+            rows = [(kind, key, data) for (kind, key), (data, _) in batch.items()]
+            if not await db.run_async(db.save_bot_state, self.bot_id, rows, self.origin):
+                # Retried with the next run, unless they changed again meanwhile
+                for entry, value in batch.items():
+                    self._dirty.setdefault(entry, value)
+                asyncio.get_running_loop().call_later(self.update_interval, self._schedule)
+                return
+            for entry, (_, dumped) in batch.items():
+                if dumped is None:
+                    self._stored.pop(entry, None)
+                else:
+                    self._stored[entry] = dumped
+            self.flushes += 1
+            self.written += len(rows)
+
+    async def flush(self):
+        if self._flushing is not None:
+            await self._flushing
+        await self._flush()
+        if self._on_remote_change in db.bot_state_listeners:
+            db.bot_state_listeners.remove(self._on_remote_change)
+        if self.flushes:
+            logger.info("Bot %s: %d conversation state(s) and user_data written in %d flush(es)",
+                        self.bot_id, self.written, self.flushes)
+
+    # -- Other replicas' writes ---------------------------------------------------
+    def _on_remote_change(self, message):
+        """Invalidation listener thread: fetch the entries another replica wrote."""
+        if message.get("bot") != self.bot_id or message.get("origin") == self.origin or self._loop is None:
+            return
+        keys = [tuple(entry) for entry in message.get("keys", [])]
+        try:
+            found = {(kind, key): data for kind, key, data in db.load_bot_state(self.bot_id, keys=keys)}
+        except Exception as e:
+            logger.error("Error loading conversation state of bot %s: %s", self.bot_id, e)
+            return
+        self._loop.call_soon_threadsafe(self._apply_remote, [(kind, key, found.get((kind, key)))
+                                                             for kind, key in keys])
+
+    def _apply_remote(self, changes):
+        for kind, key, data in changes:
+            if (kind, key) in self._dirty:
+                continue  # changed here since: ours is newer
+            if data is None:
+                self._stored.pop((kind, key), None)
+            else:
+                self._stored[(kind, key)] = _dump(data)
+            if kind == USER_DATA:
+                self._remote_user_data[int(key)] = data or {}
+            elif kind.startswith(CONVERSATION) and kind[len(CONVERSATION):] in self._handlers:
+                # PTB has no public way to set a conversation's state; write it untracked,
+                # as the handler does with the states it loads
+                conversations = self._handlers[kind[len(CONVERSATION):]]._conversations
+                if data is None:
+                    conversations.data.pop(tuple(json.loads(key)), None)
+                else:
+                    conversations.update_no_track({tuple(json.loads(key)): data})
+
+    async def refresh_user_data(self, user_id, user_data):
+        data = self._remote_user_data.pop(user_id, None)
+        if data is not None:
+            user_data.clear()
+            user_data.update(data)
+
+    # -- Not stored -------------------------------------------------------------
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+
+def attach(application):
+    """Let application's persistent ConversationHandlers take the states other replicas
+    store. Call it once the handlers are added; does nothing without a PostgresPersistence."""
+    if not isinstance(application.persistence, PostgresPersistence):
+        return
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            if isinstance(handler, ConversationHandler) and handler.persistent:
+                application.persistence._handlers[handler.name] = handler
@@ -1,36 +1,38 @@
 #!/usr/bin/env python3
 # supervisor_bot.py
 
+import asyncio
+import io
 import logging
-import json
 import cloudinary
 import cloudinary.uploader
 from telegram import (
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
-    ForceReply,
-    Bot
+    ForceReply
 )
 from telegram.ext import (
-    Updater,
+    Application,
     CommandHandler,
     MessageHandler,
-    Filters,
+    filters,
     CallbackQueryHandler,
     ConversationHandler,
-    CallbackContext
+    ContextTypes
 )
 import db
 import config
+import notifier
+import persistence
 from notifier import notify_da_moreinfo, notify_da
+import invalidation
 
 # -----------------------------------------------------------------------------
 # Logging and Cloudinary configuration
 # -----------------------------------------------------------------------------
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
-da_bot = Bot(token=config.DA_BOT_TOKEN)
 
 cloudinary.config(
     cloud_name=config.CLOUDINARY_CLOUD_NAME,
@@ -75,26 +77,29 @@ ISSUE_OPTIONS = {
     "التسليم": ["وصول متاخر", "تالف", "عطل بالسياره"]
 }
 
+# Tickets shown per "show all" page; the rest are behind a "more" button
+TICKETS_PAGE_SIZE = 10
+
 def get_issue_types_for_reason(reason: str):
     return ISSUE_OPTIONS.get(reason, [])
 
 # -----------------------------------------------------------------------------
 # Helper: safe_edit_message
 # -----------------------------------------------------------------------------
-def safe_edit_message(query, text, reply_markup=None, parse_mode="HTML"):
+async def safe_edit_message(query, text, reply_markup=None, parse_mode="HTML"):
     if hasattr(query.message, "caption") and query.message.caption:
-        return query.edit_message_caption(caption=text, reply_markup=reply_markup, parse_mode=parse_mode)
+        return await query.edit_message_caption(caption=text, reply_markup=reply_markup, parse_mode=parse_mode)
     else:
-        return query.edit_message_text(text=text, reply_markup=reply_markup, parse_mode=parse_mode)
+        return await query.edit_message_text(text=text, reply_markup=reply_markup, parse_mode=parse_mode)
 
 # -----------------------------------------------------------------------------
 # Start & Subscription
 # -----------------------------------------------------------------------------
-def start(update: Update, context: CallbackContext) -> int:
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user = update.effective_user
-    sub = db.get_subscription(user.id, "Supervisor")
+    sub = await db.run_async(db.get_subscription, user.id, "Supervisor")
     if not sub:
-        update.message.reply_text("أهلاً! يرجى إدخال رقم هاتفك للاشتراك (Supervisor):")
+        await update.message.reply_text("أهلاً! يرجى إدخال رقم هاتفك للاشتراك (Supervisor):")
         return SUBSCRIPTION_PHONE
     else:
         keyboard = [
@@ -102,33 +107,75 @@ def start(update: Update, context: CallbackContext) -> int:
              InlineKeyboardButton("استعلام عن مشكلة", callback_data="menu_query_issue")]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
-        update.message.reply_text(f"مرحباً {user.first_name}", reply_markup=reply_markup)
+        await update.message.reply_text(f"مرحباً {user.first_name}", reply_markup=reply_markup)
         return MAIN_MENU
 
-def subscription_phone(update: Update, context: CallbackContext) -> int:
+async def subscription_phone(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     phone = update.message.text.strip()
     user = update.effective_user
-    db.add_subscription(user.id, phone, 'Supervisor', "Supervisor", None,
-                        user.username, user.first_name, user.last_name, update.effective_chat.id)
+    await db.run_async(db.add_subscription, user.id, phone, 'Supervisor', "Supervisor", None,
+                       user.username, user.first_name, user.last_name, update.effective_chat.id)
     keyboard = [
         [InlineKeyboardButton("عرض الكل", callback_data="menu_show_all"),
          InlineKeyboardButton("استعلام عن مشكلة", callback_data="menu_query_issue")]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    update.message.reply_text("تم الاشتراك بنجاح كـ Supervisor!", reply_markup=reply_markup)
+    await update.message.reply_text("تم الاشتراك بنجاح كـ Supervisor!", reply_markup=reply_markup)
     return MAIN_MENU
 
 # -----------------------------------------------------------------------------
 # Main Callback Handler
 # -----------------------------------------------------------------------------
-def supervisor_main_menu_callback(update: Update, context: CallbackContext) -> int:
+async def show_ticket_details(query, data):
+    """view|<ticket_id>[|digest]: the ticket's details and actions, in place of the message
+    pressed, or as a new message when pressed in a digest (so its other tickets stay)."""
+    parts = data.split("|")
+    ticket_id = int(parts[1])
+    from_digest = parts[-1] == "digest"
+
+    async def show(text, reply_markup=None):
+        if from_digest:
+            await query.message.reply_text(text, reply_markup=reply_markup, parse_mode="HTML")
+        else:
+            await safe_edit_message(query, text=text, reply_markup=reply_markup)
+
+    ticket = await db.run_async(db.get_ticket, ticket_id)
+    if not ticket:
+        await show("التذكرة غير موجودة.")
+        return
+    try:
+        logs = "\n".join([
+            f"{entry['timestamp'] or ''}: {entry['action']} - {entry['message'] or ''}"
+            for entry in await db.run_async(db.get_ticket_events, ticket_id)
+        ])
+    except Exception:
+        logs = "لا توجد سجلات إضافية."
+    text = (f"<b>تفاصيل التذكرة #{ticket['ticket_id']}</b>\n"
+            f"رقم الطلب: {ticket['order_id']}\n"
+            f"العميل: {ticket['client']}\n"
+            f"الوصف: {ticket['issue_description']}\n"
+            f"سبب المشكلة: {ticket['issue_reason']}\n"
+            f"نوع المشكلة: {ticket['issue_type']}\n"
+            f"الحالة: {ticket['status']}\n\n"
+            f"📝 <b>السجلات:</b>\n{logs}")
+    keyboard = [
+        [InlineKeyboardButton("حل المشكلة", callback_data=f"solve|{ticket_id}")],
+        [InlineKeyboardButton("طلب معلومات إضافية", callback_data=f"moreinfo|{ticket_id}")],
+        [InlineKeyboardButton("إرسال إلى العميل", callback_data=f"sendclient|{ticket_id}")]
+    ]
+    if ticket['status'] == "Client Responded":
+        keyboard.insert(0, [InlineKeyboardButton("إرسال للحالة إلى الوكيل", callback_data=f"sendto_da|{ticket_id}")])
+    await show(text, InlineKeyboardMarkup(keyboard))
+
+async def supervisor_main_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
-    query.answer()
+    await query.answer()
     data = query.data
     logger.debug("supervisor_main_menu_callback: Received data: %s", data)
 
-    if data == "menu_show_all":
-        tickets = db.get_all_open_tickets()
+    if data == "menu_show_all" or data.startswith("more_all|"):
+        cursor = db.decode_cursor(data.split("|", 1)[1]) if data.startswith("more_all|") else None
+        tickets, next_cursor = await db.run_async(db.get_open_tickets_page, cursor, TICKETS_PAGE_SIZE)
         if tickets:
             for ticket in tickets:
                 text = (f"<b>تذكرة #{ticket['ticket_id']}</b>\n"
@@ -139,68 +186,42 @@ def supervisor_main_menu_callback(update: Update, context: CallbackContext) -> i
                 keyboard = [[InlineKeyboardButton("عرض التفاصيل", callback_data=f"view|{ticket['ticket_id']}")]]
                 reply_markup = InlineKeyboardMarkup(keyboard)
                 if ticket.get('image_url'):
-                    query.bot.send_photo(
-                        chat_id=query.message.chat.id,
-                        photo=ticket['image_url'],
+                    await notifier.send_photo(
+                        context.bot,
+                        query.message.chat.id,
+                        ticket['image_url'],
                         caption=text,
-                        reply_markup=reply_markup,
-                        parse_mode="HTML"
+                        reply_markup=reply_markup
                     )
                 else:
-                    query.bot.send_message(
+                    await context.bot.send_message(
                         chat_id=query.message.chat.id,
                         text=text,
                         reply_markup=reply_markup,
                         parse_mode="HTML"
                     )
+            if next_cursor:
+                keyboard = [[InlineKeyboardButton("عرض المزيد",
+                                                  callback_data=f"more_all|{db.encode_cursor(next_cursor)}")]]
+                await context.bot.send_message(chat_id=query.message.chat.id, text="يوجد المزيد من التذاكر المفتوحة.",
+                                               reply_markup=InlineKeyboardMarkup(keyboard))
         else:
-            safe_edit_message(query, text="لا توجد تذاكر مفتوحة حالياً.")
+            await safe_edit_message(query, text="لا توجد تذاكر مفتوحة حالياً.")
         return MAIN_MENU
 
     elif data == "menu_query_issue":
-        safe_edit_message(query, text="أدخل رقم الطلب:")
+        await safe_edit_message(query, text="أدخل رقم الطلب:")
         return SEARCH_TICKETS
 
     elif data.startswith("view|"):
-        ticket_id = int(data.split("|")[1])
-        ticket = db.get_ticket(ticket_id)
-        if ticket:
-            try:
-                logs = ""
-                if ticket.get("logs"):
-                    logs_list = json.loads(ticket["logs"])
-                    logs = "\n".join([
-                        f"{entry.get('timestamp', '')}: {entry.get('action', '')} - {entry.get('message', '')}"
-                        for entry in logs_list
-                    ])
-            except Exception:
-                logs = "لا توجد سجلات إضافية."
-            text = (f"<b>تفاصيل التذكرة #{ticket['ticket_id']}</b>\n"
-                    f"رقم الطلب: {ticket['order_id']}\n"
-                    f"العميل: {ticket['client']}\n"
-                    f"الوصف: {ticket['issue_description']}\n"
-                    f"سبب المشكلة: {ticket['issue_reason']}\n"
-                    f"نوع المشكلة: {ticket['issue_type']}\n"
-                    f"الحالة: {ticket['status']}\n\n"
-                    f"📝 <b>السجلات:</b>\n{logs}")
-            keyboard = [
-                [InlineKeyboardButton("حل المشكلة", callback_data=f"solve|{ticket_id}")],
-                [InlineKeyboardButton("طلب معلومات إضافية", callback_data=f"moreinfo|{ticket_id}")],
-                [InlineKeyboardButton("إرسال إلى العميل", callback_data=f"sendclient|{ticket_id}")]
-            ]
-            if ticket['status'] == "Client Responded":
-                keyboard.insert(0, [InlineKeyboardButton("إرسال للحالة إلى الوكيل", callback_data=f"sendto_da|{ticket_id}")])
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            safe_edit_message(query, text=text, reply_markup=reply_markup)
-        else:
-            safe_edit_message(query, text="التذكرة غير موجودة.")
+        await show_ticket_details(query, data)
         return MAIN_MENU
 
     elif data.startswith("solve|"):
         ticket_id = int(data.split("|")[1])
         context.user_data['ticket_id'] = ticket_id
         context.user_data['action'] = 'solve'
-        context.bot.send_message(
+        await context.bot.send_message(
             chat_id=query.message.chat.id,
             text="أدخل رسالة الحل للمشكلة:",
             reply_markup=ForceReply(selective=True)
@@ -211,7 +232,7 @@ def supervisor_main_menu_callback(update: Update, context: CallbackContext) -> i
         ticket_id = int(data.split("|")[1])
         context.user_data['ticket_id'] = ticket_id
         context.user_data['action'] = 'moreinfo'
-        context.bot.send_message(
+        await context.bot.send_message(
             chat_id=query.message.chat.id,
             text="أدخل المعلومات الإضافية المطلوبة للتذكرة:",
             reply_markup=ForceReply(selective=True)
@@ -223,30 +244,31 @@ def supervisor_main_menu_callback(update: Update, context: CallbackContext) -> i
         keyboard = [[InlineKeyboardButton("إرسال كما هي", callback_data=f"confirm_sendclient|{ticket_id}"),
                      InlineKeyboardButton("تعديل التفاصيل", callback_data=f"edit_sendclient|{ticket_id}")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
-        safe_edit_message(query,
-                          text="هل تريد إرسال التذكرة إلى العميل كما هي أم تعديل التفاصيل؟",
-                          reply_markup=reply_markup)
+        await safe_edit_message(query,
+                                text="هل تريد إرسال التذكرة إلى العميل كما هي أم تعديل التفاصيل؟",
+                                reply_markup=reply_markup)
         return MAIN_MENU
 
     elif data.startswith("confirm_sendclient|"):
         ticket_id = int(data.split("|")[1])
-        ticket = db.get_ticket(ticket_id)
+        ticket = await db.run_async(db.get_ticket, ticket_id)
         if ticket:
-            send_to_client(ticket)
-            safe_edit_message(query, text=f"تم إرسال التذكرة #{ticket_id} إلى العميل.")
+            queued = await db.run_async(send_to_client, ticket)
+            await safe_edit_message(query, text=sent_to_client_text(ticket_id, queued,
+                                                                    f"تم إرسال التذكرة #{ticket_id} إلى العميل."))
         else:
-            safe_edit_message(query, text="لا يمكن العثور على التذكرة.")
+            await safe_edit_message(query, text="لا يمكن العثور على التذكرة.")
         return MAIN_MENU
 
     elif data.startswith("cancel_sendclient|"):
-        safe_edit_message(query, text="تم إلغاء الإرسال إلى العميل.")
+        await safe_edit_message(query, text="تم إلغاء الإرسال إلى العميل.")
         return MAIN_MENU
 
     elif data.startswith("edit_sendclient|"):
         ticket_id = int(data.split("|")[1])
-        ticket = db.get_ticket(ticket_id)
+        ticket = await db.run_async(db.get_ticket, ticket_id)
         if not ticket:
-            safe_edit_message(query, text="التذكرة غير موجودة.")
+            await safe_edit_message(query, text="التذكرة غير موجودة.")
             return MAIN_MENU
         context.user_data['ticket_id'] = ticket_id
         context.user_data['order_id'] = ticket['order_id']
@@ -256,39 +278,34 @@ def supervisor_main_menu_callback(update: Update, context: CallbackContext) -> i
         context.user_data['client'] = ticket['client']
         context.user_data['image_url'] = ticket.get('image_url', None)
         context.user_data['action'] = 'edit_for_client'
-        return show_ticket_summary_for_edit_supervisor(query, context)
+        return await show_ticket_summary_for_edit_supervisor(query, context)
 
     elif data.startswith("sendto_da|"):
         ticket_id = int(data.split("|")[1])
-        ticket = db.get_ticket(ticket_id)
-        if not ticket:
-            safe_edit_message(query, text="لا يمكن العثور على التذكرة.")
-            return MAIN_MENU
-        client_solution = None
-        if ticket.get("logs"):
-            try:
-                logs = json.loads(ticket["logs"])
-                for log in logs:
-                    if log.get("action") == "client_solution":
-                        client_solution = log.get("message")
-                        break
-            except Exception:
-                client_solution = None
+        solution_event = await db.run_async(db.get_latest_ticket_event, ticket_id, "client_solution")
+        client_solution = solution_event["message"] if solution_event else None
         if not client_solution:
             client_solution = "لا يوجد حل من العميل."
-        db.update_ticket_status(ticket_id, "Pending DA Action", {"action": "supervisor_forward", "message": client_solution})
-        notify_da(ticket, client_solution, info_request=False)
-        safe_edit_message(query, text="تم إرسال الحالة إلى الوكيل.")
+        ticket, applied = await db.run_async(
+            db.apply_transition, ticket_id, "supervisor_forward", client_solution, actor=query.from_user.id,
+            notify=lambda conn, ticket: notify_da(ticket, client_solution, info_request=False, conn=conn))
+        if not ticket:
+            await safe_edit_message(query, text="لا يمكن العثور على التذكرة.")
+            return MAIN_MENU
+        if not applied:
+            await safe_edit_message(query, text=f"لا يمكن تنفيذ هذا الإجراء في حالة التذكرة الحالية: {ticket['status']}")
+            return MAIN_MENU
+        await safe_edit_message(query, text="تم إرسال الحالة إلى الوكيل.")
         return MAIN_MENU
 
     else:
-        safe_edit_message(query, text="الإجراء غير معروف.")
+        await safe_edit_message(query, text="الإجراء غير معروف.")
         return MAIN_MENU
 
 # -----------------------------------------------------------------------------
 # Summaries & Editing (Supervisor)
 # -----------------------------------------------------------------------------
-def show_ticket_summary_for_edit_supervisor(query, context: CallbackContext) -> int:
+async def show_ticket_summary_for_edit_supervisor(query, context: ContextTypes.DEFAULT_TYPE) -> int:
     data = context.user_data
     summary = (
         f"رقم الطلب: {data.get('order_id','')}\n"
@@ -304,15 +321,15 @@ def show_ticket_summary_for_edit_supervisor(query, context: CallbackContext) ->
          InlineKeyboardButton("لا", callback_data="sup_edit_ticket_no")]
     ]
     rm = InlineKeyboardMarkup(kb)
-    safe_edit_message(query, text=text, reply_markup=rm)
+    await safe_edit_message(query, text=text, reply_markup=rm)
     return EDIT_PROMPT
 
-def supervisor_edit_prompt_callback(update: Update, context: CallbackContext) -> int:
+async def supervisor_edit_prompt_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
-    query.answer()
+    await query.answer()
     data = query.data
     if data == "sup_edit_ticket_no":
-        return finalize_sendclient(query, context)
+        return await finalize_sendclient(query, context)
     elif data == "sup_edit_ticket_yes":
         keyboard = [
             [InlineKeyboardButton("رقم الطلب", callback_data="sup_edit_field_order"),
@@ -324,27 +341,27 @@ def supervisor_edit_prompt_callback(update: Update, context: CallbackContext) ->
             [InlineKeyboardButton("تم", callback_data="sup_edit_done")]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
-        safe_edit_message(query, text="اختر الحقل الذي تريد تعديله:", reply_markup=reply_markup)
+        await safe_edit_message(query, text="اختر الحقل الذي تريد تعديله:", reply_markup=reply_markup)
         return EDIT_FIELD
     else:
-        safe_edit_message(query, text="الإجراء غير معروف.")
+        await safe_edit_message(query, text="الإجراء غير معروف.")
         return MAIN_MENU
 
-def supervisor_edit_field_callback(update: Update, context: CallbackContext) -> int:
+async def supervisor_edit_field_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
-    query.answer()
+    await query.answer()
     data = query.data
     if data == "sup_edit_done":
-        return show_ticket_summary_for_edit_supervisor(query, context)
+        return await show_ticket_summary_for_edit_supervisor(query, context)
     elif data == "sup_edit_field_image":
-        safe_edit_message(query, text="من فضلك أرسل الصورة الجديدة:")
+        await safe_edit_message(query, text="من فضلك أرسل الصورة الجديدة:")
         return EDIT_IMAGE
     elif data == "sup_edit_field_reason":
         keyboard = []
         for reason_key in ISSUE_OPTIONS:
             keyboard.append([InlineKeyboardButton(reason_key, callback_data=f"sup_reason_{reason_key}")])
         reply_markup = InlineKeyboardMarkup(keyboard)
-        safe_edit_message(query, text="اختر سبب المشكلة الجديد:", reply_markup=reply_markup)
+        await safe_edit_message(query, text="اختر سبب المشكلة الجديد:", reply_markup=reply_markup)
         return EDIT_REASON
     elif data == "sup_edit_field_type":
         current_reason = context.user_data.get('issue_reason')
@@ -353,7 +370,7 @@ def supervisor_edit_field_callback(update: Update, context: CallbackContext) ->
             for reason_key in ISSUE_OPTIONS:
                 keyboard.append([InlineKeyboardButton(reason_key, callback_data=f"sup_reason_{reason_key}")])
             reply_markup = InlineKeyboardMarkup(keyboard)
-            safe_edit_message(query, text="اختر سبب المشكلة أولاً:", reply_markup=reply_markup)
+            await safe_edit_message(query, text="اختر سبب المشكلة أولاً:", reply_markup=reply_markup)
             return EDIT_REASON
         else:
             types_for_reason = get_issue_types_for_reason(current_reason)
@@ -361,32 +378,32 @@ def supervisor_edit_field_callback(update: Update, context: CallbackContext) ->
             for t in types_for_reason:
                 keyboard.append([InlineKeyboardButton(t, callback_data=f"sup_type_{t}")])
             reply_markup = InlineKeyboardMarkup(keyboard)
-            safe_edit_message(query, text=f"اختر النوع المناسب ({current_reason}):", reply_markup=reply_markup)
+            await safe_edit_message(query, text=f"اختر النوع المناسب ({current_reason}):", reply_markup=reply_markup)
             return EDIT_TYPE
     elif data == "sup_edit_field_order":
-        safe_edit_message(query, text="أدخل رقم الطلب الجديد:")
+        await safe_edit_message(query, text="أدخل رقم الطلب الجديد:")
         context.user_data['edit_field'] = "order_id"
         return EDIT_FIELD
     elif data == "sup_edit_field_description":
-        safe_edit_message(query, text="أدخل وصفاً جديداً:")
+        await safe_edit_message(query, text="أدخل وصفاً جديداً:")
         context.user_data['edit_field'] = "issue_description"
         return EDIT_FIELD
     elif data == "sup_edit_field_client":
-        safe_edit_message(query, text="أدخل اسم العميل الجديد:")
+        await safe_edit_message(query, text="أدخل اسم العميل الجديد:")
         context.user_data['edit_field'] = "client"
         return EDIT_FIELD
     else:
-        safe_edit_message(query, text="الإجراء غير معروف.")
+        await safe_edit_message(query, text="الإجراء غير معروف.")
         return EDIT_FIELD
 
-def supervisor_edit_field_input_handler(update: Update, context: CallbackContext) -> int:
+async def supervisor_edit_field_input_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     field = context.user_data.get('edit_field')
     new_value = update.message.text.strip()
     if not field:
-        update.message.reply_text("لا يوجد حقل محدد للتعديل.")
+        await update.message.reply_text("لا يوجد حقل محدد للتعديل.")
         return EDIT_FIELD
     context.user_data[field] = new_value
-    update.message.reply_text(f"تم تحديث {field} إلى: {new_value}")
+    await update.message.reply_text(f"تم تحديث {field} إلى: {new_value}")
     keyboard = [
         [InlineKeyboardButton("رقم الطلب", callback_data="sup_edit_field_order"),
          InlineKeyboardButton("الوصف", callback_data="sup_edit_field_description")],
@@ -397,32 +414,31 @@ def supervisor_edit_field_input_handler(update: Update, context: CallbackContext
         [InlineKeyboardButton("تم", callback_data="sup_edit_done")]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    update.message.reply_text("اختر الحقل الذي تريد تعديله:", reply_markup=reply_markup)
+    await update.message.reply_text("اختر الحقل الذي تريد تعديله:", reply_markup=reply_markup)
     return EDIT_FIELD
 
-def supervisor_edit_image_handler(update: Update, context: CallbackContext) -> int:
+async def supervisor_edit_image_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if update.message.photo:
         photo = update.message.photo[-1]
-        file = photo.get_file()
-        import io
+        file = await photo.get_file()
         bio = io.BytesIO()
-        file.download(out=bio)
+        await file.download_to_memory(bio)
         bio.seek(0)
         try:
-            result = cloudinary.uploader.upload(bio)
+            result = await asyncio.to_thread(cloudinary.uploader.upload, bio)
             secure_url = result.get("secure_url")
             if secure_url:
                 context.user_data['image_url'] = secure_url
-                update.message.reply_text("تم تحديث الصورة بنجاح.")
+                await update.message.reply_text("تم تحديث الصورة بنجاح.")
             else:
-                update.message.reply_text("فشل رفع الصورة. حاول مرة أخرى:")
+                await update.message.reply_text("فشل رفع الصورة. حاول مرة أخرى:")
                 return EDIT_IMAGE
         except Exception as e:
             logger.error("Error uploading image: %s", e)
-            update.message.reply_text("خطأ أثناء رفع الصورة. حاول مرة أخرى:")
+            await update.message.reply_text("خطأ أثناء رفع الصورة. حاول مرة أخرى:")
             return EDIT_IMAGE
     else:
-        update.message.reply_text("الملف المرسل ليس صورة صالحة. أعد الإرسال:")
+        await update.message.reply_text("الملف المرسل ليس صورة صالحة. أعد الإرسال:")
         return EDIT_IMAGE
     keyboard = [
         [InlineKeyboardButton("رقم الطلب", callback_data="sup_edit_field_order"),
@@ -434,32 +450,32 @@ def supervisor_edit_image_handler(update: Update, context: CallbackContext) -> i
         [InlineKeyboardButton("تم", callback_data="sup_edit_done")]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    update.message.reply_text("اختر الحقل الذي تريد تعديله:", reply_markup=reply_markup)
+    await update.message.reply_text("اختر الحقل الذي تريد تعديله:", reply_markup=reply_markup)
     return EDIT_FIELD
 
-def supervisor_edit_reason_callback(update: Update, context: CallbackContext) -> int:
+async def supervisor_edit_reason_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
-    query.answer()
+    await query.answer()
     reason = query.data.split("sup_reason_")[1]
     context.user_data['issue_reason'] = reason
-    query.message.reply_text(f"تم تحديث سبب المشكلة إلى: {reason}")
+    await query.message.reply_text(f"تم تحديث سبب المشكلة إلى: {reason}")
     types_for_reason = get_issue_types_for_reason(reason)
     if not types_for_reason:
-        query.message.reply_text("لا توجد أنواع متاحة لهذا السبب.")
+        await query.message.reply_text("لا توجد أنواع متاحة لهذا السبب.")
         return EDIT_FIELD
     keyboard = []
     for t in types_for_reason:
         keyboard.append([InlineKeyboardButton(t, callback_data=f"sup_type_{t}")])
     reply_markup = InlineKeyboardMarkup(keyboard)
-    query.message.reply_text("اختر النوع المناسب:", reply_markup=reply_markup)
+    await query.message.reply_text("اختر النوع المناسب:", reply_markup=reply_markup)
     return EDIT_TYPE
 
-def supervisor_edit_type_callback(update: Update, context: CallbackContext) -> int:
+async def supervisor_edit_type_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
-    query.answer()
+    await query.answer()
     new_type = query.data.split("sup_type_")[1]
     context.user_data['issue_type'] = new_type
-    query.message.reply_text(f"تم تحديث نوع المشكلة إلى: {new_type}")
+    await query.message.reply_text(f"تم تحديث نوع المشكلة إلى: {new_type}")
     keyboard = [
         [InlineKeyboardButton("رقم الطلب", callback_data="sup_edit_field_order"),
          InlineKeyboardButton("الوصف", callback_data="sup_edit_field_description")],
@@ -470,14 +486,14 @@ def supervisor_edit_type_callback(update: Update, context: CallbackContext) -> i
         [InlineKeyboardButton("تم", callback_data="sup_edit_done")]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    query.message.reply_text("اختر الحقل الذي تريد تعديله:", reply_markup=reply_markup)
+    await query.message.reply_text("اختر الحقل الذي تريد تعديله:", reply_markup=reply_markup)
     return EDIT_FIELD
 
-def finalize_sendclient(query, context: CallbackContext) -> int:
+async def finalize_sendclient(query, context: ContextTypes.DEFAULT_TYPE) -> int:
     ticket_id = context.user_data.get('ticket_id')
-    existing_ticket = db.get_ticket(ticket_id)
+    existing_ticket = await db.run_async(db.get_ticket, ticket_id)
     if not existing_ticket:
-        safe_edit_message(query, text="التذكرة غير موجودة.")
+        await safe_edit_message(query, text="التذكرة غير موجودة.")
         context.user_data.clear()
         return MAIN_MENU
     pseudo_ticket = {
@@ -490,15 +506,15 @@ def finalize_sendclient(query, context: CallbackContext) -> int:
         'image_url': context.user_data.get('image_url', existing_ticket.get('image_url')),
         'status': existing_ticket['status']
     }
-    send_to_client(pseudo_ticket)
-    safe_edit_message(query, text=f"تم إرسال التذكرة #{ticket_id} إلى العميل بالتفاصيل المعدلة.")
+    queued = await db.run_async(send_to_client, pseudo_ticket)
+    await safe_edit_message(query, text=sent_to_client_text(
+        ticket_id, queued, f"تم إرسال التذكرة #{ticket_id} إلى العميل بالتفاصيل المعدلة."))
     context.user_data.clear()
     return MAIN_MENU
 
 def send_to_client(ticket, message_text=None):
     client_name = ticket.get('client')
     clients = db.get_clients_by_name(client_name)
-    bot = Bot(token=config.CLIENT_BOT_TOKEN)
     description = message_text if message_text is not None else ticket['issue_description']
     message = (
         f"<b>تذكرة من المشرف</b>\n"
@@ -513,32 +529,28 @@ def send_to_client(ticket, message_text=None):
     reply_markup = InlineKeyboardMarkup(keyboard)
     if not clients:
         logger.warning(f"send_to_client: No client subscriptions found for client name '{client_name}'")
-    for c in clients:
-        try:
-            if ticket.get('image_url'):
-                bot.send_photo(
-                    chat_id=c['chat_id'],
-                    photo=ticket['image_url'],
-                    caption=message,
-                    reply_markup=reply_markup,
-                    parse_mode="HTML"
-                )
-            else:
-                bot.send_message(
-                    chat_id=c['chat_id'],
-                    text=message,
-                    reply_markup=reply_markup,
-                    parse_mode="HTML"
-                )
-        except Exception as e:
-            logger.error(f"Error notifying client {c['chat_id']}: {e}")
+        return None
+    # Sending the same ticket again (e.g. with edited details) replaces the client's copy;
+    # the same text again within seconds (a double-tapped confirm) is dropped as a duplicate
+    dedup_key, skip_keys = notifier.double_tap_keys("send_to_client", ticket['ticket_id'], message)
+    return notifier.queue(None, "Client", [c['chat_id'] for c in clients], message, reply_markup,
+                          photo=ticket.get('image_url'), kind="send_to_client", ticket_id=ticket['ticket_id'],
+                          mode="edit", dedup_key=dedup_key, skip_keys=skip_keys)
+
+def sent_to_client_text(ticket_id, queued, sent_text):
+    """The reply to the supervisor for send_to_client()'s result `queued`."""
+    if queued is None:
+        return f"لم يتم إرسال التذكرة #{ticket_id}: لا توجد جهات اتصال مسجلة لهذا العميل."
+    if not queued:
+        return f"لم يتم إرسال التذكرة #{ticket_id} مرة أخرى: تم إرسالها إلى العميل للتو."
+    return sent_text
 
 # -----------------------------------------------------------------------------
 # Searching, Solving, & Global Handlers
 # -----------------------------------------------------------------------------
-def search_tickets(update: Update, context: CallbackContext) -> int:
+async def search_tickets(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query_text = update.message.text.strip()
-    tickets = db.search_tickets_by_order(query_text)
+    tickets = await db.run_async(db.search_tickets_by_order, query_text)
     if tickets:
         for ticket in tickets:
             text = (f"<b>تذكرة #{ticket['ticket_id']}</b>\n"
@@ -548,68 +560,83 @@ def search_tickets(update: Update, context: CallbackContext) -> int:
                     f"الحالة: {ticket['status']}")
             keyboard = [[InlineKeyboardButton("عرض التفاصيل", callback_data=f"view|{ticket['ticket_id']}")]]
             reply_markup = InlineKeyboardMarkup(keyboard)
-            update.message.reply_text(text, reply_markup=reply_markup, parse_mode="HTML")
+            await update.message.reply_text(text, reply_markup=reply_markup, parse_mode="HTML")
     else:
-        update.message.reply_text("لم يتم العثور على تذاكر مطابقة.")
+        await update.message.reply_text("لم يتم العثور على تذاكر مطابقة.")
     keyboard = [
         [InlineKeyboardButton("عرض الكل", callback_data="menu_show_all"),
          InlineKeyboardButton("استعلام عن مشكلة", callback_data="menu_query_issue")]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    update.message.reply_text("اختر خياراً:", reply_markup=reply_markup)
+    await update.message.reply_text("اختر خياراً:", reply_markup=reply_markup)
     return MAIN_MENU
 
-def awaiting_response_handler(update: Update, context: CallbackContext) -> int:
+async def awaiting_response_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     response = update.message.text.strip()
     ticket_id = context.user_data.get('ticket_id')
     action = context.user_data.get('action')
     if not ticket_id or not action:
-        update.message.reply_text("حدث خطأ. أعد المحاولة.")
+        await update.message.reply_text("حدث خطأ. أعد المحاولة.")
         return MAIN_MENU
     if action == 'solve':
-        db.update_ticket_status(ticket_id, "Pending DA Action", {"action": "supervisor_solution", "message": response})
-        notify_da(db.get_ticket(ticket_id))
-        update.message.reply_text("تم إرسال الحل إلى الوكيل.")
+        ticket, applied = await db.run_async(db.apply_transition, ticket_id, "supervisor_solution", response,
+                                             actor=update.effective_user.id,
+                                             notify=lambda conn, ticket: notify_da(ticket, conn=conn))
+        if not ticket:
+            await update.message.reply_text("حدث خطأ أثناء تحديث التذكرة.")
+        elif not applied:
+            await update.message.reply_text(f"لا يمكن تنفيذ هذا الإجراء في حالة التذكرة الحالية: {ticket['status']}")
+        else:
+            await update.message.reply_text("تم إرسال الحل إلى الوكيل.")
     elif action == 'moreinfo':
-        db.update_ticket_status(ticket_id, "Pending DA Response", {"action": "supervisor_moreinfo", "message": response})
-        notify_da_moreinfo(ticket_id, response)
-        update.message.reply_text("تم إرسال المعلومات الإضافية إلى الوكيل.")
+        ticket, applied = await db.run_async(
+            db.apply_transition, ticket_id, "supervisor_moreinfo", response, actor=update.effective_user.id,
+            notify=lambda conn, ticket: notify_da_moreinfo(ticket_id, response, ticket=ticket, conn=conn))
+        if not ticket:
+            await update.message.reply_text("حدث خطأ أثناء تحديث التذكرة.")
+        elif not applied:
+            await update.message.reply_text(f"لا يمكن تنفيذ هذا الإجراء في حالة التذكرة الحالية: {ticket['status']}")
+        else:
+            await update.message.reply_text("تم إرسال المعلومات الإضافية إلى الوكيل.")
     context.user_data.pop('ticket_id', None)
     context.user_data.pop('action', None)
     return MAIN_MENU
 
-def default_handler_supervisor(update: Update, context: CallbackContext) -> int:
+async def default_handler_supervisor(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     keyboard = [
         [InlineKeyboardButton("عرض الكل", callback_data="menu_show_all"),
          InlineKeyboardButton("استعلام عن مشكلة", callback_data="menu_query_issue")]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    update.message.reply_text("الرجاء اختيار خيار:", reply_markup=reply_markup)
+    await update.message.reply_text("الرجاء اختيار خيار:", reply_markup=reply_markup)
     return MAIN_MENU
 
-def error_handler(update: Update, context: CallbackContext):
+async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.error('Update "%s" caused error "%s"', update, context.error)
     if update and update.message:
-        update.message.reply_text("⚠️ حدث خطأ أثناء معالجة الطلب. الرجاء المحاولة مرة أخرى.")
+        await update.message.reply_text("⚠️ حدث خطأ أثناء معالجة الطلب. الرجاء المحاولة مرة أخرى.")
 
-def cancel(update: Update, context: CallbackContext) -> int:
-    update.message.reply_text("تم إلغاء العملية.")
+async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    await update.message.reply_text("تم إلغاء العملية.")
     return ConversationHandler.END
 
-def global_supervisor_action_handler(update: Update, context: CallbackContext) -> int:
+async def global_supervisor_action_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
-    query.answer()
+    await query.answer()
     data = query.data
     logger.debug("global_supervisor_action_handler: Received data: %s", data)
-    if data.startswith("solve|"):
+    if data.startswith("view|"):
+        await show_ticket_details(query, data)
+        return MAIN_MENU
+    elif data.startswith("solve|"):
         try:
             ticket_id = int(data.split("|")[1])
         except (IndexError, ValueError):
-            safe_edit_message(query, "بيانات التذكرة غير صحيحة.")
+            await safe_edit_message(query, "بيانات التذكرة غير صحيحة.")
             return MAIN_MENU
         context.user_data['ticket_id'] = ticket_id
         context.user_data['action'] = 'solve'
-        context.bot.send_message(
+        await context.bot.send_message(
             chat_id=query.message.chat.id,
             text="أدخل رسالة الحل للمشكلة:",
             reply_markup=ForceReply(selective=True)
@@ -619,11 +646,11 @@ def global_supervisor_action_handler(update: Update, context: CallbackContext) -
         try:
             ticket_id = int(data.split("|")[1])
         except (IndexError, ValueError):
-            safe_edit_message(query, "بيانات التذكرة غير صحيحة.")
+            await safe_edit_message(query, "بيانات التذكرة غير صحيحة.")
             return MAIN_MENU
         context.user_data['ticket_id'] = ticket_id
         context.user_data['action'] = 'moreinfo'
-        context.bot.send_message(
+        await context.bot.send_message(
             chat_id=query.message.chat.id,
             text="أدخل المعلومات الإضافية المطلوبة للتذكرة:",
             reply_markup=ForceReply(selective=True)
@@ -633,85 +660,146 @@ def global_supervisor_action_handler(update: Update, context: CallbackContext) -
         try:
             ticket_id = int(data.split("|")[1])
         except (IndexError, ValueError):
-            safe_edit_message(query, "بيانات التذكرة غير صحيحة.")
+            await safe_edit_message(query, "بيانات التذكرة غير صحيحة.")
             return MAIN_MENU
-        ticket = db.get_ticket(ticket_id)
+        ticket = await db.run_async(db.get_ticket, ticket_id)
         if ticket:
-            send_to_client(ticket)
-            safe_edit_message(query, text=f"تم إرسال التذكرة #{ticket_id} إلى العميل.")
+            queued = await db.run_async(send_to_client, ticket)
+            await safe_edit_message(query, text=sent_to_client_text(ticket_id, queued,
+                                                                    f"تم إرسال التذكرة #{ticket_id} إلى العميل."))
         else:
-            safe_edit_message(query, text="التذكرة غير موجودة.")
+            await safe_edit_message(query, text="التذكرة غير موجودة.")
         return MAIN_MENU
     elif data.startswith("sendto_da|"):
         try:
             ticket_id = int(data.split("|")[1])
         except (IndexError, ValueError):
-            safe_edit_message(query, "بيانات التذكرة غير صحيحة.")
+            await safe_edit_message(query, "بيانات التذكرة غير صحيحة.")
             return MAIN_MENU
-        ticket = db.get_ticket(ticket_id)
-        if ticket:
-            client_solution = None
-            if ticket.get("logs"):
-                try:
-                    logs = json.loads(ticket["logs"])
-                    for log in logs:
-                        if log.get("action") == "client_solution":
-                            client_solution = log.get("message")
-                            break
-                except Exception:
-                    client_solution = None
-            if not client_solution:
-                client_solution = "لا يوجد حل من العميل."
-            db.update_ticket_status(ticket_id, "Pending DA Action", {"action": "supervisor_forward", "message": client_solution})
-            notify_da(ticket, client_solution, info_request=False)
-            safe_edit_message(query, text="تم إرسال الحالة إلى الوكيل.")
+        solution_event = await db.run_async(db.get_latest_ticket_event, ticket_id, "client_solution")
+        client_solution = solution_event["message"] if solution_event else None
+        if not client_solution:
+            client_solution = "لا يوجد حل من العميل."
+        ticket, applied = await db.run_async(
+            db.apply_transition, ticket_id, "supervisor_forward", client_solution, actor=query.from_user.id,
+            notify=lambda conn, ticket: notify_da(ticket, client_solution, info_request=False, conn=conn))
+        if not ticket:
+            await safe_edit_message(query, text="التذكرة غير موجودة.")
+        elif not applied:
+            await safe_edit_message(query, text=f"لا يمكن تنفيذ هذا الإجراء في حالة التذكرة الحالية: {ticket['status']}")
         else:
-            safe_edit_message(query, text="التذكرة غير موجودة.")
+            await safe_edit_message(query, text="تم إرسال الحالة إلى الوكيل.")
         return MAIN_MENU
     else:
-        safe_edit_message(query, text="الإجراء غير معروف.")
+        await safe_edit_message(query, text="الإجراء غير معروف.")
         return MAIN_MENU
 
-def global_supervisor_text_handler(update: Update, context: CallbackContext) -> None:
+async def global_supervisor_text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if context.user_data.get('action') in ['solve', 'moreinfo'] and context.user_data.get('ticket_id'):
-        awaiting_response_handler(update, context)
+        await awaiting_response_handler(update, context)
+    else:
+        await update.message.reply_text("الرجاء اختيار خيار من القائمة.")
+
+async def set_availability(update: Update, context: ContextTypes.DEFAULT_TYPE, available: bool) -> None:
+    """/away and /available: whether new tickets are assigned to this supervisor."""
+    if not await db.run_async(db.set_supervisor_available, update.effective_user.id, available):
+        await update.message.reply_text("يرجى الاشتراك أولاً باستخدام /start.")
+    elif available:
+        await update.message.reply_text("تم تفعيل استقبال التذاكر الجديدة.")
     else:
-        update.message.reply_text("الرجاء اختيار خيار من القائمة.")
+        await update.message.reply_text("لن يتم تحويل تذاكر جديدة إليك حتى ترسل /available.")
+
+BROADCAST_USAGE = (
+    "لإرسال إعلان:\n"
+    "/broadcast da نص الرسالة — إلى جميع الوكلاء\n"
+    "/broadcast client اسم العميل | نص الرسالة — إلى جميع جهات اتصال العميل"
+)
+BROADCAST_STATUS = {"running": "جارٍ الإرسال", "done": "اكتمل"}
+
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/broadcast: start a broadcast to every DA or every contact of a client, or list the latest."""
+    user_id = update.effective_user.id
+    # Anyone can subscribe as a supervisor, so only the configured admins may broadcast
+    if user_id not in config.BROADCAST_ADMIN_IDS or not await db.run_async(db.get_user, user_id, "Supervisor"):
+        await update.message.reply_text("غير مصرح لك بإرسال الإعلانات.")
+        return
+    # The raw text, so the message keeps its line breaks
+    parts = update.message.text.split(maxsplit=2)
+    if len(parts) < 3:
+        lines = [BROADCAST_USAGE]
+        for b in await db.run_async(db.get_broadcasts, limit=5):
+            audience = f"العميل {b['client']}" if b['client'] else "الوكلاء"
+            lines.append(f"#{b['id']} إلى {audience}: {BROADCAST_STATUS.get(b['status'], b['status'])} — "
+                         f"تم التسليم {b['delivered']} / {b['total']}، فشل {b['failed']}")
+        await update.message.reply_text("\n".join(lines))
+        return
+    audience, message = parts[1].lower(), parts[2].strip()
+    client = None
+    if audience == "client":
+        client, _, message = message.partition("|")
+        client, message = client.strip(), message.strip()
+    if audience not in ("da", "client") or not message or (audience == "client" and not client):
+        await update.message.reply_text(BROADCAST_USAGE)
+        return
+    broadcast = await db.run_async(db.create_broadcast, "DA" if audience == "da" else "Client", message, client,
+                                   created_by=user_id)
+    if broadcast is None:
+        await update.message.reply_text(f"لم يتم العثور على العميل '{client}'.")
+        return
+    logger.info("Broadcast %s to %s started by %s (%d recipients)", broadcast['id'], parts[1], user_id,
+                broadcast['total'])
+    await update.message.reply_text(f"تم بدء الإعلان #{broadcast['id']} إلى {broadcast['total']} مستلم. "
+                                    f"أرسل /broadcast لمتابعة التقدم.")
 
 # -----------------------------------------------------------------------------
 # Main function for Supervisor Bot
 # -----------------------------------------------------------------------------
-def main():
-    updater = Updater(config.SUPERVISOR_BOT_TOKEN, use_context=True)
-    dp = updater.dispatcher
-    dp.add_error_handler(error_handler)
+def build_application(builder=None) -> Application:
+    """
+    The supervisor bot's Application with all its handlers, from builder
+    (default: notifier.application_builder() for SUPERVISOR_BOT_TOKEN).
+    """
+    if builder is None:
+        builder = notifier.application_builder(config.SUPERVISOR_BOT_TOKEN)
+    application = builder.build()
+    application.add_error_handler(error_handler)
 
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler("start", start)],
         states={
-            SUBSCRIPTION_PHONE: [MessageHandler(Filters.text & ~Filters.command, subscription_phone)],
+            SUBSCRIPTION_PHONE: [MessageHandler(filters.TEXT & ~filters.COMMAND, subscription_phone)],
             MAIN_MENU: [CallbackQueryHandler(
                 supervisor_main_menu_callback,
-                pattern=r"^(menu_show_all|menu_query_issue|view\|.*|solve\|.*|moreinfo\|.*|sendclient\|.*|sendto_da\|.*|confirm_sendclient\|.*|cancel_sendclient\|.*|edit_sendclient\|.*)$"
+                pattern=r"^(menu_show_all|more_all\|.*|menu_query_issue|view\|.*|solve\|.*|moreinfo\|.*|sendclient\|.*|sendto_da\|.*|confirm_sendclient\|.*|cancel_sendclient\|.*|edit_sendclient\|.*)$"
             )],
-            SEARCH_TICKETS: [MessageHandler(Filters.text & ~Filters.command, search_tickets)],
-            AWAITING_RESPONSE: [MessageHandler(Filters.text & ~Filters.command, awaiting_response_handler)]
+            SEARCH_TICKETS: [MessageHandler(filters.TEXT & ~filters.COMMAND, search_tickets)],
+            AWAITING_RESPONSE: [MessageHandler(filters.TEXT & ~filters.COMMAND, awaiting_response_handler)]
         },
-        fallbacks=[CommandHandler("cancel", lambda u, c: u.message.reply_text("تم إلغاء العملية."))]
+        fallbacks=[CommandHandler("cancel", cancel)],
+        name="supervisor_conversation",
+        persistent=application.persistence is not None
     )
-    dp.add_handler(conv_handler)
-    dp.add_handler(CallbackQueryHandler(global_supervisor_action_handler, pattern=r"^(solve\|.*|moreinfo\|.*|sendclient\|.*|sendto_da\|.*)$"))
-    dp.add_handler(MessageHandler(Filters.text & ~Filters.command, global_supervisor_text_handler))
-    # Removed the extra MessageHandler(Filters.text, default_handler_supervisor) to avoid duplicate main menu messages.
+    application.add_handler(conv_handler)
+    application.add_handler(CommandHandler("away", lambda u, c: set_availability(u, c, False)))
+    application.add_handler(CommandHandler("available", lambda u, c: set_availability(u, c, True)))
+    application.add_handler(CommandHandler("broadcast", broadcast_command))
+    application.add_handler(CallbackQueryHandler(global_supervisor_action_handler, pattern=r"^(view\|.*|solve\|.*|moreinfo\|.*|sendclient\|.*|sendto_da\|.*)$"))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, global_supervisor_text_handler))
+    # Removed the extra MessageHandler(filters.TEXT, default_handler_supervisor) to avoid duplicate main menu messages.
 
     # -------------------------
     # Global /start handler (group -1)
     # -------------------------
-    dp.add_handler(CommandHandler('start', start), group=-1)
+    application.add_handler(CommandHandler('start', start), group=-1)
+    # Conversations other replicas move along (persistence.py)
+    persistence.attach(application)
+    return application
 
+def main():
+    invalidation.start_listener()
+    application = build_application()
     logger.info("Supervisor bot started successfully.")
-    updater.start_polling()
-    updater.idle()
+    application.run_polling()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
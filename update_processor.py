@@ -0,0 +1,135 @@
+# update_processor.py
+"""
+Concurrent update handling for the bots that keeps each chat's updates in order.
+
+PTB's concurrent_updates(n) runs any n updates at once, two from the same chat
+included, so a DA who sends the next step before the last one's handler
+finished (a photo while "attach a photo" is still saving) can have the
+ConversationHandler see them out of order. ChatOrderedUpdateProcessor runs the
+updates of different chats on up to max_in_flight handlers at once, and those of
+one chat one after another, in the order they arrived; an update waiting for its
+chat doesn't take a handler slot from other chats. Updates with no chat or user
+(none of the bots' handlers use them) run in any order.
+
+Up to max_pending updates are taken off the application's queue at once, running
+or waiting; the rest wait there. Each processor logs its queue depth every
+LOG_INTERVAL seconds while it has work, and update_stats() returns it for every
+bot.
+"""
+import asyncio
+import logging
+import time
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+import config
+
+logger = logging.getLogger(__name__)
+
+LOG_INTERVAL = 60.0
+
+_processors = {}  # name -> ChatOrderedUpdateProcessor
+
+
+def chat_key(update):
+    """The chat whose updates must stay in order, or None."""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_chat:
+        return update.effective_chat.id
+    if update.effective_user:
+        return update.effective_user.id
+    return None
+
+
+class _Chat:
+    __slots__ = ("lock", "updates")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.updates = 0  # running or waiting
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Runs updates of different chats concurrently and those of one chat in order."""
+
+    def __init__(self, max_in_flight=config.BOT_CONCURRENT_UPDATES, max_pending=config.BOT_MAX_PENDING_UPDATES,
+                 name="bot"):
+        # PTB's own semaphore bounds the updates taken off the queue, running or waiting
+        super().__init__(max(max_pending, max_in_flight))
+        self.max_in_flight = max_in_flight
+        self.name = name
+        self._workers = asyncio.Semaphore(max_in_flight)
+        self._chats = {}  # chat_key() -> _Chat, while it has updates
+        self.in_flight = 0
+        self.waiting = 0  # for their chat or a handler slot
+        self.peak_waiting = 0
+        self.handled = 0
+        self.wait_time = 0.0  # total seconds updates waited, for the average
+        self._next_log = time.monotonic() + LOG_INTERVAL
+        _processors[name] = self
+
+    async def do_process_update(self, update, coroutine):
+        key = chat_key(update)
+        chat = None
+        if key is not None:
+            chat = self._chats.get(key)
+            if chat is None:
+                chat = self._chats[key] = _Chat()
+            chat.updates += 1
+        self.waiting += 1
+        self.peak_waiting = max(self.peak_waiting, self.waiting)
+        queued_at = time.monotonic()
+        locked = started = False
+        try:
+            if chat:
+                await chat.lock.acquire()
+                locked = True
+            async with self._workers:
+                started = True
+                self.waiting -= 1
+                self.in_flight += 1
+                self.wait_time += time.monotonic() - queued_at
+                try:
+                    await coroutine
+                finally:
+                    self.in_flight -= 1
+                    self.handled += 1
+        finally:
+            if locked:
+                chat.lock.release()
+            if not started:
+                # Cancelled while waiting, e.g. on shutdown
+                self.waiting -= 1
+                coroutine.close()
+            if chat:
+                chat.updates -= 1
+                if not chat.updates:
+                    del self._chats[key]
+            self._maybe_log()
+
+    def stats(self):
+        return {"in_flight": self.in_flight, "max_in_flight": self.max_in_flight, "waiting": self.waiting,
+                "peak_waiting": self.peak_waiting, "chats": len(self._chats), "handled": self.handled,
+                "avg_wait_ms": round(self.wait_time / self.handled * 1000, 1) if self.handled else 0.0}
+
+    def _maybe_log(self):
+        now = time.monotonic()
+        if now < self._next_log:
+            return
+        self._next_log = now + LOG_INTERVAL
+        logger.info("Updates for bot %s: %s", self.name, self.stats())
+        self.peak_waiting = self.waiting
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        if self.handled:
+            logger.info("Updates for bot %s: %s", self.name, self.stats())
+
+
+def update_stats():
+    """{name: ChatOrderedUpdateProcessor.stats()} for every processor in this process."""
+    return {name: processor.stats() for name, processor in _processors.items()}
@@ -1,9 +1,27 @@
 # webapp.py
-from flask import Flask, render_template_string, request
+import hashlib
+import hmac
+import secrets
+from urllib.parse import urlencode
+from flask import Flask, abort, redirect, render_template_string, request, session
+import config
 import db
-import json
 
 app = Flask(__name__)
+# The session only carries the broadcast form's CSRF token; derived from the admin
+# secret so it survives restarts and is the same in every worker
+app.secret_key = (hashlib.sha256(b"webapp-session:" + config.WEBAPP_ADMIN_SECRET.encode()).digest()
+                  if config.WEBAPP_ADMIN_SECRET else secrets.token_bytes(32))
+
+# /tickets query argument -> db.get_tickets_page filter
+TICKET_FILTERS = {
+    "status": "status",
+    "client": "client",
+    "reason": "reason",
+    "type": "issue_type",
+    "da_id": "da_id",
+}
+MAX_PAGE_SIZE = 500
 
 COMMON_STYLE = """
 <style>
@@ -179,6 +197,9 @@ TICKETS_TEMPLATE = COMMON_STYLE + """
   </tr>
   {% endfor %}
 </table>
+{% if next_cursor %}
+<a class="button" href="/tickets?{{ next_query }}">Next Page</a>
+{% endif %}
 <a class="button" href="/">Back to Home</a>
 """
 
@@ -228,6 +249,10 @@ HOME_TEMPLATE = COMMON_STYLE + """
     <h2>Subscriptions</h2>
     <a class="button" href="/subscriptions">View Subscriptions</a>
   </div>
+  <div class="card">
+    <h2>Broadcasts</h2>
+    <a class="button" href="/broadcasts">Send a Broadcast</a>
+  </div>
 </div>
 <style>
 .card-container {
@@ -258,6 +283,79 @@ HOME_TEMPLATE = COMMON_STYLE + """
 </style>
 """
 
+BROADCASTS_TEMPLATE = COMMON_STYLE + """
+<!doctype html>
+<title>Broadcasts</title>
+<h1>Broadcasts</h1>
+{% if can_send %}
+<form method="post" class="broadcast-form">
+  <input type="hidden" name="csrf_token" value="{{ csrf_token }}">
+  <label>To
+    <select name="audience">
+      <option value="DA">All DAs</option>
+      <option value="Client">Every contact of a client</option>
+    </select>
+  </label>
+  <label>Client <input name="client" value="{{ client or '' }}" placeholder="only for a client"></label>
+  <textarea name="message" rows="5" placeholder="نص الإعلان" required>{{ message or '' }}</textarea>
+  <label>Admin secret <input type="password" name="admin_secret" required></label>
+  {% if error %}<p class="error">{{ error }}</p>{% endif %}
+  <button class="button" type="submit">Send</button>
+</form>
+{% else %}
+<p>Starting a broadcast here needs WEBAPP_ADMIN_SECRET; supervisors in BROADCAST_ADMIN_IDS can use /broadcast in the supervisor bot.</p>
+{% endif %}
+<table>
+  <tr>
+    <th>ID</th>
+    <th>To</th>
+    <th>Message</th>
+    <th>Status</th>
+    <th>Recipients</th>
+    <th>Queued</th>
+    <th>Delivered</th>
+    <th>Failed</th>
+    <th>Created At</th>
+    <th>Finished At</th>
+  </tr>
+  {% for b in broadcasts %}
+  <tr>
+    <td>{{ b['id'] }}</td>
+    <td>{{ b['client'] or 'All DAs' }}</td>
+    <td>{{ b['text'] }}</td>
+    <td>{{ b['status'] }}</td>
+    <td>{{ b['total'] }}</td>
+    <td>{{ b['queued'] }}</td>
+    <td>{{ b['delivered'] }}</td>
+    <td>{{ b['failed'] }}</td>
+    <td>{{ b['created_at'] }}</td>
+    <td>{{ b['finished_at'] or '' }}</td>
+  </tr>
+  {% endfor %}
+</table>
+<a class="button" href="/">Back to Home</a>
+<style>
+.broadcast-form {
+    display: flex;
+    flex-direction: column;
+    gap: 0.75rem;
+    background: white;
+    padding: 1.5rem;
+    border-radius: 8px;
+    box-shadow: 0 1px 3px rgba(0,0,0,0.12);
+}
+
+.broadcast-form textarea, .broadcast-form input, .broadcast-form select {
+    width: 100%;
+    padding: 8px;
+    border: 1px solid #e0e0e0;
+    border-radius: 4px;
+}
+
+.error { color: #ea4335; }
+</style>
+"""
+
 ACTIVITY_TEMPLATE = COMMON_STYLE + """
 <!doctype html>
 <title>Ticket Activity</title>
@@ -268,8 +366,8 @@ ACTIVITY_TEMPLATE = COMMON_STYLE + """
     <img src="{{ image_url }}" width="200">
   </div>
   {% endif %}
-  {% for entry in logs.split('\n') %}
-  <div class="log-entry">{{ entry }}</div>
+  {% for entry in events %}
+  <div class="log-entry">{{ entry['timestamp'] }}: {{ entry['action'] }}{% if entry['message'] %} - {{ entry['message'] }}{% endif %}</div>
   {% endfor %}
 </div>
 <a class="button" href="/tickets">Back to Tickets</a>
@@ -281,22 +379,67 @@ def home():
 
 @app.route("/tickets")
 def tickets():
-    tickets = db.get_all_tickets()
-    return render_template_string(TICKETS_TEMPLATE, tickets=tickets)
+    # Optional filters, e.g. /tickets?status=Opened&client=...; "cursor" comes from the Next Page link
+    filters = {key: request.args[arg] for arg, key in TICKET_FILTERS.items() if request.args.get(arg)}
+    if "da_id" in filters:
+        filters["da_id"] = request.args.get("da_id", type=int)
+    page_size = max(1, min(request.args.get("page_size", db.DEFAULT_PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+    tickets, next_cursor = db.get_all_tickets_page(db.decode_cursor(request.args.get("cursor")),
+                                                   page_size, full_description=True, **filters)
+    next_query = None
+    if next_cursor:
+        args = request.args.to_dict()
+        args["cursor"] = db.encode_cursor(next_cursor)
+        next_query = urlencode(args)
+    return render_template_string(TICKETS_TEMPLATE, tickets=tickets, next_cursor=next_cursor,
+                                  next_query=next_query)
 
 @app.route("/ticket/<int:ticket_id>/activity")
 def ticket_activity(ticket_id):
     t = db.get_ticket(ticket_id)
     if not t:
         return "Ticket not found", 404
-    logs = json.dumps(json.loads(t['logs']), ensure_ascii=False, indent=2)
+    events = db.get_ticket_events(ticket_id)
     image_url = t['image_url']
-    return render_template_string(ACTIVITY_TEMPLATE, ticket_id=ticket_id, logs=logs, image_url=image_url)
+    return render_template_string(ACTIVITY_TEMPLATE, ticket_id=ticket_id, events=events, image_url=image_url)
 
 @app.route("/subscriptions")
 def subscriptions():
     subs = db.get_all_subscriptions()
     return render_template_string(SUBSCRIPTIONS_TEMPLATE, subs=subs)
 
+def csrf_token():
+    """This session's token for the broadcast form, created on first use."""
+    if "csrf_token" not in session:
+        session["csrf_token"] = secrets.token_urlsafe(32)
+    return session["csrf_token"]
+
+@app.route("/broadcasts", methods=["GET", "POST"])
+def broadcasts():
+    # The dispatcher sends a started broadcast in chunks (notifier.advance_broadcasts); reload for progress
+    error = None
+    message = request.form.get("message", "").strip()
+    client = request.form.get("client", "").strip()
+    if request.method == "POST":
+        if not config.WEBAPP_ADMIN_SECRET:
+            abort(403)
+        if not hmac.compare_digest(request.form.get("csrf_token", ""), session.get("csrf_token", "")):
+            abort(400)
+        audience = request.form.get("audience")
+        if not hmac.compare_digest(request.form.get("admin_secret", "").encode(),
+                                   config.WEBAPP_ADMIN_SECRET.encode()):
+            error = "Wrong admin secret."
+        elif not message:
+            error = "The message is empty."
+        elif audience == "Client" and not client:
+            error = "Enter the client whose contacts should get it."
+        elif db.create_broadcast(audience, message, client if audience == "Client" else None) is None:
+            error = f"No client named '{client}'." if audience == "Client" else "Unknown audience."
+        else:
+            return redirect("/broadcasts")
+    return render_template_string(BROADCASTS_TEMPLATE, broadcasts=db.get_broadcasts(), error=error,
+                                  message=message, client=client, can_send=bool(config.WEBAPP_ADMIN_SECRET),
+                                  csrf_token=csrf_token())
+
 if __name__ == '__main__':
-    app.run(debug=True, port=5000)
+    app.run(debug=config.WEBAPP_DEBUG, port=5000)
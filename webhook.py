@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# webhook.py
+"""
+Webhook ingestion for the three bots (main.py --mode webhook).
+
+One HTTP server takes the updates Telegram POSTs for every bot, each on its own
+path under WEBHOOK_URL: /da, /supervisor and /client. It checks the
+X-Telegram-Bot-Api-Secret-Token header against WEBHOOK_SECRET, puts the update
+on that bot's application queue and answers 200 at once; the handlers run after
+the response, so a slow one doesn't hold Telegram's connection. Unknown paths
+get a 404, a missing or wrong secret a 403, a body that isn't an update a 400.
+
+Put it behind a load balancer that forwards WEBHOOK_URL's paths to WEBHOOK_PORT
+and health-checks GET /healthz, which answers 200 while this replica's
+applications run and 503 while it starts or stops. Tickets, subscriptions and the
+outbox are in Postgres, and invalidation.py keeps every replica's caches current.
+
+Serve the updates from one replica at a time, with the others as standbys (or a
+deploy starting a replacement). Conversation states and user_data are stored
+(persistence.py), so a replacement carries on every conversation. But another
+replica sees a conversation's new state only after the write-behind flush (up to
+PERSISTENCE_FLUSH_INTERVAL) and its NOTIFY. ChatOrderedUpdateProcessor orders a
+chat's updates within one process only. So when updates are spread over
+replicas, a quick second tap can be handled against the state before the first.
+WEBHOOK_MAX_CONNECTIONS does not prevent that either: updates are answered
+before they are handled.
+
+Each replica registers the webhooks when it starts; setWebhook with the same
+URL and secret changes nothing, so replicas starting together don't conflict.
+
+    python webhook.py --set      # register WEBHOOK_URL for the three bots
+    python webhook.py --info     # print each bot's webhook status
+    python webhook.py --delete   # remove the webhooks, e.g. to go back to polling
+"""
+
+import argparse
+import asyncio
+import hmac
+import json
+import logging
+import re
+from urllib.parse import urlsplit
+
+from telegram import Update
+
+import config
+import notifier
+
+logger = logging.getLogger(__name__)
+
+# Path under WEBHOOK_URL -> token, in main.BOTS order
+BOT_PATHS = {"da": config.DA_BOT_TOKEN, "supervisor": config.SUPERVISOR_BOT_TOKEN,
+             "client": config.CLIENT_BOT_TOKEN}
+SECRET_HEADER = "x-telegram-bot-api-secret-token"
+SECRET_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,256}")
+HEALTH_PATH = "/healthz"
+# Updates are a few KB; anything bigger is not from Telegram
+MAX_BODY = 1024 * 1024
+
+REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 405: "Method Not Allowed",
+           413: "Payload Too Large", 503: "Service Unavailable"}
+
+
+def check_secret(secret):
+    """secret, if Telegram accepts it as a secret_token; raises ValueError if not."""
+    if not SECRET_PATTERN.fullmatch(secret or ""):
+        raise ValueError("WEBHOOK_SECRET must be 1-256 characters of A-Z, a-z, 0-9, _ and -")
+    return secret
+
+
+def base_path(url=None):
+    """The path of WEBHOOK_URL (or url) that the bots' paths go under, without a trailing slash."""
+    return urlsplit(url if url is not None else config.WEBHOOK_URL).path.rstrip("/")
+
+
+class WebhookServer:
+    """HTTP server putting the updates for each bot on its application's queue.
+
+    applications maps a name from BOT_PATHS to the bot's Application, which
+    serves updates at <prefix>/<name>; prefix defaults to WEBHOOK_URL's path.
+    """
+
+    def __init__(self, applications, secret=config.WEBHOOK_SECRET, host=config.WEBHOOK_LISTEN,
+                 port=config.WEBHOOK_PORT, prefix=None):
+        prefix = base_path() if prefix is None else prefix
+        self.applications = {f"{prefix}/{name}": application for name, application in applications.items()}
+        self.secret = check_secret(secret).encode()
+        self.host = host
+        self.port = port
+        self.received = 0
+        self.rejected = 0
+        self._server = None
+        self._connections = {}  # handler task -> its StreamWriter
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    def healthy(self):
+        return self._server is not None and all(app.running for app in self.applications.values())
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info("Webhook server listening on %s:%s for %s", self.host, self.port, ", ".join(self.applications))
+        return self
+
+    async def stop(self):
+        """Stop accepting updates; the ones already queued are left to the applications."""
+        server, self._server = self._server, None
+        if server is None:
+            return
+        server.close()
+        for writer in self._connections.values():
+            writer.close()
+        await asyncio.gather(*self._connections, return_exceptions=True)
+        await server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        self._connections[asyncio.current_task()] = writer
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                request_line, *header_lines = head.decode("latin-1").split("\r\n")
+                headers = {}
+                for line in header_lines:
+                    if ":" in line:
+                        name, value = line.split(":", 1)
+                        headers[name.strip().lower()] = value.strip()
+                method, path, version = (request_line.split(" ") + ["", ""])[:3]
+                length = int(headers.get("content-length") or 0)
+                if length > MAX_BODY:
+                    await self._respond(writer, 413, close=True)
+                    return
+                body = await reader.readexactly(length)
+                status = await self._route(method, path.partition("?")[0], headers, body)
+                close = headers.get("connection", "").lower() == "close" or version == "HTTP/1.0"
+                await self._respond(writer, status, close)
+                if close:
+                    return
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, ValueError):
+            pass
+        finally:
+            self._connections.pop(asyncio.current_task(), None)
+            writer.close()
+
+    @staticmethod
+    async def _respond(writer, status, close=False):
+        writer.write(f"HTTP/1.1 {status} {REASONS[status]}\r\nContent-Length: 0\r\n"
+                     f"{'Connection: close' if close else 'Connection: keep-alive'}\r\n\r\n".encode())
+        await writer.drain()
+
+    async def _route(self, method, path, headers, body):
+        if path == HEALTH_PATH:
+            return 200 if self.healthy() else 503
+        application = self.applications.get(path)
+        if application is None:
+            return 404
+        if method != "POST":
+            return 405
+        if not hmac.compare_digest(headers.get(SECRET_HEADER, "").encode(), self.secret):
+            self.rejected += 1
+            logger.warning("Webhook request to %s with a missing or wrong secret token", path)
+            return 403
+        if not application.running:
+            # Telegram retries, and the load balancer tries another replica
+            return 503
+        try:
+            update = Update.de_json(json.loads(body), application.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            logger.warning(f"Webhook request to {path} is not an update: {e}")
+            return 400
+        if update is None:
+            return 400
+        self.received += 1
+        await application.update_queue.put(update)
+        return 200
+
+
+async def set_webhooks(bots, url=None, secret=None):
+    """Point each bot ({name: Bot}) at <url>/<name>; url and secret default to WEBHOOK_URL and WEBHOOK_SECRET."""
+    url = (url or config.WEBHOOK_URL).rstrip("/")
+    secret = check_secret(secret or config.WEBHOOK_SECRET)
+    for name, bot in bots.items():
+        await bot.set_webhook(url=f"{url}/{name}", secret_token=secret,
+                              max_connections=config.WEBHOOK_MAX_CONNECTIONS, allowed_updates=Update.ALL_TYPES)
+        logger.info(f"Webhook for {name} set to {url}/{name}")
+
+
+async def _command(args):
+    bots = {name: notifier.make_bot(token) for name, token in BOT_PATHS.items()}
+    try:
+        if args.set:
+            await set_webhooks(bots)
+        for name, bot in bots.items():
+            if args.delete:
+                await bot.delete_webhook()
+            info = await bot.get_webhook_info()
+            print(f"{name:<10} {info.url or '(none)'}  pending {info.pending_update_count}"
+                  f"{'  last error: ' + info.last_error_message if info.last_error_message else ''}")
+    finally:
+        for bot in bots.values():
+            await bot.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    action = parser.add_mutually_exclusive_group(required=True)
+    action.add_argument("--set", action="store_true", help="register WEBHOOK_URL for the three bots")
+    action.add_argument("--info", action="store_true", help="print each bot's webhook status")
+    action.add_argument("--delete", action="store_true", help="remove the webhooks")
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    if args.set and not config.WEBHOOK_URL:
+        parser.error("WEBHOOK_URL is not set")
+    asyncio.run(_command(args))
+
+
+if __name__ == "__main__":
+    main()